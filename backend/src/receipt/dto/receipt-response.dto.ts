@@ -11,6 +11,27 @@ class ItemDto {
   itemCost: number;
 }
 
+class DuplicateDto {
+  @ApiProperty({
+    description:
+      'returned = the earlier parse of the same receipt, warned = parsed again but the same receipt',
+    example: 'returned',
+  })
+  outcome: string;
+
+  @ApiProperty({
+    description: 'Content hash prefix of the earlier upload',
+    example: '3f2a9c0d4b1e7a65',
+  })
+  of: string;
+
+  @ApiProperty({
+    description: 'Perceptual hash distance to the earlier upload, 0 = same file',
+    example: 3,
+  })
+  distance: number;
+}
+
 export class ReceiptResponseDto {
   @ApiProperty({
     description: 'Unique identifier of the receipt',
@@ -41,4 +62,12 @@ export class ReceiptResponseDto {
 
   @ApiProperty({ description: 'User ID that owns this receipt' })
   userId: string;
+
+  @ApiProperty({
+    description:
+      'Set if the receipt was already uploaded, its expense should not be counted twice',
+    type: DuplicateDto,
+    required: false,
+  })
+  duplicate?: DuplicateDto;
 }
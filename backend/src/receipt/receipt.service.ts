@@ -57,6 +57,8 @@ export class ReceiptService {
           }))
         : [], // Fallback to empty array if itemized_list is missing
       userId: '',
+      // Set by the receipt service when this receipt was already uploaded
+      duplicate: flaskResponse.duplicate,
     };
   }
 
@@ -233,6 +235,8 @@ export class ReceiptService {
       formData.append('defaultModel', model);
       formData.append('geminiKey', geminiKey);
       formData.append('openaiKey', openaiKey);
+      // Scopes the near-duplicate check of the receipt service to this user
+      formData.append('userId', userId);
 
       this.logger.log('Sending image to Flask for processing');
 
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from typing import Callable, Optional
+import asyncio
+import threading
+import time
+
+
+def schedule_async_close(close_coroutine):
+    """Close an async client from a sync eviction callback, the close runs on the current event loop"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # No loop to run on, the client is cleaned up when it is garbage collected
+        close_coroutine.close()
+        return
+    loop.create_task(close_coroutine)
+
+
+class ClientRegistry:
+    """Bounded per API key cache of provider clients
+
+    Clients keep their HTTP connection pools warm between requests. The least recently used client is dropped
+    when the registry is full, and clients that were not used for idle_ttl seconds are dropped on the next lookup.
+    Dropped clients are not closed, a request may still be using them, they close their connections when the last
+    handler holding them is garbage collected. close is only called by clear.
+    """
+    def __init__(self, factory: Callable[[str], object], max_size: int = 64, idle_ttl: Optional[float] = 600,
+                 close: Optional[Callable[[object], None]] = None):
+        if max_size <= 0:
+            raise ValueError("max_size must be greater than 0")
+        self.factory = factory
+        self.max_size = max_size
+        # None or 0 = clients are only evicted when the registry is full
+        self.idle_ttl = idle_ttl or None
+        self.close = close
+        # api_key -> (last_used, client), ordered from least to most recently used
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str):
+        now = time.monotonic()
+        with self._lock:
+            self._pop_idle(now)
+            entry = self._clients.get(api_key)
+            if entry is not None:
+                client = entry[1]
+                self._clients[api_key] = (now, client)
+                self._clients.move_to_end(api_key)
+
+        if entry is None:
+            # Construct outside the lock, client setup can be slow
+            client = self.factory(api_key)
+            with self._lock:
+                if api_key in self._clients:
+                    # Another request created the client first, use theirs
+                    client = self._clients[api_key][1]
+                self._clients[api_key] = (now, client)
+                self._clients.move_to_end(api_key)
+                while len(self._clients) > self.max_size:
+                    self._clients.popitem(last=False)
+        return client
+
+    def discard(self, api_key: str):
+        """Remove the client of an API key, e.g. after the provider rejected the key"""
+        with self._lock:
+            self._clients.pop(api_key, None)
+
+    def clear(self):
+        """Close every client, only once no request can be using them, e.g. at shutdown"""
+        with self._lock:
+            evicted = [client for _, client in self._clients.values()]
+            self._clients.clear()
+        self._close_all(evicted)
+
+    def __contains__(self, api_key: str):
+        with self._lock:
+            return api_key in self._clients
+
+    def __len__(self):
+        with self._lock:
+            return len(self._clients)
+
+    def _pop_idle(self, now):
+        if self.idle_ttl is None:
+            return
+        # Oldest entries are at the front, stop at the first one that is still fresh
+        while self._clients:
+            api_key, (last_used, _) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            del self._clients[api_key]
+
+    def _close_all(self, clients):
+        if self.close is None:
+            return
+        for client in clients:
+            try:
+                self.close(client)
+            except Exception as e:
+                print(f"Error closing client: {e}")
@@ -0,0 +1,187 @@
+import os
+
+
+class Config:
+    """Default service configuration, every value can be overridden with an environment variable"""
+    # Parse result cache, keyed on the uploaded bytes + model name + prompt version
+    # Backend is either 'memory' (in-process LRU) or 'disk' (survives restarts)
+    PARSE_CACHE_BACKEND = os.getenv('PARSE_CACHE_BACKEND', 'memory')
+    # Entries kept by either backend, the least recently used (memory) or oldest written (disk) are dropped first
+    PARSE_CACHE_MAX_SIZE = int(os.getenv('PARSE_CACHE_MAX_SIZE', 1024))
+    # Seconds before a cached parse expires, 0 = never expire
+    PARSE_CACHE_TTL = int(os.getenv('PARSE_CACHE_TTL', 7 * 24 * 60 * 60))
+    PARSE_CACHE_DIR = os.getenv('PARSE_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'downloads', 'parse-cache'))
+
+    # Provider clients are reused per API key, so HTTP connections stay warm between requests
+    CLIENT_REGISTRY_MAX_SIZE = int(os.getenv('CLIENT_REGISTRY_MAX_SIZE', 64))
+    # Seconds a client can stay unused before it is dropped, 0 = only drop clients when the registry is full
+    CLIENT_REGISTRY_IDLE_TTL = int(os.getenv('CLIENT_REGISTRY_IDLE_TTL', 600))
+
+    # Async (ASGI) serving mode, see asyncservice.py
+    # Max receipt parses / reviews awaiting a provider at once, further requests wait for a free slot
+    ASYNC_MAX_CONCURRENCY = int(os.getenv('ASYNC_MAX_CONCURRENCY', 256))
+    ASYNC_BIND = os.getenv('ASYNC_BIND', '0.0.0.0:8081')
+
+    # How /upload uses the parsers when the request has no parsePolicy
+    # 'fallback' = try in order, 'race' = start the next parser after PARSE_HEDGE_DELAY, first valid receipt wins
+    PARSE_POLICY = os.getenv('PARSE_POLICY', 'fallback')
+    # Seconds to wait for the default parser before also starting the next one, 0 = start all at once
+    PARSE_HEDGE_DELAY = float(os.getenv('PARSE_HEDGE_DELAY', 3.0))
+    # Threads running raced parses in the sync service
+    RACE_MAX_WORKERS = int(os.getenv('RACE_MAX_WORKERS', 32))
+
+    # How /upload sends the pages of a PDF when the request has no pageMode, see pages.py
+    # 'combined' = all pages in one prompt, 'merge' = parse page groups in parallel and merge them,
+    # 'split' = parse page groups in parallel and return one receipt per group
+    PAGE_MODE = os.getenv('PAGE_MODE', 'combined')
+    PAGES_PER_GROUP = int(os.getenv('PAGES_PER_GROUP', 1))
+    # Processes rasterizing PDF pages, 0 = one per CPU
+    PDF_RASTER_WORKERS = int(os.getenv('PDF_RASTER_WORKERS', 0))
+    # Threads parsing page groups in the sync service
+    PAGE_PARSE_WORKERS = int(os.getenv('PAGE_PARSE_WORKERS', 16))
+
+    # PDF rasterization, pages are rendered one at a time from a temp file, see rasterize.py
+    PDF_DPI = int(os.getenv('PDF_DPI', 200))
+    PDF_GRAYSCALE = os.getenv('PDF_GRAYSCALE', 'false').lower() == 'true'
+    # PDFs with more pages are rejected, 0 = no limit
+    PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', 0))
+    # Pages rendered ahead of the page parsers in merge/split page modes, also bounds the pages being parsed at once
+    PDF_PREFETCH_PAGES = int(os.getenv('PDF_PREFETCH_PAGES', 4))
+
+    # Image preprocessing ahead of the vision parsers, see preprocess.py
+    # Crop phone photos to the receipt paper, convert to grayscale and stretch the contrast, once per upload
+    IMAGE_AUTOCROP = os.getenv('IMAGE_AUTOCROP', 'true').lower() == 'true'
+    IMAGE_GRAYSCALE = os.getenv('IMAGE_GRAYSCALE', 'true').lower() == 'true'
+    IMAGE_AUTOCONTRAST = os.getenv('IMAGE_AUTOCONTRAST', 'true').lower() == 'true'
+    # Encoding sent to the providers, 'jpeg' or 'webp'
+    IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'jpeg')
+    IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 85))
+    # OpenAI downscales detail high images to fit 2048 x 2048 with a shortest side of 768, sending more is wasted
+    OPENAI_IMAGE_MAX_DIMENSION = int(os.getenv('OPENAI_IMAGE_MAX_DIMENSION', 2048))
+    OPENAI_IMAGE_MAX_SHORT_SIDE = int(os.getenv('OPENAI_IMAGE_MAX_SHORT_SIDE', 768))
+    # Gemini bills a flat 258 tokens per image, a smaller image only saves upload time
+    GEMINI_IMAGE_MAX_DIMENSION = int(os.getenv('GEMINI_IMAGE_MAX_DIMENSION', 1600))
+
+    # Local OCR pre-pass, see ocr.py. Needs pytesseract and the tesseract binary
+    OCR_ENABLED = os.getenv('OCR_ENABLED', 'false').lower() == 'true'
+    # Worker processes running tesseract, 0 = one per CPU
+    OCR_WORKERS = int(os.getenv('OCR_WORKERS', 0))
+    OCR_LANG = os.getenv('OCR_LANG', 'eng')
+    # Mean word confidence (0-100) and words a page needs to be sent as text, otherwise the image is sent
+    OCR_MIN_CONFIDENCE = float(os.getenv('OCR_MIN_CONFIDENCE', 80))
+    OCR_MIN_WORDS = int(os.getenv('OCR_MIN_WORDS', 10))
+    # Thumbnail sent along with the OCR text, so the model can check it, 0 = text only
+    OCR_THUMBNAIL_MAX_DIMENSION = int(os.getenv('OCR_THUMBNAIL_MAX_DIMENSION', 0))
+
+    # Merchant templates learned from OCR pages, see TemplateStore.py. Only used with OCR_ENABLED
+    TEMPLATES_ENABLED = os.getenv('TEMPLATES_ENABLED', 'true').lower() == 'true'
+    # Backend is either 'disk' (survives restarts) or 'memory' (in-process LRU)
+    TEMPLATE_STORE_BACKEND = os.getenv('TEMPLATE_STORE_BACKEND', 'disk')
+    TEMPLATE_STORE_MAX_SIZE = int(os.getenv('TEMPLATE_STORE_MAX_SIZE', 10000))
+    # Seconds a template is kept after it was last learned, 0 = forever
+    TEMPLATE_STORE_TTL = int(os.getenv('TEMPLATE_STORE_TTL', 30 * 24 * 60 * 60))
+    TEMPLATE_STORE_DIR = os.getenv('TEMPLATE_STORE_DIR',
+                                   os.path.join(os.path.dirname(__file__), 'downloads', 'templates'))
+
+    # Near-duplicate photo uploads, see DuplicateIndex.py. Requests can opt out with allowDuplicate=true
+    DUPLICATES_ENABLED = os.getenv('DUPLICATES_ENABLED', 'true').lower() == 'true'
+    # 'warn' = flag a duplicate in its response, 'return' = answer it with the earlier parse, flagged the same way.
+    # A match is parsed to confirm its merchant, date and total, unless 'return' mode answers it without parsing
+    DUPLICATE_MODE = os.getenv('DUPLICATE_MODE', 'warn')
+    # Hamming distances within which two photos may be the same receipt, of 64 pHash bits and 256 dHash bits
+    DUPLICATE_MAX_PHASH_DISTANCE = int(os.getenv('DUPLICATE_MAX_PHASH_DISTANCE', 10))
+    DUPLICATE_MAX_DHASH_DISTANCE = int(os.getenv('DUPLICATE_MAX_DHASH_DISTANCE', 48))
+    # Distances within which 'return' mode answers with the earlier parse without calling a model
+    DUPLICATE_RETURN_MAX_PHASH_DISTANCE = int(os.getenv('DUPLICATE_RETURN_MAX_PHASH_DISTANCE', 4))
+    DUPLICATE_RETURN_MAX_DHASH_DISTANCE = int(os.getenv('DUPLICATE_RETURN_MAX_DHASH_DISTANCE', 24))
+    # Uploads kept in the in-process index, oldest are dropped first
+    DUPLICATE_INDEX_MAX_SIZE = int(os.getenv('DUPLICATE_INDEX_MAX_SIZE', 1000000))
+
+    # Batch uploads, see batch.py
+    BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', 500))
+    # Bytes, larger files are rejected, zip archives are checked per file
+    BATCH_MAX_FILE_SIZE = int(os.getenv('BATCH_MAX_FILE_SIZE', 20 * 1024 * 1024))
+    # Bytes of all files of a batch together, after zip archives are expanded, 0 = unbounded
+    BATCH_MAX_TOTAL_SIZE = int(os.getenv('BATCH_MAX_TOTAL_SIZE', 200 * 1024 * 1024))
+    # Files of a batch parsed at once, in the sync service this is shared by all batches
+    BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', 8))
+
+    # Background parse jobs for /upload with async=true, see jobs.py
+    # Processes can share a job database, unfinished jobs are failed once their process stopped renewing them
+    JOB_DB_PATH = os.getenv('JOB_DB_PATH', os.path.join(os.path.dirname(__file__), 'downloads', 'jobs.sqlite3'))
+    JOB_UPLOAD_DIR = os.getenv('JOB_UPLOAD_DIR', os.path.join(os.path.dirname(__file__), 'downloads', 'jobs'))
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+    # Jobs queued or running at once, further async uploads get a 503 until some finish
+    JOB_MAX_PENDING = int(os.getenv('JOB_MAX_PENDING', 100))
+    # Seconds finished jobs are kept for polling, 0 = keep forever
+    JOB_TTL = int(os.getenv('JOB_TTL', 24 * 60 * 60))
+    JOB_CALLBACK_TIMEOUT = float(os.getenv('JOB_CALLBACK_TIMEOUT', 10.0))
+    # Seconds an unfinished job stays reserved for its process without a renewal, renewed every third of it
+    JOB_LEASE = float(os.getenv('JOB_LEASE', 120))
+    # Threads sending callbacks, separate from the job workers
+    JOB_CALLBACK_WORKERS = int(os.getenv('JOB_CALLBACK_WORKERS', 4))
+    # Comma separated callbackUrl hosts, empty = any host that only resolves to public addresses
+    JOB_CALLBACK_ALLOWED_HOSTS = [host.strip().lower()
+                                  for host in os.getenv('JOB_CALLBACK_ALLOWED_HOSTS', '').split(',') if host.strip()]
+
+    # Tokens the text only correction turns of one parse may spend together, retries stop once the next one
+    # would not fit. A correction costs about the previous JSON twice, far less than resending the images.
+    PARSE_RETRY_TOKEN_BUDGET = int(os.getenv('PARSE_RETRY_TOKEN_BUDGET', 6000))
+
+    # /review sends up to this many receipts verbatim, longer histories are sent as a spending summary
+    REVIEW_MAX_RAW_RECEIPTS = int(os.getenv('REVIEW_MAX_RAW_RECEIPTS', 20))
+    # Most recent receipts sent verbatim along with the summary
+    REVIEW_SAMPLE_RECEIPTS = int(os.getenv('REVIEW_SAMPLE_RECEIPTS', 5))
+
+    # /review insights cache, keyed on the normalized receipts + query, see InsightsCache.py
+    # Backend is either 'memory' (in-process LRU) or 'disk' (survives restarts)
+    INSIGHTS_CACHE_BACKEND = os.getenv('INSIGHTS_CACHE_BACKEND', 'memory')
+    INSIGHTS_CACHE_MAX_SIZE = int(os.getenv('INSIGHTS_CACHE_MAX_SIZE', 1024))
+    # Seconds cached insights are returned as is, 0 = do not cache
+    INSIGHTS_CACHE_TTL = int(os.getenv('INSIGHTS_CACHE_TTL', 60 * 60))
+    # Seconds after the TTL that stale insights are still returned while fresh ones are generated in the background,
+    # 0 = regenerate in the request once the TTL has passed
+    INSIGHTS_CACHE_STALE_TTL = int(os.getenv('INSIGHTS_CACHE_STALE_TTL', 24 * 60 * 60))
+    INSIGHTS_CACHE_DIR = os.getenv('INSIGHTS_CACHE_DIR',
+                                   os.path.join(os.path.dirname(__file__), 'downloads', 'insights-cache'))
+    # Threads refreshing stale insights in the sync service
+    REVIEW_REFRESH_WORKERS = int(os.getenv('REVIEW_REFRESH_WORKERS', 4))
+
+    # Rolling summaries of incremental /review requests, see RollingSummary.py
+    # Backend is either 'disk' (survives restarts) or 'memory' (in-process LRU)
+    ROLLING_SUMMARY_BACKEND = os.getenv('ROLLING_SUMMARY_BACKEND', 'disk')
+    ROLLING_SUMMARY_MAX_SIZE = int(os.getenv('ROLLING_SUMMARY_MAX_SIZE', 10000))
+    # Seconds a summary is kept after its last update, 0 = forever
+    ROLLING_SUMMARY_TTL = int(os.getenv('ROLLING_SUMMARY_TTL', 90 * 24 * 60 * 60))
+    ROLLING_SUMMARY_DIR = os.getenv('ROLLING_SUMMARY_DIR',
+                                    os.path.join(os.path.dirname(__file__), 'downloads', 'rolling-summaries'))
+
+    # Per provider circuit breakers, see breaker.py
+    BREAKER_ENABLED = os.getenv('BREAKER_ENABLED', 'true').lower() == 'true'
+    # Rolling window of calls the error rate is computed over
+    BREAKER_WINDOW_SECONDS = float(os.getenv('BREAKER_WINDOW_SECONDS', 60))
+    # Calls in the window before the breaker can open, a single failure of an idle provider does not open it
+    BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 5))
+    # Share of failed calls in the window that opens the breaker
+    BREAKER_ERROR_RATE = float(os.getenv('BREAKER_ERROR_RATE', 0.5))
+    # Seconds an open breaker skips its provider before letting a probe through
+    BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', 30))
+    # Calls slower than this count as failures, 0 = only errors count
+    BREAKER_SLOW_CALL_SECONDS = float(os.getenv('BREAKER_SLOW_CALL_SECONDS', 0))
+    # A provider whose median latency is this many times the fastest one is tried after it, 0 = keep the order
+    ROUTING_LATENCY_RATIO = float(os.getenv('ROUTING_LATENCY_RATIO', 3.0))
+
+    # Provider endpoints, unset = the providers' own APIs. Point both at benchmarks/mock_provider.py to load test the
+    # service offline, the mock only speaks REST so Gemini needs GEMINI_TRANSPORT=rest (sync service only)
+    OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL') or None
+    GEMINI_API_ENDPOINT = os.getenv('GEMINI_API_ENDPOINT') or None
+    # 'grpc' (default) or 'rest'
+    GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT') or None
+
+    # Record / replay of provider calls, see cassette.py
+    # 'off' (default), 'record', 'replay' (no network, an unrecorded call fails) or 'auto' (replay, else record)
+    CASSETTE_MODE = os.getenv('CASSETTE_MODE', 'off')
+    CASSETTE_PATH = os.getenv('CASSETTE_PATH',
+                              os.path.join(os.path.dirname(__file__), 'tests', 'cassettes', 'providers.json.gz'))
+    # 'collapse' replays at once, 'preserve' waits as long as the recorded call took
+    CASSETTE_LATENCY = os.getenv('CASSETTE_LATENCY', 'collapse')
@@ -0,0 +1,301 @@
+from collections import OrderedDict, deque
+from itertools import combinations
+from typing import Optional
+import json
+import math
+import threading
+import PIL.Image
+from metrics import DUPLICATE_LOOKUPS
+from RollingSummary import get_user_key
+
+# Near-duplicate uploads
+# The parse cache only knows uploads byte for byte, a receipt photographed twice is parsed twice and its expense
+# counted twice. Every parsed photo is indexed by two perceptual hashes of its normalized image: a 64 bit pHash
+# (low frequencies of a DCT, robust to lighting and re-encoding) and a 256 bit dHash (gradients, checks detail).
+# Lookups are multi-index hashing on the pHash: it is split into chunks, and any hash within max_phash_distance
+# has at least one chunk within max_phash_distance // chunks of the query's, so only the few buckets around each
+# chunk are probed instead of comparing against every entry. Entries are scoped per user, receipts of the same
+# merchant look alike at this resolution and must never be matched across users.
+# Similar looking receipts of the same merchant can still be within the distances, so a borderline match is only
+# a candidate: the upload is parsed anyway, and it is only a duplicate if its merchant, date and total are those of
+# the earlier parse. In 'return' mode a match well inside both distances is answered with the earlier parse without
+# calling a model, confirmed matches get the earlier parse too, so a client sees the same receipt twice. The
+# response body carries a duplicate field either way.
+# A byte for byte re-upload is answered by the parse cache before any of this, so the content hashes parsed in each
+# scope are kept too, and a cache hit on one of them is flagged the same way.
+
+DUPLICATE_RETURNED = 'returned'
+DUPLICATE_WARNED = 'warned'
+DUPLICATE_NONE = 'none'
+# Fields that must agree between the earlier and the new parse for the upload to be the same receipt
+CONFIRM_FIELDS = ('merchant_name', 'date', 'total_cost')
+
+PHASH_SIZE = 8
+DHASH_SIZE = 16
+# Cosines of the 32 point DCT, only the 8 lowest frequencies are kept
+_DCT_SIZE = 32
+_DCT = [[math.cos(math.pi * (2 * x + 1) * u / (2 * _DCT_SIZE)) for x in range(_DCT_SIZE)] for u in range(PHASH_SIZE)]
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def phash(img: PIL.Image.Image) -> int:
+    """64 bit perceptual hash, the signs of the 8x8 lowest DCT frequencies against their median"""
+    pixels = list(img.convert('L').resize((_DCT_SIZE, _DCT_SIZE), PIL.Image.LANCZOS, reducing_gap=3.0).getdata())
+    # Separable DCT, rows first then columns
+    rows = []
+    for y in range(_DCT_SIZE):
+        row = pixels[y * _DCT_SIZE:(y + 1) * _DCT_SIZE]
+        rows.append([sum(c * p for c, p in zip(_DCT[u], row)) for u in range(PHASH_SIZE)])
+    coefficients = [sum(_DCT[v][y] * rows[y][u] for y in range(_DCT_SIZE))
+                    for v in range(PHASH_SIZE) for u in range(PHASH_SIZE)]
+    median = sorted(coefficients)[len(coefficients) // 2]
+    bits = 0
+    for coefficient in coefficients:
+        bits = (bits << 1) | (coefficient > median)
+    return bits
+
+
+def dhash(img: PIL.Image.Image, hash_size: int = DHASH_SIZE) -> int:
+    """hash_size² bit difference hash, whether each pixel is brighter than its right neighbour"""
+    width = hash_size + 1
+    pixels = list(img.convert('L').resize((width, hash_size), PIL.Image.LANCZOS, reducing_gap=3.0).getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[row * width + col] > pixels[row * width + col + 1])
+    return bits
+
+
+def image_hashes(img: PIL.Image.Image):
+    """(phash, dhash) of a normalized upload"""
+    return phash(img), dhash(img)
+
+
+def _flip_masks(bits: int, radius: int):
+    """Masks flipping up to radius of bits bits"""
+    masks = []
+    for flipped in range(radius + 1):
+        for positions in combinations(range(bits), flipped):
+            mask = 0
+            for position in positions:
+                mask |= 1 << position
+            masks.append(mask)
+    return masks
+
+
+class DuplicateMatch:
+    """Indexed upload a new one is a near-duplicate of"""
+    def __init__(self, content_hash: str, phash_distance: int, dhash_distance: int):
+        self.content_hash = content_hash
+        self.phash_distance = phash_distance
+        self.dhash_distance = dhash_distance
+        # DUPLICATE_RETURNED or DUPLICATE_WARNED, set by DuplicateIndex.resolve
+        self.outcome = None
+
+    def headers(self) -> dict:
+        return {'X-Duplicate': self.outcome, 'X-Duplicate-Of': self.content_hash[:16],
+                'X-Duplicate-Distance': str(self.phash_distance)}
+
+    def to_dict(self) -> dict:
+        return {'outcome': self.outcome, 'of': self.content_hash[:16], 'distance': self.phash_distance}
+
+
+class DuplicateIndex:
+    """In-process index of the perceptual hashes of parsed uploads, oldest entries are dropped past max_size"""
+    def __init__(self, mode: str = 'warn', max_phash_distance: int = 10, max_dhash_distance: int = 48,
+                 return_phash_distance: int = 4, return_dhash_distance: int = 24, max_size: int = 1000000,
+                 chunks: int = 4):
+        if 64 % chunks:
+            raise ValueError("chunks must divide the 64 bits of the pHash")
+        # 'warn' = flag a confirmed duplicate in its own parse, 'return' = answer it with the earlier parse
+        self.mode = mode
+        self.max_phash_distance = max_phash_distance
+        self.max_dhash_distance = max_dhash_distance
+        # In 'return' mode, matches within both of these are answered without parsing the upload
+        self.return_phash_distance = return_phash_distance
+        self.return_dhash_distance = return_dhash_distance
+        self.max_size = max_size
+        self.chunks = chunks
+        self.chunk_bits = 64 // chunks
+        self._chunk_mask = (1 << self.chunk_bits) - 1
+        self._probes = _flip_masks(self.chunk_bits, max_phash_distance // chunks)
+        # entry id -> (scope, phash, dhash, content_hash)
+        self.entries = {}
+        # One table per chunk, (scope, chunk value) -> entry ids
+        self.tables = [{} for _ in range(chunks)]
+        self.order = deque()
+        self.next_id = 0
+        # (scope, content_hash) of the uploads parsed in each scope, photos or not, oldest first
+        self.uploads = OrderedDict()
+        self.counts = {DUPLICATE_RETURNED: 0, DUPLICATE_WARNED: 0, DUPLICATE_NONE: 0}
+        self._lock = threading.Lock()
+
+    def _chunk_values(self, value: int):
+        return [(value >> (index * self.chunk_bits)) & self._chunk_mask for index in range(self.chunks)]
+
+    def lookup(self, scope: str, hashes) -> Optional[DuplicateMatch]:
+        """Closest indexed upload of scope within both distances, or None"""
+        query_phash, query_dhash = hashes
+        best = None
+        with self._lock:
+            seen = set()
+            for table, chunk in zip(self.tables, self._chunk_values(query_phash)):
+                for mask in self._probes:
+                    for entry_id in table.get((scope, chunk ^ mask), ()):
+                        if entry_id in seen:
+                            continue
+                        seen.add(entry_id)
+                        _, entry_phash, entry_dhash, content_hash = self.entries[entry_id]
+                        phash_distance = hamming(query_phash, entry_phash)
+                        if phash_distance > self.max_phash_distance:
+                            continue
+                        dhash_distance = hamming(query_dhash, entry_dhash)
+                        if dhash_distance > self.max_dhash_distance:
+                            continue
+                        if best is None or (phash_distance, dhash_distance) < (best.phash_distance,
+                                                                               best.dhash_distance):
+                            best = DuplicateMatch(content_hash, phash_distance, dhash_distance)
+        return best
+
+    def add(self, scope: str, hashes, content_hash: str):
+        entry_phash, entry_dhash = hashes
+        with self._lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = (scope, entry_phash, entry_dhash, content_hash)
+            for table, chunk in zip(self.tables, self._chunk_values(entry_phash)):
+                table.setdefault((scope, chunk), []).append(entry_id)
+            self.order.append(entry_id)
+            while len(self.order) > self.max_size:
+                self._remove(self.order.popleft())
+
+    def _remove(self, entry_id: int):
+        scope, entry_phash, _, _ = self.entries.pop(entry_id)
+        for table, chunk in zip(self.tables, self._chunk_values(entry_phash)):
+            bucket = table[(scope, chunk)]
+            bucket.remove(entry_id)
+            if not bucket:
+                del table[(scope, chunk)]
+
+    def add_upload(self, scope: str, content_hash: str):
+        """Remember that the upload of content_hash was parsed in scope"""
+        with self._lock:
+            self.uploads[(scope, content_hash)] = None
+            self.uploads.move_to_end((scope, content_hash))
+            while len(self.uploads) > self.max_size:
+                self.uploads.popitem(last=False)
+
+    def check_cached(self, scope: str, upload, cached_json: str) -> str:
+        """Cached parse of an upload, flagged if the same bytes were already uploaded in scope"""
+        with self._lock:
+            seen = (scope, upload.content_hash) in self.uploads
+        if not seen:
+            # Parsed for another scope, the next upload of these bytes in this one is a duplicate
+            self.add_upload(scope, upload.content_hash)
+            return cached_json
+        match = DuplicateMatch(upload.content_hash, 0, 0)
+        match.outcome = DUPLICATE_RETURNED
+        print(f"Upload is the same file as {match.content_hash[:16]}, {match.outcome}")
+        self.record(match.outcome)
+        upload.duplicate = match
+        return flag_response(json.loads(cached_json), match)
+
+    def check(self, scope: str, img: PIL.Image.Image):
+        """(hashes, DuplicateMatch or None) of a normalized upload, a match is then answered or resolved"""
+        hashes = image_hashes(img)
+        match = self.lookup(scope, hashes)
+        if match is None:
+            self.record(DUPLICATE_NONE)
+        return hashes, match
+
+    def answer(self, match: DuplicateMatch, upload, earlier_json: Optional[str]) -> Optional[str]:
+        """Earlier parse flagged as the response of an unparsed upload, None if the upload has to be parsed
+
+        Only in 'return' mode, for a match close enough not to need a parse to confirm it, whose earlier parse is
+        still cached.
+        """
+        if earlier_json is None or not self.can_answer(match):
+            return None
+        match.outcome = DUPLICATE_RETURNED
+        print(f"Upload is a duplicate of {match.content_hash[:16]} at distance {match.phash_distance}, "
+              f"{match.outcome} without parsing")
+        self.record(match.outcome)
+        upload.duplicate = match
+        return flag_response(json.loads(earlier_json), match)
+
+    def can_answer(self, match: DuplicateMatch) -> bool:
+        return (self.mode == 'return' and match.phash_distance <= self.return_phash_distance and
+                match.dhash_distance <= self.return_dhash_distance)
+
+    def resolve(self, match: DuplicateMatch, upload, response_json: str, earlier_json: Optional[str]) -> str:
+        """Response of a parsed upload that matched, flagged if it is the same receipt as the earlier parse
+
+        earlier_json is the cached parse of the matched upload, an earlier parse that is no longer cached cannot
+        confirm the match, the upload is flagged but keeps its own parse. A confirmed duplicate is kept on
+        upload.duplicate, so the response headers can flag it too.
+        """
+        response = json.loads(response_json)
+        earlier = json.loads(earlier_json) if earlier_json is not None else None
+        if earlier is not None and not same_receipt(earlier, response):
+            print(f"Upload looks like {match.content_hash[:16]} at distance {match.phash_distance}, "
+                  f"but is a different receipt")
+            self.record(DUPLICATE_NONE)
+            return response_json
+        if self.mode == 'return' and earlier is not None:
+            match.outcome = DUPLICATE_RETURNED
+            response = earlier
+        else:
+            match.outcome = DUPLICATE_WARNED
+        print(f"Upload is a duplicate of {match.content_hash[:16]} at distance {match.phash_distance}, "
+              f"{match.outcome}")
+        self.record(match.outcome)
+        upload.duplicate = match
+        return flag_response(response, match)
+
+    def record(self, outcome: str):
+        DUPLICATE_LOOKUPS.labels(outcome).inc()
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self.counts, 'size': len(self.entries), 'uploads': len(self.uploads)}
+
+
+def flag_response(response, match: DuplicateMatch) -> str:
+    """json of a parsed response with the duplicate field, set on each receipt of a split document"""
+    # Clients that count expenses read the body, not the headers
+    for receipt in response if isinstance(response, list) else [response]:
+        receipt['duplicate'] = match.to_dict()
+    return json.dumps(response)
+
+
+def same_receipt(earlier, parsed) -> bool:
+    """True if two parses agree on the CONFIRM_FIELDS, ignoring case and surrounding spaces"""
+    if not isinstance(earlier, dict) or not isinstance(parsed, dict):
+        return False
+    return all(str(earlier.get(field)).strip().lower() == str(parsed.get(field)).strip().lower()
+               for field in CONFIRM_FIELDS)
+
+
+def create_duplicate_index(config) -> Optional[DuplicateIndex]:
+    if not config['DUPLICATES_ENABLED']:
+        return None
+    if config['DUPLICATE_MODE'] not in ('return', 'warn'):
+        raise ValueError(f"Unknown duplicate mode '{config['DUPLICATE_MODE']}', expected 'return' or 'warn'")
+    return DuplicateIndex(mode=config['DUPLICATE_MODE'], max_phash_distance=config['DUPLICATE_MAX_PHASH_DISTANCE'],
+                          max_dhash_distance=config['DUPLICATE_MAX_DHASH_DISTANCE'],
+                          return_phash_distance=config['DUPLICATE_RETURN_MAX_PHASH_DISTANCE'],
+                          return_dhash_distance=config['DUPLICATE_RETURN_MAX_DHASH_DISTANCE'],
+                          max_size=config['DUPLICATE_INDEX_MAX_SIZE'])
+
+
+def get_duplicate_scope(form) -> Optional[str]:
+    """Scope of the uploads of a request, its userId or else its API keys, None if allowDuplicate is set"""
+    if form.get('allowDuplicate', 'false').lower() == 'true':
+        return None
+    return get_user_key({'userId': form.get('userId'),
+                         'apiKeys': {'geminiKey': form.get('geminiKey'), 'openaiKey': form.get('openaiKey')}})
@@ -9,4 +9,11 @@ class APIKeyError(Exception):
     """Invalid API key"""
     def __init__(self):
         # No message needed
-        super().__init__()
\ No newline at end of file
+        super().__init__()
+
+class PageLimitError(Exception):
+    """PDF has more pages than PDF_MAX_PAGES"""
+    def __init__(self, page_count: int, max_pages: int):
+        self.page_count = page_count
+        self.max_pages = max_pages
+        super().__init__(f"PDF has {page_count} pages, at most {max_pages} are supported")
@@ -0,0 +1,131 @@
+from typing import Optional, Tuple
+import hashlib
+import json
+import threading
+import time
+from ParseCache import AbstractCacheBackend, MemoryCacheBackend, DiskCacheBackend
+
+# Receipt fields that affect the insights, anything else (ids, timestamps of the app) is left out of the key
+RECEIPT_FIELDS = ('merchantName', 'date', 'category', 'totalCost')
+ITEM_FIELDS = ('itemName', 'itemQuantity', 'itemCost')
+
+
+def _normalize_value(value):
+    if isinstance(value, str):
+        return ' '.join(value.split())
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # 3, 3.0 and "3.0" from different clients are the same cost
+        return repr(float(value))
+    return value
+
+
+def normalize_receipt(receipt) -> str:
+    """Receipt reduced to the fields the reviewer sees, as canonical json"""
+    entry = {field: _normalize_value(receipt.get(field)) for field in RECEIPT_FIELDS}
+    entry['itemizedList'] = sorted(
+        (json.dumps({field: _normalize_value(item.get(field)) for field in ITEM_FIELDS}, sort_keys=True)
+         for item in receipt.get('itemizedList') or []))
+    return json.dumps(entry, sort_keys=True)
+
+
+def normalize_receipts(receipts) -> list:
+    # Order of the receipts does not change the insights
+    return sorted(normalize_receipt(receipt) for receipt in receipts)
+
+
+def receipt_fingerprint(receipt) -> str:
+    return hashlib.sha256(normalize_receipt(receipt).encode('utf-8')).hexdigest()[:16]
+
+
+class InsightsCache:
+    """Cache of /review insights, keyed by a hash of the normalized receipts and query
+
+    The key changes whenever a receipt is added, removed or edited, so a changed receipt set never sees the
+    insights of the old one. Entries are fresh for ttl seconds, then stale for stale_ttl more seconds: a stale
+    entry is still returned, and the caller generates fresh insights in the background (stale-while-revalidate).
+    """
+    def __init__(self, backend: AbstractCacheBackend, ttl: float, stale_ttl: float = 0):
+        # ttl 0 disables the cache
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        # Keys with a background refresh running, so a burst of reloads only starts one
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(receipts, query: str, prompt_version) -> str:
+        canonical = json.dumps({
+            'receipts': normalize_receipts(receipts),
+            'query': ' '.join((query or '').split()).lower(),
+            'prompt_version': prompt_version,
+        }, sort_keys=True)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def lookup(self, key: str) -> Tuple[Optional[str], bool]:
+        """(insights, is_stale), insights is None on a miss"""
+        if not self.ttl:
+            return None, False
+        value = self.backend.get(key)
+        entry = json.loads(value) if value is not None else None
+        # Wall clock time, disk entries outlive the process
+        age = time.time() - entry['created_at'] if entry is not None else None
+
+        with self._lock:
+            if age is not None and age < self.ttl:
+                self.hits += 1
+                return entry['insights'], False
+            if age is not None and age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                return entry['insights'], True
+            self.misses += 1
+            return None, False
+
+    def store(self, key: str, insights: str):
+        if not self.ttl:
+            return
+        self.backend.set(key, json.dumps({'insights': insights, 'created_at': time.time()}))
+
+    def start_refresh(self, key: str) -> bool:
+        """True if the caller should refresh the key, False if a refresh is already running"""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            self.refreshes += 1
+            return True
+
+    def finish_refresh(self, key: str):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def stats(self):
+        with self._lock:
+            hits, stale_hits, misses, refreshes = self.hits, self.stale_hits, self.misses, self.refreshes
+        lookups = hits + stale_hits + misses
+        return {
+            'hits': hits,
+            'stale_hits': stale_hits,
+            'misses': misses,
+            'hit_rate': (hits + stale_hits) / lookups if lookups else 0.0,
+            'refreshes': refreshes,
+            'size': len(self.backend),
+        }
+
+
+def create_insights_cache(config) -> InsightsCache:
+    backend_name = config['INSIGHTS_CACHE_BACKEND'].lower()
+    # Stale entries are kept until the end of their stale window
+    backend_ttl = config['INSIGHTS_CACHE_TTL'] + config['INSIGHTS_CACHE_STALE_TTL']
+    if backend_name == 'memory':
+        backend = MemoryCacheBackend(max_size=config['INSIGHTS_CACHE_MAX_SIZE'], ttl=backend_ttl)
+    elif backend_name == 'disk':
+        backend = DiskCacheBackend(directory=config['INSIGHTS_CACHE_DIR'], ttl=backend_ttl,
+                                   max_size=config['INSIGHTS_CACHE_MAX_SIZE'])
+    else:
+        raise ValueError(f"Unknown insights cache backend '{backend_name}', expected 'memory' or 'disk'")
+    return InsightsCache(backend, config['INSIGHTS_CACHE_TTL'], config['INSIGHTS_CACHE_STALE_TTL'])
@@ -0,0 +1,253 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class AbstractCacheBackend(ABC):
+    """Key value store for serialized parse results"""
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: str):
+        pass
+
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+
+class MemoryCacheBackend(AbstractCacheBackend):
+    """In-process LRU cache with size and TTL eviction"""
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        if max_size <= 0:
+            raise ValueError("max_size must be greater than 0")
+        self.max_size = max_size
+        # None or 0 = entries never expire
+        self.ttl = ttl or None
+        # key -> (expires_at, value), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            # Evict least recently used entries
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class DiskCacheBackend(AbstractCacheBackend):
+    """One json file per key on disk, entries survive service restarts
+
+    Writes sweep the directory every sweep_interval seconds, or sooner once max_size may be exceeded: expired
+    entries are removed, then the oldest written ones until a tenth of max_size is free again.
+    """
+    def __init__(self, directory: str, ttl: Optional[float] = None, max_size: int = 0, sweep_interval: float = 60):
+        self.directory = directory
+        # None or 0 = entries never expire
+        self.ttl = ttl or None
+        # 0 = no bound on the number of entries
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        # Entries left by the last sweep and writes since, the first write sweeps what previous runs left
+        self._swept_size = 0
+        self._writes = 0
+        self._last_sweep = None
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        # Shard by key prefix to keep directories small
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        # Wall clock time is used because entries outlive the process
+        if entry['expires_at'] is not None and entry['expires_at'] <= time.time():
+            self.delete(key)
+            return None
+
+        return entry['value']
+
+    def set(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {
+            'expires_at': time.time() + self.ttl if self.ttl else None,
+            'value': value,
+        }
+        # Write to a temp file then rename, so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._maybe_sweep()
+
+    def _maybe_sweep(self):
+        with self._lock:
+            self._writes += 1
+            now = time.monotonic()
+            due = self._last_sweep is None or now - self._last_sweep >= self.sweep_interval
+            full = self.max_size and self._swept_size + self._writes > self.max_size
+            if not (due or full):
+                return
+            self._swept_size = self.sweep()
+            self._writes = 0
+            self._last_sweep = now
+
+    def sweep(self) -> int:
+        """Remove expired entries and the oldest ones past max_size, returns the number of entries left"""
+        entries = []
+        now = time.time()
+        for path in self._iter_entry_paths():
+            try:
+                # Entries are only written by set, so the file time is when the entry's TTL started
+                written_at = os.stat(path).st_mtime
+                if self.ttl and written_at + self.ttl <= now:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                # Removed by another process sharing the directory
+                continue
+            entries.append((written_at, path))
+
+        if self.max_size and len(entries) > self.max_size:
+            # Leave some room, so the next writes do not sweep again right away
+            keep = self.max_size - self.max_size // 10
+            entries.sort()
+            for _, path in entries[:len(entries) - keep]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            entries = entries[len(entries) - keep:]
+        return len(entries)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for path in self._iter_entry_paths():
+            os.remove(path)
+
+    def __len__(self):
+        return sum(1 for _ in self._iter_entry_paths())
+
+    def _iter_entry_paths(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.json'):
+                    yield os.path.join(root, name)
+
+
+class ParseCache:
+    """Content addressed cache of parsed receipts, skips the LLM call for files that were already parsed"""
+    def __init__(self, backend: AbstractCacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def hash_content(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def make_key(content_hash: str, model_name: str, prompt_version) -> str:
+        # A different model or prompt can give a different result for the same file
+        return hashlib.sha256(f"{content_hash}:{model_name}:{prompt_version}".encode('utf-8')).hexdigest()
+
+    def lookup(self, content_hash: str, candidates: Iterable[Tuple[str, object]]) -> Optional[str]:
+        """Return the first cached receipt json for the (model_name, prompt_version) candidates, in order"""
+        for model_name, prompt_version in candidates:
+            receipt_json = self.backend.get(self.make_key(content_hash, model_name, prompt_version))
+            if receipt_json is not None:
+                with self._lock:
+                    self.hits += 1
+                return receipt_json
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def store(self, content_hash: str, model_name: str, prompt_version, receipt_json: str):
+        self.backend.set(self.make_key(content_hash, model_name, prompt_version), receipt_json)
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'size': len(self.backend),
+        }
+
+
+def create_parse_cache(config) -> ParseCache:
+    backend_name = config['PARSE_CACHE_BACKEND'].lower()
+    if backend_name == 'memory':
+        backend = MemoryCacheBackend(max_size=config['PARSE_CACHE_MAX_SIZE'], ttl=config['PARSE_CACHE_TTL'])
+    elif backend_name == 'disk':
+        backend = DiskCacheBackend(directory=config['PARSE_CACHE_DIR'], ttl=config['PARSE_CACHE_TTL'],
+                                   max_size=config['PARSE_CACHE_MAX_SIZE'])
+    else:
+        raise ValueError(f"Unknown parse cache backend '{backend_name}', expected 'memory' or 'disk'")
+    return ParseCache(backend)
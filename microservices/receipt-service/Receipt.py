@@ -1,3 +1,4 @@
+from datetime import datetime
 from enum import Enum
 from typing import List
 from dateutil import parser, utils
@@ -5,8 +6,21 @@ from dateutil.parser import ParserError
 from price_parser import Price
 from dateutil.tz import gettz
 import json
+import re
 from Exceptions import ReceiptError
 
+try:
+    import orjson
+except ImportError:
+    # Optional, to_json falls back to the standard library encoder
+    orjson = None
+
+ISO_DATE = re.compile(r'^\s*\d{4}[-/.]\d{1,2}[-/.]\d{1,2}')
+# Formats the parsers are asked for, strptime is much faster than the dateutil parser and gives the same datetime
+FAST_DATE_FORMATS = ('%d/%m/%Y', '%Y-%m-%d')
+# gettz builds a new tzinfo lookup on every call, parse_date runs for every receipt
+SGT = gettz("Asia/Singapore")
+
 
 class Category(Enum):
     TRANSPORT = 'Transport'
@@ -30,6 +44,8 @@ class Category(Enum):
 
 
 class Item:
+    __slots__ = ('item_name', 'item_cost', 'item_quantity')
+
     def __init__(self, item_name: str, item_cost: str, item_quantity: int):
         self.item_name = item_name
         self.item_cost = item_cost
@@ -47,6 +63,10 @@ class Item:
 
 
 class Receipt:
+    # Parsed fields, checked by validate_non_empty, then their formatted values, computed once on construction
+    VALIDATED_FIELDS = ('merchant_name', '_date', '_total_cost', '_category', '_itemized_list')
+    __slots__ = VALIDATED_FIELDS + ('_date_str', '_total_cost_str', '_items')
+
     def __init__(self, merchant_name: str, date: str, total_cost: str, category: Category, itemized_list: List[Item]):
         self.merchant_name = merchant_name
         self._date = self.parse_date(date)
@@ -57,38 +77,55 @@ class Receipt:
         # Additional validation
         self.validate_non_empty()
 
+        self._date_str = self._date.strftime("%d/%m/%Y")
+        self._total_cost_str = str(self._total_cost.amount)
+        self._items = [Item(item['item_name'], str(item['item_cost'].amount), item.get('item_quantity', 1))
+                       for item in self._itemized_list]
+
     def to_dict(self):
         return {
             "merchant_name": self.merchant_name,
-            "date": self.date,
-            "total_cost": self.total_cost,
-            "category": self.category,
-            "itemized_list": [item.to_dict() for item in self.itemized_list]
+            "date": self._date_str,
+            "total_cost": self._total_cost_str,
+            "category": self._category.name,
+            "itemized_list": [item.to_dict() for item in self._items]
         }
 
+    def to_json(self) -> bytes:
+        """UTF-8 json of to_dict, with orjson when it is installed"""
+        return dumps_receipts(self)
+
     @property
     def date(self) -> str:
-        return self._date.strftime("%d/%m/%Y")
+        return self._date_str
 
     @property
     def category(self) -> str:
-        return str(self._category.name)
+        return self._category.name
 
     @property
     def total_cost(self) -> str:
-        return str(self._total_cost.amount)
+        return self._total_cost_str
 
     @property
     def itemized_list(self) -> List[Item]:
-        return [Item(item['item_name'], str(item['item_cost'].amount), item.get('item_quantity', 1)) for item in self._itemized_list]
-#
+        # Copy of the list, the Item objects are shared
+        return list(self._items)
+
     @staticmethod
     def parse_date(date_string: str):
         if date_string == "None":
             # Date cannot be found in the receipt, use today's date
-            return utils.today(tzinfo=gettz("Asia/Singapore")).date()
+            return utils.today(tzinfo=SGT).date()
+        for date_format in FAST_DATE_FORMATS:
+            try:
+                return datetime.strptime(date_string, date_format)
+            except ValueError:
+                pass
         try:
-            return parser.parse(date_string, dayfirst=True, tzinfos={"SGT": gettz("Asia/Singapore")})
+            # dayfirst would swap the month and day of ISO dates, e.g. 2024-01-02
+            dayfirst = ISO_DATE.match(date_string) is None
+            return parser.parse(date_string, dayfirst=dayfirst, tzinfos={"SGT": SGT})
         except ParserError:
             raise ReceiptError("date", f"Invalid date format: '{date_string}'. If possible, provide a valid date in the format: 'YYYY-MM-DD'")
 
@@ -105,12 +142,18 @@ class Receipt:
     def parse_itemized_list(itemized_list: List[Item]):
         # Loop each item and parse the cost
         for item_dict in itemized_list:
-            item_dict['item_cost'] = Receipt.parse_total_cost(item_dict['item_cost'])
+            price_obj = Price.fromstring(item_dict['item_cost'])
+            if price_obj.amount is None:
+                # Reported on itemized_list, so a correction turn fixes the item instead of the total
+                raise ReceiptError("itemized_list", f"Invalid item cost '{item_dict['item_cost']}' for item "
+                                                    f"'{item_dict.get('item_name')}'. Please provide a valid number")
+            item_dict['item_cost'] = price_obj
 
         return itemized_list
 
     def validate_non_empty(self):
-        for attr, value in self.__dict__.items():
+        for attr in self.VALIDATED_FIELDS:
+            value = getattr(self, attr)
             if isinstance(value, str):
                 temp = value.strip()
             if isinstance(value, list):
@@ -128,13 +171,25 @@ class Receipt:
                 f"category={self.category}, itemized_list={self.itemized_list})")
 
 
+def _to_json_type(obj):
+    # Call to_dict for custom types
+    if isinstance(obj, (Receipt, Item)):
+        return obj.to_dict()
+    elif isinstance(obj, Enum):
+        return obj.value
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
 class ReceiptEncoder(json.JSONEncoder):
     def default(self, obj):
-        # Call to_dict for custom types
-        if isinstance(obj, Receipt):
-            return obj.to_dict()
-        elif isinstance(obj, Item):
-            return obj.to_dict()
-        elif isinstance(obj, Enum):
-            return obj.value
-        return super().default(obj)
\ No newline at end of file
+        try:
+            return _to_json_type(obj)
+        except TypeError:
+            return super().default(obj)
+
+
+def dumps_receipts(obj) -> bytes:
+    """UTF-8 json of a Receipt, or a list of them, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_to_json_type)
+    return json.dumps(obj, cls=ReceiptEncoder).encode('utf-8')
@@ -1,14 +1,17 @@
 from abc import ABC, abstractmethod
+import json
+from Receipt import ReceiptError, Category
+from repair import build_receipt
+from conversation import run_conversation, run_conversation_async, CorrectionTurn, TokenBudget
+from cassette import recorded, recorded_async
+from Config import Config
+from metrics import PARSE_ATTEMPTS
+from tokens import static_token_count
+from ocr import OcrPage
 
-class AbstractParser(ABC):
-    def __init__(self, api_key: str, receipt_schema, model_name: str, max_retry: int = 4, buffer: int = 2048):
-        self.api_key = api_key
-        # Default = 4, 3 retries + 1 initial
-        self.max_retry = max_retry
-        self.buffer = buffer
-        self.receipt_schema = receipt_schema
-        self.model_name = model_name
-        self.initial_prompt = """Given an image of a receipt, extract information from the receipt. If the image is not a receipt, please return Invalid category and ignore all other fields.
+# Static prompts, built once per process. They are sent first in every request, so the prefix stays
+# byte identical across requests and provider prefix caching can apply.
+INITIAL_PROMPT = """Given an image of a receipt, extract information from the receipt. If the image is not a receipt, please return Invalid category and ignore all other fields.
 If the values are not present, please return 'None' for them.
 
 merchant_name: The name of the merchant
@@ -20,13 +23,173 @@ itemized_list: A list of line items, each containing:
     item_cost: The cost of the item
     item_quantity: The quantity of the item
 """.strip()
-        self.system_instruction = """You are an AI language model tasked with extracting key information from a receipt.
+SYSTEM_INSTRUCTION = """You are an AI language model tasked with extracting key information from a receipt.
 If the image given is not a receipt, please return Invalid category and ignore all other fields. If the values are not present, please return 'None' for them.""".strip()
+# Retries are text only, so they can fix the format of a value but cannot read the receipt again
+CORRECTION_PROMPT = """The JSON below was extracted from a receipt, but the field '{field_name}' is invalid: {error}
+Return a JSON object with only the corrected '{field_name}' field, keep the original meaning of the value. If the value cannot be corrected, return 'None' for it.
+
+{receipt_json}""".strip()
+# Sent instead of the image for pages the local OCR pre-pass read confidently, see ocr.py
+OCR_TEXT_PROMPT = """Text of the receipt, read by OCR with the layout of its rows kept. It may contain recognition errors, correct them from the context and the image if one is given.
+
+{text}""".strip()
+
+
+class AbstractParser(ABC):
+    # Bump whenever the prompts above change, cached parses from older prompts are then ignored
+    prompt_version = 1
+    # Model used when no model_version is given, overridden by each provider
+    default_model_version = None
+    # Metric labels, provider is set by each provider mixin
+    provider = None
+    task_name = 'parser'
+    # Shared by every instance, subclasses may override them
+    initial_prompt = INITIAL_PROMPT
+    system_instruction = SYSTEM_INSTRUCTION
+    correction_prompt = CORRECTION_PROMPT
+    ocr_text_prompt = OCR_TEXT_PROMPT
+    # ImagePreprocessor of the provider, estimates the image tokens of the first turn
+    preprocessor = None
+
+    def __init__(self, api_key: str, receipt_schema, model_name: str, max_retry: int = 4, buffer: int = 2048,
+                 retry_token_budget: int = Config.PARSE_RETRY_TOKEN_BUDGET):
+        self.api_key = api_key
+        # Default = 4, 3 retries + 1 initial
+        self.max_retry = max_retry
+        self.buffer = buffer
+        self.receipt_schema = receipt_schema
+        self.model_name = model_name
+        # Set by the caller to stop retrying, e.g. when another provider won a race
+        self.cancel_event = None
+        # Tokens all correction turns of a parse may spend together
+        self.retry_token_budget = retry_token_budget
 
-    @abstractmethod
     def parse(self, receipt_obj_list):
+        return run_conversation(self.parse_steps(receipt_obj_list), recorded(self, self.send_message),
+                                self.cancel_event)
+
+    async def parse_async(self, receipt_obj_list):
+        return await run_conversation_async(self.parse_steps(receipt_obj_list),
+                                            recorded_async(self, self.send_message_async))
+
+    def parse_steps(self, receipt_obj_list):
+        """Retry loop shared by all providers, yields messages to send and receives (response_text, total_tokens)
+
+        Only the first turn carries the images. A failed field is corrected with a standalone text only turn that
+        holds the previous JSON and the error, and asks for just the corrected field. Retries stop once the next
+        correction would not fit in the retry token budget.
+        """
+        # Checked locally before the images are encoded and sent, e.g. a long PDF with every page in one prompt
+        initial_tokens = self.estimate_initial_tokens(receipt_obj_list)
+        if initial_tokens + self.buffer > self.get_input_token_limit():
+            print(f"Receipt needs ~{initial_tokens} tokens, over the input limit of {self.model_name}. "
+                  f"Unable to parse receipt.")
+            PARSE_ATTEMPTS.labels(str(self.provider), 'too_large').observe(0)
+            return None
+
+        message = self.build_initial_message(receipt_obj_list)
+        budget = TokenBudget(self.retry_token_budget)
+        receipt_dict = None
+
+        for attempt_num in range(self.max_retry):
+            response_text, total_tokens = yield message
+            if attempt_num > 0:
+                budget.spend(total_tokens)
+
+            # Attempt to parse the receipt
+            response_dict = json.loads(response_text)
+            # Corrections only return the fixed fields, apply them to the previous response
+            receipt_dict = response_dict if receipt_dict is None else {**receipt_dict, **response_dict}
+
+            # If model returns invalid category, return None
+            if receipt_dict['category'] == Category.INVALID.value:
+                print("Image is not a receipt.")
+                PARSE_ATTEMPTS.labels(str(self.provider), 'invalid').observe(attempt_num + 1)
+                return None
+
+            # Fields that only need a format fix are repaired locally, the rest go back to the model
+            receipt_instance, receipt_dict, e = build_receipt(receipt_dict)
+            if receipt_instance is not None:
+                print(f"Attempt {attempt_num + 1} Success")
+                PARSE_ATTEMPTS.labels(str(self.provider), 'success').observe(attempt_num + 1)
+                return receipt_instance
+
+            print(f"Attempt {attempt_num + 1} Error: {e}")
+            correction_prompt = self.build_correction_prompt(receipt_dict, e)
+            correction_tokens = self.get_token_count(correction_prompt)
+
+            # If max retry reached or the correction does not fit the budget, return None
+            if attempt_num + 1 == self.max_retry or not budget.can_afford(correction_tokens + self.buffer):
+                print(f"Max retry reached, {budget.spent} retry tokens spent. Unable to parse receipt.")
+                PARSE_ATTEMPTS.labels(str(self.provider), 'failed').observe(attempt_num + 1)
+                return None
+
+            message = CorrectionTurn(correction_prompt)
+
+        return None
+
+    def estimate_initial_tokens(self, receipt_obj_list) -> int:
+        """Prompt tokens of the first turn, counted locally"""
+        receipt_tokens = 0
+        for receipt_obj in receipt_obj_list:
+            if isinstance(receipt_obj, OcrPage):
+                receipt_tokens += self.get_token_count(self.ocr_text_prompt.format(text=receipt_obj.text))
+                receipt_obj = receipt_obj.thumbnail
+            if receipt_obj is not None and self.preprocessor is not None:
+                receipt_tokens += self.preprocessor.estimate_image_tokens(receipt_obj)
+        return (self.get_static_token_count(self.system_instruction) +
+                self.get_static_token_count(self.initial_prompt) + receipt_tokens)
+
+    def build_receipt_parts(self, receipt_obj_list) -> list:
+        """Message parts of the receipt pages, the OCR text of pages read locally and the image of the others"""
+        parts = []
+        for receipt_obj in receipt_obj_list:
+            if isinstance(receipt_obj, OcrPage):
+                parts.append(self.build_text_part(self.ocr_text_prompt.format(text=receipt_obj.text)))
+                if receipt_obj.thumbnail is not None:
+                    parts.append(self.build_image_part(receipt_obj.thumbnail, thumbnail=True))
+            else:
+                parts.append(self.build_image_part(receipt_obj))
+        return parts
+
+    def get_static_token_count(self, prompt: str) -> int:
+        # The prompts only change with prompt_version, so they are counted once per process
+        return static_token_count((type(self).__name__, self.model_name), prompt, self.get_token_count)
+
+    def build_correction_prompt(self, receipt_dict: dict, error: ReceiptError) -> str:
+        # Private attributes are reported by validate_non_empty, e.g. _date
+        field_name = error.field_name.lstrip('_')
+        return self.correction_prompt.format(field_name=field_name, error=error.error_msg,
+                                             receipt_json=json.dumps(receipt_dict))
+
+    @abstractmethod
+    def build_initial_message(self, receipt_obj_list):
+        pass
+
+    @abstractmethod
+    def build_text_part(self, text: str):
+        """Part of a text, used by build_receipt_parts"""
+        pass
+
+    @abstractmethod
+    def build_image_part(self, img, thumbnail: bool = False):
+        """Part of a receipt image, a thumbnail is the small image sent along with OCR text"""
+        pass
+
+    @abstractmethod
+    def send_message(self, message):
+        """Send a user turn or a standalone CorrectionTurn, returns (response_text, total_tokens)"""
+        pass
+
+    @abstractmethod
+    async def send_message_async(self, message):
+        pass
+
+    @abstractmethod
+    def get_input_token_limit(self) -> int:
         pass
 
     @abstractmethod
     def get_token_count(self, prompt):
-        pass
\ No newline at end of file
+        pass
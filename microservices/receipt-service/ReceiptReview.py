@@ -1,14 +1,12 @@
 from abc import ABC, abstractmethod
+import json
+from conversation import run_conversation, run_conversation_async
+from cassette import recorded, recorded_async, recorded_stream, recorded_stream_async
+from tokens import static_token_count
 
-class AbstractReview(ABC):
-    def __init__(self, api_key: str, review_schema, model_name: str, max_retry: int = 4, buffer: int = 2048):
-        self.api_key = api_key
-        # Default = 4, 3 retries + 1 initial
-        self.max_retry = max_retry
-        self.buffer = buffer
-        self.review_schema = review_schema
-        self.model_name = model_name
-        self.initial_prompt = """Given the spending data of a user, generate useful insights to help the user understand their spending pattern and reduce their spendings.
+# Static prompts, built once per process. They are sent first in every request, so the prefix stays
+# byte identical across requests and provider prefix caching can apply.
+INITIAL_PROMPT = """Given the spending data of a user, generate useful insights to help the user understand their spending pattern and reduce their spendings.
 
 The receipts data are formatted as:
     merchant_name: The name of the merchant
@@ -27,11 +25,138 @@ The insights response must be formatted as:
 Please always give some insights, even if the data is not enough to generate a meaningful insight. General insights are also acceptable.
 Please do not mention about lack of spending data, General insights are also acceptable.
 """.strip()
-        self.system_instruction = """You are an AI language model tasked with generating insights given the spending data of the user.
+SYSTEM_INSTRUCTION = """You are an AI language model tasked with generating insights given the spending data of the user.
 Please always give some insights, even if the data is not enough to generate a meaningful insight. General insights are also acceptable.
 Please do not mention about lack of spending data, General insights are also acceptable.""".strip()
-        self.error_response = """Missing insight in response. Please always give some insights, even if the data is not enough to generate a meaningful insight. General insights are also acceptable.""".strip()
+ERROR_RESPONSE = """Missing insight in response. Please always give some insights, even if the data is not enough to generate a meaningful insight. General insights are also acceptable.""".strip()
+
+
+class AbstractReview(ABC):
+    # Bump whenever the prompts above change, cached insights from older prompts are then ignored
+    prompt_version = 1
+    # Metric labels, provider is set by each provider mixin
+    provider = None
+    task_name = 'reviewer'
+    # Shared by every instance, subclasses may override them
+    initial_prompt = INITIAL_PROMPT
+    system_instruction = SYSTEM_INSTRUCTION
+    error_response = ERROR_RESPONSE
+
+    def __init__(self, api_key: str, review_schema, model_name: str, max_retry: int = 4, buffer: int = 2048):
+        self.api_key = api_key
+        # Default = 4, 3 retries + 1 initial
+        self.max_retry = max_retry
+        self.buffer = buffer
+        self.review_schema = review_schema
+        self.model_name = model_name
+        # Set by the caller to stop retrying, e.g. when another provider won a race
+        self.cancel_event = None
 
-    @abstractmethod
     def review(self, receipt_str, query):
-        pass
\ No newline at end of file
+        return run_conversation(self.review_steps(receipt_str, query), recorded(self, self.send_message),
+                                self.cancel_event)
+
+    async def review_async(self, receipt_str, query):
+        return await run_conversation_async(self.review_steps(receipt_str, query),
+                                            recorded_async(self, self.send_message_async))
+
+    def review_steps(self, receipt_str, query):
+        """Retry loop shared by all providers, yields messages to send and receives (response_text, total_tokens)"""
+        if not self.fits_input_limit(receipt_str, query):
+            return None
+
+        message = self.build_initial_message(receipt_str, query)
+
+        for attempt_num in range(self.max_retry):
+            response_text, total_tokens = yield message
+
+            # Parse json response
+            review_dict = json.loads(response_text)
+
+            # If model unable to generate review
+            if not review_dict['status']:
+                print(f"Attempt {attempt_num + 1} Error: status is False")
+                if (attempt_num + 1 == self.max_retry or
+                        total_tokens + self.get_static_token_count(self.error_response) + self.buffer >
+                        self.get_input_token_limit()):
+                    print("Max retry reached. Unable to generate insights.")
+                    return None
+
+                # Still have retries left, retry
+                message = self.build_retry_message(self.error_response)
+            else:
+                print(f"Attempt {attempt_num + 1} Success")
+                return review_dict['insights']
+
+        return None
+
+    def review_stream(self, receipt_str, query, stream):
+        """Yield the insight text while the provider streams its response, stream is an InsightStream
+
+        Streams are not retried, the caller validates stream.result() and falls back to another reviewer.
+        """
+        if not self.fits_input_limit(receipt_str, query):
+            return
+        for chunk in recorded_stream(self, self.stream_message)(self.build_initial_message(receipt_str, query)):
+            text = stream.feed(chunk)
+            if text:
+                yield text
+
+    async def review_stream_async(self, receipt_str, query, stream):
+        if not self.fits_input_limit(receipt_str, query):
+            return
+        stream_message_async = recorded_stream_async(self, self.stream_message_async)
+        async for chunk in stream_message_async(self.build_initial_message(receipt_str, query)):
+            text = stream.feed(chunk)
+            if text:
+                yield text
+
+    def fits_input_limit(self, receipt_str, query) -> bool:
+        # Checked locally before anything is sent, the spending data of a user can be long
+        initial_tokens = (self.get_static_token_count(self.system_instruction) +
+                          self.get_static_token_count(self.initial_prompt) +
+                          self.get_token_count(receipt_str) + self.get_token_count(query))
+        if initial_tokens + self.buffer > self.get_input_token_limit():
+            print(f"Spending data needs ~{initial_tokens} tokens, over the input limit of {self.model_name}. "
+                  f"Unable to generate insights.")
+            return False
+        return True
+
+    def get_static_token_count(self, prompt: str) -> int:
+        # The prompts are the same for every request, so they are counted once per process
+        return static_token_count((type(self).__name__, self.model_name), prompt, self.get_token_count)
+
+    @abstractmethod
+    def build_initial_message(self, receipt_str, query):
+        pass
+
+    @abstractmethod
+    def build_retry_message(self, error_msg: str):
+        pass
+
+    @abstractmethod
+    def send_message(self, message):
+        """Send a user turn, returns (response_text, total_tokens)"""
+        pass
+
+    @abstractmethod
+    async def send_message_async(self, message):
+        pass
+
+    @abstractmethod
+    def stream_message(self, message):
+        """Send a user turn, yields the response text as it arrives"""
+        pass
+
+    @abstractmethod
+    def stream_message_async(self, message):
+        """Async generator version of stream_message"""
+        pass
+
+    @abstractmethod
+    def get_input_token_limit(self) -> int:
+        pass
+
+    @abstractmethod
+    def get_token_count(self, prompt):
+        pass
@@ -0,0 +1,154 @@
+from collections import Counter
+from typing import Optional
+import copy
+import hashlib
+import json
+import threading
+import time
+from ParseCache import AbstractCacheBackend, MemoryCacheBackend, DiskCacheBackend
+from InsightsCache import receipt_fingerprint
+from summary import (new_totals, add_receipts, compact_totals, finish_summary, format_summary, find_new_anomalies,
+                     format_review_data)
+
+# Incremental /review
+# A client that sends "incremental": true gets a rolling summary kept for it between requests: the running totals
+# of the receipts seen so far, their fingerprints and the last insights. The next request only sends the receipts
+# added since then to the reviewer, with the previous insights and totals as context, so the prompt grows with the
+# new activity instead of the whole history. The client still sends its full receipt list, it is diffed against
+# the fingerprints; if a receipt was edited or removed the totals are rebuilt with a full review.
+
+PLAN_FULL = 'full'
+PLAN_DELTA = 'delta'
+PLAN_UNCHANGED = 'unchanged'
+
+DELTA_TEMPLATE = """Insights previously given for the receipts before:
+{insights}
+
+Spending summary of the receipts before:
+{summary}
+
+New receipts since then, update the insights with them:
+{new_receipts}"""
+
+
+def get_user_key(data: dict) -> str:
+    """Owner of a rolling summary, the userId of the request, else a hash of its API keys"""
+    user_id = data.get('userId')
+    if user_id:
+        return f"user:{user_id}"
+    api_keys = data.get('apiKeys', {})
+    digest = hashlib.sha256(f"{api_keys.get('geminiKey')}:{api_keys.get('openaiKey')}".encode('utf-8'))
+    return f"keys:{digest.hexdigest()}"
+
+
+class ReviewPlan:
+    """What to send to the reviewer for one incremental request, and the state to store once it succeeds"""
+    def __init__(self, key: str, mode: str, receipt_str: Optional[str], totals: dict, fingerprints: Counter,
+                 insights: Optional[str] = None, new_receipts: int = 0):
+        self.key = key
+        self.mode = mode
+        self.receipt_str = receipt_str
+        self.totals = totals
+        self.fingerprints = fingerprints
+        # Insights of the previous summary, returned as is when nothing changed
+        self.insights = insights
+        self.new_receipts = new_receipts
+
+
+class RollingSummaryStore:
+    """Rolling summaries per user and query"""
+    def __init__(self, backend: AbstractCacheBackend, max_raw_receipts: int = 20, sample_size: int = 5):
+        self.backend = backend
+        self.max_raw_receipts = max_raw_receipts
+        self.sample_size = sample_size
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(user_key: str, query: str, prompt_version) -> str:
+        # Insights answer the query, so each query has its own summary
+        query = ' '.join((query or '').split()).lower()
+        return hashlib.sha256(f"{user_key}:{query}:{prompt_version}".encode('utf-8')).hexdigest()
+
+    def load(self, key: str) -> Optional[dict]:
+        value = self.backend.get(key)
+        return json.loads(value) if value is not None else None
+
+    def plan(self, key: str, receipts) -> ReviewPlan:
+        state = self.load(key)
+        fingerprints = Counter(receipt_fingerprint(receipt) for receipt in receipts)
+        previous = Counter(state['fingerprints']) if state is not None else None
+
+        if previous is None or previous - fingerprints:
+            # First request, or receipts were edited or removed: the totals cannot be updated, rebuild them
+            totals = new_totals()
+            add_receipts(totals, receipts)
+            receipt_str = format_review_data(receipts, self.max_raw_receipts, self.sample_size)
+            plan = ReviewPlan(key, PLAN_FULL, receipt_str, totals, fingerprints, new_receipts=len(receipts))
+        else:
+            added = fingerprints - previous
+            if not added:
+                plan = ReviewPlan(key, PLAN_UNCHANGED, None, state['totals'], fingerprints, state['insights'])
+            else:
+                new_receipts = []
+                for receipt in receipts:
+                    fingerprint = receipt_fingerprint(receipt)
+                    if added[fingerprint]:
+                        added[fingerprint] -= 1
+                        new_receipts.append(receipt)
+                receipt_str = DELTA_TEMPLATE.format(
+                    insights=state['insights'],
+                    summary=format_summary(finish_summary(state['totals'])),
+                    new_receipts=format_review_data(new_receipts, self.max_raw_receipts, self.sample_size))
+                totals = copy.deepcopy(state['totals'])
+                dated = add_receipts(totals, new_receipts)
+                # Compared with the history before them, a burst of large receipts would otherwise raise the
+                # average it is measured against
+                anomalies = find_new_anomalies(state['totals'], dated)
+                if anomalies:
+                    receipt_str += "\n\nUnusual new receipts:\n" + "\n".join(
+                        f"  - {date.isoformat()} {merchant} ${amount:,.2f} ({category}), "
+                        f"{ratio:.1f}x the average {category} receipt"
+                        for ratio, date, merchant, category, amount in anomalies)
+                plan = ReviewPlan(key, PLAN_DELTA, receipt_str, totals, fingerprints, state['insights'],
+                                  len(new_receipts))
+
+        with self._lock:
+            self.counts[plan.mode] += 1
+            self.counts['new_receipts'] += plan.new_receipts
+        return plan
+
+    def commit(self, plan: ReviewPlan, insights: str):
+        """Store the summary of a plan once the reviewer gave its insights"""
+        if plan.mode == PLAN_UNCHANGED:
+            return
+        state = {
+            'fingerprints': dict(plan.fingerprints),
+            'totals': compact_totals(plan.totals),
+            'insights': insights,
+            'updated_at': time.time(),
+        }
+        self.backend.set(plan.key, json.dumps(state))
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        return {
+            'full': counts.get(PLAN_FULL, 0),
+            'delta': counts.get(PLAN_DELTA, 0),
+            'unchanged': counts.get(PLAN_UNCHANGED, 0),
+            'new_receipts': counts.get('new_receipts', 0),
+            'size': len(self.backend),
+        }
+
+
+def create_rolling_summary_store(config) -> RollingSummaryStore:
+    backend_name = config['ROLLING_SUMMARY_BACKEND'].lower()
+    if backend_name == 'memory':
+        backend = MemoryCacheBackend(max_size=config['ROLLING_SUMMARY_MAX_SIZE'], ttl=config['ROLLING_SUMMARY_TTL'])
+    elif backend_name == 'disk':
+        backend = DiskCacheBackend(directory=config['ROLLING_SUMMARY_DIR'], ttl=config['ROLLING_SUMMARY_TTL'],
+                                   max_size=config['ROLLING_SUMMARY_MAX_SIZE'])
+    else:
+        raise ValueError(f"Unknown rolling summary backend '{backend_name}', expected 'memory' or 'disk'")
+    return RollingSummaryStore(backend, config['REVIEW_MAX_RAW_RECEIPTS'], config['REVIEW_SAMPLE_RECEIPTS'])
@@ -0,0 +1,402 @@
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+import difflib
+import hashlib
+import json
+import re
+import threading
+import time
+from ParseCache import AbstractCacheBackend, MemoryCacheBackend, DiskCacheBackend
+from Receipt import Receipt, Category
+from repair import build_receipt, repair_date
+from pipeline import FallbackOutcome
+from ocr import OcrPage
+from metrics import TEMPLATE_LOOKUPS, TEMPLATES_LEARNED
+from RollingSummary import get_user_key
+
+# Template parser for known merchants
+# Most receipts come from a few recurring merchants with fixed layouts. Once a merchant's receipt is parsed by a
+# model from OCR text (see ocr.py), a template is learned from that text: the header line that names the merchant,
+# the label of the total, the shape of the date, which amount lines are not items, and how quantities and item
+# costs are laid out. A template is only kept if it extracts the same receipt from the same text again.
+# Later receipts whose header matches a template are extracted locally and validated with the Receipt rules and
+# the learned sum of the items; any mismatch goes to the model as before, and its parse re-learns the template.
+# Templates are kept per user (userId, else API keys, like the duplicate index), so text crafted by one user to
+# teach a wrong template under a merchant's header never decides the receipts of another.
+
+TEMPLATE_VERSION = 1
+# Lines at the top of a receipt searched for the merchant header
+HEADER_LINES = 8
+AMOUNT = re.compile(r'(?<![\d/.:,-])\d{1,7}[.,]\d{2}(?![\d/:])')
+DATE_TOKEN = re.compile(r'\b\d{1,4}[/.-]\d{1,2}[/.-]\d{2,4}\b')
+LEADING_QUANTITY = re.compile(r'^(\d{1,3})\s*[xX]?\s+(?=\D)')
+
+LOOKUP_HIT = 'hit'
+LOOKUP_MISMATCH = 'mismatch'
+LOOKUP_MISS = 'miss'
+
+
+def normalize_line(line: str) -> str:
+    """Lowercase words of a line, punctuation and spacing removed"""
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', line.lower()).split())
+
+
+def line_label(line: str) -> str:
+    """Words of a line without its amounts and numbers, e.g. 'gst' of 'GST 7%  1.82'"""
+    return ' '.join(word for word in normalize_line(AMOUNT.sub(' ', line)).split() if not word.isdigit())
+
+
+def line_amounts(line: str):
+    return [Decimal(amount.replace(',', '.')) for amount in AMOUNT.findall(line)]
+
+
+def date_shape(token: str) -> str:
+    """Regex of tokens shaped like token, e.g. 23/09/2022 -> \\d\\d/\\d\\d/\\d\\d\\d\\d"""
+    return r'\b' + ''.join(r'\d' if char.isdigit() else re.escape(char) for char in token) + r'\b'
+
+
+def to_decimal(value) -> Optional[Decimal]:
+    try:
+        return Decimal(str(value))
+    except InvalidOperation:
+        return None
+
+
+def similar(a: str, b: str) -> float:
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+class MerchantTemplate:
+    """Text anchors of one merchant layout, extracts a receipt dict from OCR lines"""
+    def __init__(self, merchant_name: str, category: str, anchor: str, total_label: str, date_pattern: str,
+                 skip_labels, quantity_position: str, cost_from_end: int, sum_rule: Optional[str],
+                 sum_label: Optional[str], has_items: bool, model_name: str = None, prompt_version=None,
+                 learned_at: float = None):
+        self.merchant_name = merchant_name
+        self.category = category
+        # Normalized header line naming the merchant
+        self.anchor = anchor
+        self.total_label = total_label
+        self.date_pattern = date_pattern
+        # Labels of amount lines between the header and the total that are not items, e.g. subtotal, gst
+        self.skip_labels = set(skip_labels)
+        # 'leading' (2 Coke 3.00), 'before_cost' (Coke 2 3.00) or 'none'
+        self.quantity_position = quantity_position
+        # Which amount of an item line is its cost, 0 = the last one
+        self.cost_from_end = cost_from_end
+        # How the items add up: 'costs', 'costs_times_quantity', or None if they do not
+        self.sum_rule = sum_rule
+        # Label of the line they add up to, e.g. subtotal when tax is added, None = the total
+        self.sum_label = sum_label
+        self.has_items = has_items
+        # Model whose parse the template was learned from
+        self.model_name = model_name
+        self.prompt_version = prompt_version
+        self.learned_at = learned_at
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'version': TEMPLATE_VERSION, 'merchant_name': self.merchant_name, 'category': self.category,
+            'anchor': self.anchor, 'total_label': self.total_label, 'date_pattern': self.date_pattern,
+            'skip_labels': sorted(self.skip_labels), 'quantity_position': self.quantity_position,
+            'cost_from_end': self.cost_from_end, 'sum_rule': self.sum_rule, 'sum_label': self.sum_label,
+            'has_items': self.has_items,
+            'model_name': self.model_name, 'prompt_version': self.prompt_version, 'learned_at': self.learned_at,
+        })
+
+    @classmethod
+    def from_json(cls, value: str) -> Optional['MerchantTemplate']:
+        data = json.loads(value)
+        if data.pop('version', None) != TEMPLATE_VERSION:
+            return None
+        return cls(**data)
+
+    def find_total(self, lines, start: int):
+        """(index, amount) of the total line after start, or (None, None)"""
+        for index in range(start, len(lines)):
+            amounts = line_amounts(lines[index])
+            if amounts and line_label(lines[index]) == self.total_label:
+                return index, amounts[-1]
+        return None, None
+
+    def parse_item(self, line: str) -> Optional[dict]:
+        amounts = AMOUNT.findall(line)
+        if len(amounts) <= self.cost_from_end:
+            return None
+        cost = amounts[-1 - self.cost_from_end]
+        name = line[:line.find(amounts[0])].strip()
+        quantity = '1'
+        if self.quantity_position == 'leading':
+            match = LEADING_QUANTITY.match(name)
+            if match:
+                quantity = match.group(1)
+                name = name[match.end():]
+        elif self.quantity_position == 'before_cost':
+            words = name.split()
+            if len(words) > 1 and words[-1].isdigit():
+                quantity = words[-1]
+                name = ' '.join(words[:-1])
+        name = name.strip(' .:-')
+        if not name:
+            return None
+        return {'item_name': name, 'item_cost': cost.replace(',', '.'), 'item_quantity': quantity}
+
+    def extract(self, lines, anchor_index: int) -> Optional[dict]:
+        """Receipt dict of the OCR lines whose header is at anchor_index, None if the layout does not match"""
+        total_index, total = self.find_total(lines, anchor_index + 1)
+        if total_index is None:
+            return None
+
+        date = None
+        for line in lines:
+            match = re.search(self.date_pattern, line)
+            if match:
+                date = repair_date(match.group(0))
+                break
+        if date is None:
+            return None
+
+        items = []
+        sum_target = total
+        for line in lines[anchor_index + 1:total_index]:
+            if not AMOUNT.search(line) or DATE_TOKEN.search(line):
+                continue
+            label = line_label(line)
+            if label in self.skip_labels:
+                if self.sum_label is not None and label == self.sum_label:
+                    sum_target = line_amounts(line)[-1]
+                continue
+            item = self.parse_item(line)
+            if item is None:
+                return None
+            items.append(item)
+        if self.has_items and not items:
+            return None
+        # Items must add up as they did on the receipt the template was learned from
+        if self.sum_rule is not None and not sum_rule_holds(self.sum_rule, items, sum_target):
+            return None
+
+        return {'merchant_name': self.merchant_name, 'date': date, 'total_cost': str(total),
+                'category': self.category, 'itemized_list': items}
+
+
+def sum_rule_holds(sum_rule: str, items, total: Decimal) -> bool:
+    costs = [to_decimal(item['item_cost']) for item in items]
+    quantities = [to_decimal(item['item_quantity']) for item in items]
+    if total is None or None in costs or None in quantities:
+        return False
+    if sum_rule == 'costs_times_quantity':
+        items_sum = sum(cost * quantity for cost, quantity in zip(costs, quantities))
+    else:
+        items_sum = sum(costs)
+    return abs(items_sum - total) <= Decimal('0.01')
+
+
+def find_anchor(lines, merchant_name: str) -> Optional[int]:
+    """Index of the header line naming the merchant"""
+    merchant = normalize_line(merchant_name)
+    best, best_ratio = None, 0.6
+    for index, line in enumerate(lines[:HEADER_LINES]):
+        normalized = normalize_line(line)
+        if not normalized:
+            continue
+        ratio = 1.0 if merchant and merchant in normalized else similar(merchant, normalized)
+        if ratio > best_ratio:
+            best, best_ratio = index, ratio
+    return best
+
+
+def learn_template(lines, receipt: Receipt) -> Optional[MerchantTemplate]:
+    """Template reproducing receipt from the OCR lines, None if the lines do not hold its fields"""
+    anchor_index = find_anchor(lines, receipt.merchant_name)
+    if anchor_index is None:
+        return None
+    total = to_decimal(receipt.total_cost)
+
+    # Total line: an amount equal to the total with a label, 'total' preferred over e.g. 'cash' or 'subtotal'
+    total_index = None
+    for index in range(anchor_index + 1, len(lines)):
+        label = line_label(lines[index])
+        if label and total in line_amounts(lines[index]):
+            if total_index is None or ('total' in label.split() and
+                                       'total' not in line_label(lines[total_index]).split()):
+                total_index = index
+    if total_index is None or line_amounts(lines[total_index])[-1] != total:
+        return None
+
+    date_pattern = None
+    for line in lines:
+        for token in DATE_TOKEN.findall(line):
+            if repair_date(token) == receipt.date:
+                date_pattern = date_shape(token)
+                break
+        if date_pattern is not None:
+            break
+    if date_pattern is None:
+        return None
+
+    # Amount lines between the header and the total are items, or labels to skip
+    items = [item.to_dict() for item in receipt.itemized_list]
+    skip_labels = set()
+    item_lines = []
+    for line in lines[anchor_index + 1:total_index]:
+        amounts = line_amounts(line)
+        if not amounts or DATE_TOKEN.search(line):
+            continue
+        costs = [to_decimal(item['item_cost']) for item in items]
+        # A subtotal of a single item receipt equals the item cost, but is never an item
+        if 'total' not in line_label(line) and any(cost in amounts for cost in costs):
+            item_lines.append(line)
+        else:
+            skip_labels.add(line_label(line))
+    if len(item_lines) != len(items):
+        return None
+
+    cost_from_end = 0
+    quantity_position = 'none'
+    for line, item in zip(item_lines, items):
+        amounts = line_amounts(line)
+        cost_from_end = len(amounts) - 1 - amounts.index(to_decimal(item['item_cost']))
+        quantity = str(item['item_quantity']).strip()
+        name = line[:line.find(AMOUNT.findall(line)[0])].split()
+        if quantity not in ('', '1') and name:
+            if name[0].rstrip('xX') == quantity:
+                quantity_position = 'leading'
+            elif name[-1] == quantity:
+                quantity_position = 'before_cost'
+
+    # What the items add up to, the total or e.g. the subtotal of a receipt that adds tax
+    sum_rule, sum_label = None, None
+    targets = [(None, total)] + [(line_label(line), line_amounts(line)[-1])
+                                 for line in lines[anchor_index + 1:total_index]
+                                 if line_amounts(line) and line_label(line) in skip_labels]
+    for label, target in targets:
+        for rule in ('costs', 'costs_times_quantity'):
+            if items and sum_rule is None and sum_rule_holds(rule, items, target):
+                sum_rule, sum_label = rule, label
+
+    return MerchantTemplate(receipt.merchant_name, Category[receipt.category].value,
+                            normalize_line(lines[anchor_index]), line_label(lines[total_index]), date_pattern,
+                            skip_labels, quantity_position, cost_from_end, sum_rule, sum_label, bool(items))
+
+
+def same_receipt(a: Receipt, b: Receipt) -> bool:
+    def key(receipt):
+        return (receipt.merchant_name, receipt.date, receipt.total_cost, receipt.category,
+                [(to_decimal(item.item_cost), str(item.item_quantity).strip() or '1')
+                 for item in receipt.itemized_list])
+    return key(a) == key(b)
+
+
+class TemplateStore:
+    """Learned merchant templates, keyed by their scope and normalized header line"""
+    def __init__(self, backend: AbstractCacheBackend):
+        self.backend = backend
+        self.counts = {LOOKUP_HIT: 0, LOOKUP_MISMATCH: 0, LOOKUP_MISS: 0, 'learned': 0}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(scope: str, anchor: str) -> str:
+        return hashlib.sha256(f"template:{scope}:{anchor}".encode('utf-8')).hexdigest()
+
+    def _count(self, outcome: str):
+        if outcome != 'learned':
+            TEMPLATE_LOOKUPS.labels(outcome).inc()
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def find(self, scope: str, lines):
+        """(template, anchor index) of the first header line with a template of scope, or (None, None)"""
+        for index, line in enumerate(lines[:HEADER_LINES]):
+            normalized = normalize_line(line)
+            if not normalized:
+                continue
+            value = self.backend.get(self.make_key(scope, normalized))
+            if value is not None:
+                template = MerchantTemplate.from_json(value)
+                if template is not None:
+                    return template, index
+        return None, None
+
+    def match(self, scope: str, receipt_obj_list) -> Optional[FallbackOutcome]:
+        """Outcome of a receipt extracted locally, None if the model has to parse it"""
+        # Only single page receipts read by OCR, templates are learned from those
+        if len(receipt_obj_list) != 1 or not isinstance(receipt_obj_list[0], OcrPage):
+            return None
+        lines = receipt_obj_list[0].text.splitlines()
+        template, anchor_index = self.find(scope, lines)
+        if template is None:
+            self._count(LOOKUP_MISS)
+            return None
+
+        receipt_dict = template.extract(lines, anchor_index)
+        receipt = build_receipt(receipt_dict)[0] if receipt_dict is not None else None
+        if receipt is None:
+            print(f"Receipt does not match the template of {template.merchant_name}, parsing it with a model")
+            self._count(LOOKUP_MISMATCH)
+            return None
+
+        print(f"Receipt of {template.merchant_name} extracted with its template")
+        self._count(LOOKUP_HIT)
+        outcome = FallbackOutcome()
+        outcome.response = receipt
+        # Cached in the parse cache as a parse of the model the template was learned from
+        outcome.handler = template
+        return outcome
+
+    def learn(self, scope: str, receipt_obj_list, outcome: FallbackOutcome):
+        """Learn a template of scope from a successful model parse of an OCR page"""
+        if (outcome.response is None or isinstance(outcome.handler, MerchantTemplate) or
+                len(receipt_obj_list) != 1 or not isinstance(receipt_obj_list[0], OcrPage)):
+            return
+        lines = receipt_obj_list[0].text.splitlines()
+        template = learn_template(lines, outcome.response)
+        if template is None:
+            return
+        # Kept only if it gives back the receipt of the model
+        receipt_dict = template.extract(lines, find_anchor(lines, outcome.response.merchant_name))
+        receipt = build_receipt(receipt_dict)[0] if receipt_dict is not None else None
+        if receipt is None or not same_receipt(receipt, outcome.response):
+            return
+        template.model_name = outcome.handler.model_name
+        template.prompt_version = outcome.handler.prompt_version
+        template.learned_at = time.time()
+        self.backend.set(self.make_key(scope, template.anchor), template.to_json())
+        TEMPLATES_LEARNED.inc()
+        self._count('learned')
+        print(f"Learned a template for {template.merchant_name}")
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        lookups = counts[LOOKUP_HIT] + counts[LOOKUP_MISMATCH] + counts[LOOKUP_MISS]
+        return {
+            'lookups': lookups,
+            'hits': counts[LOOKUP_HIT],
+            'mismatches': counts[LOOKUP_MISMATCH],
+            'misses': counts[LOOKUP_MISS],
+            # Share of the OCR pages that skipped the model
+            'hit_rate': counts[LOOKUP_HIT] / lookups if lookups else 0.0,
+            'learned': counts['learned'],
+            'size': len(self.backend),
+        }
+
+
+def get_template_scope(form) -> str:
+    """Scope of the templates of a request, its userId or else its API keys"""
+    return get_user_key({'userId': form.get('userId'),
+                         'apiKeys': {'geminiKey': form.get('geminiKey'), 'openaiKey': form.get('openaiKey')}})
+
+
+def create_template_store(config) -> Optional[TemplateStore]:
+    if not config['TEMPLATES_ENABLED']:
+        return None
+    backend_name = config['TEMPLATE_STORE_BACKEND'].lower()
+    if backend_name == 'memory':
+        backend = MemoryCacheBackend(max_size=config['TEMPLATE_STORE_MAX_SIZE'], ttl=config['TEMPLATE_STORE_TTL'])
+    elif backend_name == 'disk':
+        backend = DiskCacheBackend(directory=config['TEMPLATE_STORE_DIR'], ttl=config['TEMPLATE_STORE_TTL'],
+                                   max_size=config['TEMPLATE_STORE_MAX_SIZE'])
+    else:
+        raise ValueError(f"Unknown template store backend '{backend_name}', expected 'memory' or 'disk'")
+    return TemplateStore(backend)
@@ -0,0 +1,474 @@
+from quart import Quart, request, jsonify, Response, g
+from quart_cors import cors
+from werkzeug.utils import secure_filename
+from Receipt import ReceiptEncoder, dumps_receipts
+from Config import Config
+from ParseCache import create_parse_cache
+from breaker import create_provider_health
+from cassette import configure_cassette, get_cassette
+from InsightsCache import InsightsCache, create_insights_cache
+from RollingSummary import RollingSummaryStore, create_rolling_summary_store, get_user_key, PLAN_UNCHANGED
+from ReceiptReview import AbstractReview
+from race import RaceStats, get_parse_policy, run_race_async
+from pages import get_page_mode, combine_page_outcomes, parse_page_groups_async, max_groups_in_flight
+from preprocess import image_options, preprocess_stats
+from ocr import create_ocr_prepass, ocr_stats
+from TemplateStore import create_template_store, get_template_scope
+from DuplicateIndex import create_duplicate_index, get_duplicate_scope
+from rasterize import raster_options, iter_page_groups_async
+from metrics import record_request, metrics_response, time_stage
+from repair import repair_stats
+from jobs import create_job_queue, get_job_options, job_to_dict, JOB_QUEUED
+from batch import validate_batch, get_batch_format, spool_batch, close_batch, batch_result, summarize_batch
+from concurrent.futures import ProcessPoolExecutor
+from Exceptions import PageLimitError
+from pipeline import (allowed_file, is_pdf, validate_api_keys, validate_upload, get_parsers, get_reviewers,
+                      get_cache_candidates, load_receipt_images, run_with_fallback_async,
+                      SpooledUpload, DEFAULT_INSIGHTS)
+from summary import format_review_data
+from streaming import wants_stream, stream_review_async, sse_event, sse_insights, SSE_HEADERS
+import asyncio
+import json
+import time
+
+# Async version of receiptservice.py with the same routes and json contract
+# Provider calls are awaited, so a single process can hold many in-flight parses
+# Run with: python asyncservice.py (or any ASGI server, e.g. hypercorn "asyncservice:create_async_app()")
+
+def create_async_app(test_config=None):
+    app = Quart(__name__)
+    app.config.from_object(Config)
+    if test_config is not None:
+        app.config.update(test_config)
+    app.json_encoder = ReceiptEncoder
+    app = cors(app, allow_origin="*")
+
+    parse_cache = create_parse_cache(app.config)
+    app.extensions['parse_cache'] = parse_cache
+    insights_cache = create_insights_cache(app.config)
+    app.extensions['insights_cache'] = insights_cache
+    rolling_summaries = create_rolling_summary_store(app.config)
+    app.extensions['rolling_summaries'] = rolling_summaries
+    # Provider calls of the process go through the cassette, if CASSETTE_MODE is set
+    configure_cassette(app.config)
+    race_stats = RaceStats()
+    # None when the circuit breakers are disabled
+    provider_health = create_provider_health(app.config)
+    raster_executor = ProcessPoolExecutor(max_workers=app.config['PDF_RASTER_WORKERS'] or None)
+    # None unless OCR_ENABLED, pages are then read locally first and sent as text when OCR is confident
+    ocr_prepass = create_ocr_prepass(app.config)
+    # Merchant templates learned from OCR pages, None when disabled
+    template_store = create_template_store(app.config)
+    # Perceptual hashes of parsed photos, None when disabled
+    duplicate_index = create_duplicate_index(app.config)
+    job_queue = create_job_queue(app.config)
+    # Bounds the provider calls in flight, requests over the limit wait for a free slot
+    # Created on first use, on python 3.9 a semaphore binds to the loop that exists when it is created
+    semaphores = []
+
+    def concurrency_limit():
+        if not semaphores:
+            semaphores.append(asyncio.Semaphore(app.config['ASYNC_MAX_CONCURRENCY']))
+        return semaphores[0]
+
+    def insights_response(insights, stream, headers):
+        """Response of insights that are already complete"""
+        if stream:
+            return Response(sse_insights(insights), mimetype='text/event-stream', headers={**SSE_HEADERS, **headers}), 200
+        return jsonify(insights), 200, headers
+
+    # Background refreshes of stale cached insights, referenced until done so they are not garbage collected
+    refresh_tasks = set()
+
+    async def refresh_insights(cache_key, reviewers, receipt_str, query):
+        try:
+            async with concurrency_limit():
+                outcome = await run_with_fallback_async(
+                    reviewers, lambda reviewer: reviewer.review_async(receipt_str, query), 'reviewer',
+                    provider_health)
+            if outcome.response is not None:
+                await asyncio.to_thread(insights_cache.store, cache_key, outcome.response)
+        except Exception as e:
+            print(f"Unexpected error occurred refreshing insights: {e}")
+        finally:
+            insights_cache.finish_refresh(cache_key)
+
+    async def parse_upload(filename, upload, parsers, parse_policy, hedge_delay, page_mode, pages_per_group,
+                           duplicate_scope=None, template_scope=None):
+        """Parse a spooled upload, returns (response_json, error_msg, status_code)
+
+        With duplicate_scope, re-uploads of the same file and photos in the near-duplicate index are flagged.
+        With template_scope, OCR pages are matched against and teach the merchant templates of that scope.
+        """
+        paged = page_mode != 'combined' and is_pdf(filename)
+
+        # Return the stored result if this exact file was already parsed by one of the usable models
+        content_hash = upload.content_hash
+        if paged:
+            content_hash = f"{content_hash}:{page_mode}:{pages_per_group}"
+        # The cache and template backends may be on disk, their I/O is kept off the event loop
+        cached_json = await asyncio.to_thread(parse_cache.lookup, content_hash, get_cache_candidates(parsers))
+        if cached_json is not None:
+            if duplicate_index is not None and duplicate_scope is not None:
+                cached_json = duplicate_index.check_cached(duplicate_scope, upload, cached_json)
+            return cached_json, None, 200
+
+        async def parse_images(receipt_obj_list):
+            if ocr_prepass is not None:
+                receipt_obj_list = await ocr_prepass.apply_async(receipt_obj_list)
+            if template_store is not None and template_scope is not None:
+                # Known merchant layouts are extracted from the OCR text without a model
+                outcome = await asyncio.to_thread(template_store.match, template_scope, receipt_obj_list)
+                if outcome is not None:
+                    return outcome
+            async with concurrency_limit():
+                if parse_policy == 'race':
+                    outcome = await run_race_async(parsers, lambda parser: parser.parse_async(receipt_obj_list),
+                                                   'parser', hedge_delay, race_stats, provider_health)
+                else:
+                    outcome = await run_with_fallback_async(
+                        parsers, lambda parser: parser.parse_async(receipt_obj_list), 'parser',
+                        provider_health)
+            if template_store is not None and template_scope is not None:
+                await asyncio.to_thread(template_store.learn, template_scope, receipt_obj_list, outcome)
+            return outcome
+
+        # (phash, dhash) of a photo to index once it is parsed, and the earlier upload it looks like
+        duplicate_hashes = None
+        duplicate_match = None
+        if paged:
+            # Parse each page group as soon as its pages are rendered
+            page_groups = iter_page_groups_async(upload.path, raster_executor, pages_per_group,
+                                                 app.config['PDF_PREFETCH_PAGES'], **raster_options(app.config))
+            try:
+                # The page count is checked before the first page is rendered
+                outcomes = await parse_page_groups_async(
+                    page_groups, parse_images, max_groups_in_flight(app.config['PDF_PREFETCH_PAGES'], pages_per_group))
+            except PageLimitError as e:
+                return None, str(e), 400
+            outcome = combine_page_outcomes(outcomes, page_mode)
+        else:
+            # PDF rasterization is CPU bound, keep it off the event loop
+            try:
+                receipt_obj_list = await asyncio.to_thread(load_receipt_images, filename, upload.path,
+                                                           **raster_options(app.config),
+                                                           image_options=image_options(app.config))
+            except PageLimitError as e:
+                return None, str(e), 400
+            if duplicate_index is not None and duplicate_scope is not None and not is_pdf(filename):
+                # The same receipt photographed again is flagged, hashed before OCR replaces the image
+                duplicate_hashes, duplicate_match = await asyncio.to_thread(
+                    duplicate_index.check, duplicate_scope, receipt_obj_list[0])
+                if duplicate_match is not None and duplicate_index.can_answer(duplicate_match):
+                    # Close enough to answer with the earlier parse without calling a model
+                    earlier_json = await asyncio.to_thread(parse_cache.lookup, duplicate_match.content_hash,
+                                                           get_cache_candidates(parsers))
+                    duplicate_json = duplicate_index.answer(duplicate_match, upload, earlier_json)
+                    if duplicate_json is not None:
+                        return duplicate_json, None, 200
+            outcome = await parse_images(receipt_obj_list)
+
+        if outcome.invalid_api_keys:
+            return None, f"Invalid API keys for {outcome.api_key_error_models}", 401
+
+        # After all parsers have been tried, if response is still None, return an error
+        if outcome.response is None:
+            return None, outcome.error or 'Image is not a receipt or error parsing receipt', 400
+
+        with time_stage('serialize'):
+            response_json = dumps_receipts(outcome.response).decode('utf-8')
+        await asyncio.to_thread(parse_cache.store, content_hash, outcome.handler.model_name,
+                                outcome.handler.prompt_version, response_json)
+        if duplicate_index is not None and duplicate_scope is not None:
+            duplicate_index.add_upload(duplicate_scope, upload.content_hash)
+        if duplicate_hashes is not None:
+            duplicate_index.add(duplicate_scope, duplicate_hashes, upload.content_hash)
+        if duplicate_match is not None:
+            earlier_json = await asyncio.to_thread(parse_cache.lookup, duplicate_match.content_hash,
+                                                   get_cache_candidates(parsers))
+            response_json = duplicate_index.resolve(duplicate_match, upload, response_json, earlier_json)
+        return response_json, None, 200
+
+    @app.before_request
+    async def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    async def record_request_latency(response):
+        if 'request_start' in g:
+            rule = request.url_rule.rule if request.url_rule is not None else None
+            record_request(rule, request.method, response.status_code, time.perf_counter() - g.request_start)
+        return response
+
+    @app.route('/review', methods=['POST'])
+    async def get_review():
+        data = await request.get_json()
+
+        default_model = data.get('apiKeys', {}).get('defaultModel')
+        gemini_api_key = data.get('apiKeys', {}).get('geminiKey')
+        openai_api_key = data.get('apiKeys', {}).get('openaiKey')
+        receipts = data.get('receipts')
+        query = data.get('query')
+
+        if query is None:
+            query = ""
+
+        # Check if everything is received
+        error = validate_api_keys(default_model, gemini_api_key, openai_api_key)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        if receipts is None:
+            return jsonify({'error': 'Missing receipts parameter'}), 400
+
+        reviewers = get_reviewers(default_model, gemini_api_key, openai_api_key)
+        stream = wants_stream(data, request.headers)
+
+        # Same receipts and query as a recent request, e.g. a dashboard reload
+        cache_key = InsightsCache.make_key(receipts, query, AbstractReview.prompt_version)
+        insights, stale = await asyncio.to_thread(insights_cache.lookup, cache_key)
+        if insights is not None:
+            if stale and insights_cache.start_refresh(cache_key):
+                receipt_str = format_review_data(receipts, app.config['REVIEW_MAX_RAW_RECEIPTS'],
+                                                 app.config['REVIEW_SAMPLE_RECEIPTS'])
+                task = asyncio.ensure_future(refresh_insights(cache_key, reviewers, receipt_str, query))
+                refresh_tasks.add(task)
+                task.add_done_callback(refresh_tasks.discard)
+            return insights_response(insights, stream, {'X-Insights-Cache': 'stale' if stale else 'hit'})
+
+        headers = {'X-Insights-Cache': 'miss'}
+        plan = None
+        if data.get('incremental'):
+            # Only the receipts added since the last summary of this user go to the reviewer
+            summary_key = RollingSummaryStore.make_key(get_user_key(data), query, AbstractReview.prompt_version)
+            plan = await asyncio.to_thread(rolling_summaries.plan, summary_key, receipts)
+            headers['X-Review-Mode'] = plan.mode
+            if plan.mode == PLAN_UNCHANGED:
+                return insights_response(plan.insights, stream, headers)
+            receipt_str = plan.receipt_str
+        else:
+            # Long histories are summarized, so the prompt stays bounded
+            receipt_str = format_review_data(receipts, app.config['REVIEW_MAX_RAW_RECEIPTS'],
+                                             app.config['REVIEW_SAMPLE_RECEIPTS'])
+
+        async def remember(insights):
+            # The insights cache and the summaries may be on disk
+            await asyncio.to_thread(insights_cache.store, cache_key, insights)
+            if plan is not None:
+                await asyncio.to_thread(rolling_summaries.commit, plan, insights)
+
+        if stream:
+            async def limited_events():
+                # The slot is held until the stream ends
+                async with concurrency_limit():
+                    reviewer_events = stream_review_async(reviewers, receipt_str, query, health=provider_health)
+                    async for event in reviewer_events:
+                        yield event
+
+            events = limited_events()
+            # The first event arrives with the first insight text, or tells that the API keys are invalid
+            first_event = await events.__anext__()
+            if first_event[0] == 'invalid_api_keys':
+                await events.aclose()
+                return jsonify({'error': f"Invalid API keys for {first_event[1]}"}), 401
+
+            async def cache_done(event):
+                if event[0] == 'done' and event[1]['insights'] != DEFAULT_INSIGHTS:
+                    await remember(event[1]['insights'])
+
+            async def generate():
+                await cache_done(first_event)
+                yield sse_event(*first_event)
+                async for event in events:
+                    await cache_done(event)
+                    yield sse_event(*event)
+            return Response(generate(), mimetype='text/event-stream', headers={**SSE_HEADERS, **headers}), 200
+
+        async with concurrency_limit():
+            outcome = await run_with_fallback_async(
+                reviewers, lambda reviewer: reviewer.review_async(receipt_str, query), 'reviewer',
+                provider_health)
+        if outcome.invalid_api_keys:
+            return jsonify({'error': f"Invalid API keys for {outcome.api_key_error_models}"}), 401
+
+        # After all reviewers have been tried, if response is still None, return standard insights
+        if outcome.response is None:
+            return jsonify(DEFAULT_INSIGHTS), 200
+
+        await remember(outcome.response)
+        return jsonify(outcome.response), 200, headers
+
+    @app.route('/upload', methods=['POST'])
+    async def upload_file():
+        files = await request.files
+        form = await request.form
+
+        # Check if everything is received
+        error = validate_upload(files, form)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        parse_policy, hedge_delay, error = get_parse_policy(form, app.config)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        page_mode, pages_per_group, error = get_page_mode(form, app.config)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        run_async, callback_url, error = get_job_options(form, app.config['JOB_CALLBACK_ALLOWED_HOSTS'])
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        # Unpack
+        file = files['file']
+        default_model = form.get('defaultModel')
+        gemini_api_key = form.get('geminiKey')
+        openai_api_key = form.get('openaiKey')
+
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Invalid file type received'}), 400
+
+        filename = secure_filename(file.filename)
+
+        parsers = get_parsers(default_model, gemini_api_key, openai_api_key)
+        duplicate_scope = get_duplicate_scope(form)
+        template_scope = get_template_scope(form)
+
+        # Spool the upload to a temp file instead of reading it into memory
+        with await asyncio.to_thread(SpooledUpload, file.stream) as upload:
+            if run_async:
+                # The job worker threads run the parse on this event loop
+                loop = asyncio.get_running_loop()
+                job_id = await asyncio.to_thread(
+                    job_queue.submit, filename, upload,
+                    lambda job_upload: asyncio.run_coroutine_threadsafe(
+                        parse_upload(filename, job_upload, parsers, parse_policy, hedge_delay, page_mode,
+                                     pages_per_group, duplicate_scope, template_scope), loop).result(),
+                    callback_url)
+                if job_id is None:
+                    return jsonify({'error': 'Too many queued jobs, try again later'}), 503, {'Retry-After': '30'}
+                return jsonify({'job_id': job_id, 'status': JOB_QUEUED}), 202, {'Location': f'/jobs/{job_id}'}
+
+            response_json, error, status = await parse_upload(filename, upload, parsers, parse_policy, hedge_delay,
+                                                              page_mode, pages_per_group, duplicate_scope,
+                                                              template_scope)
+        if error is not None:
+            return jsonify({'error': error}), status
+        headers = upload.duplicate.headers() if upload.duplicate is not None else {}
+        return Response(response_json, mimetype='application/json', headers=headers), status
+
+    @app.route('/upload/batch', methods=['POST'])
+    async def upload_batch():
+        files = await request.files
+        form = await request.form
+
+        # Check if everything is received
+        error = validate_batch(files, form)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        parse_policy, hedge_delay, error = get_parse_policy(form, app.config)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        page_mode, pages_per_group, error = get_page_mode(form, app.config)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        batch_format = get_batch_format(form, request.headers)
+        parsers = get_parsers(form.get('defaultModel'), form.get('geminiKey'), form.get('openaiKey'))
+        duplicate_scope = get_duplicate_scope(form)
+        template_scope = get_template_scope(form)
+
+        items, error = await asyncio.to_thread(spool_batch, files.getlist('files'), app.config['BATCH_MAX_FILES'],
+                                               app.config['BATCH_MAX_FILE_SIZE'], app.config['BATCH_MAX_TOTAL_SIZE'])
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        # Bounds the files of this batch parsed at once, the provider calls are also bounded by concurrency_limit
+        batch_limit = asyncio.Semaphore(app.config['BATCH_MAX_WORKERS'])
+
+        async def parse_item(item):
+            if item.error is not None:
+                return batch_result(item, error=item.error)
+            try:
+                async with batch_limit:
+                    response_json, error, status = await parse_upload(item.filename, item.upload, parsers,
+                                                                      parse_policy, hedge_delay, page_mode,
+                                                                      pages_per_group, duplicate_scope,
+                                                                      template_scope)
+            except Exception as e:
+                print(f"Unexpected error occurred parsing {item.filename}: {e}")
+                response_json, error, status = None, 'Error parsing receipt', 500
+            finally:
+                # Free the disk space as soon as the file is parsed
+                item.upload.close()
+            return batch_result(item, response_json, error, status)
+
+        tasks = [asyncio.ensure_future(parse_item(item)) for item in items]
+
+        if batch_format == 'ndjson':
+            async def generate():
+                try:
+                    for next_result in asyncio.as_completed(tasks):
+                        yield json.dumps(await next_result) + '\n'
+                finally:
+                    # Client went away, stop parsing the rest of the batch
+                    for task in tasks:
+                        task.cancel()
+                    close_batch(items)
+            return Response(generate(), mimetype='application/x-ndjson'), 200
+
+        try:
+            return jsonify(summarize_batch(await asyncio.gather(*tasks))), 200
+        finally:
+            for task in tasks:
+                task.cancel()
+            close_batch(items)
+
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    async def get_job(job_id):
+        job = await asyncio.to_thread(job_queue.store.get, job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job_to_dict(job)), 200
+
+    @app.route('/metrics', methods=['GET'])
+    async def get_metrics():
+        body, content_type = metrics_response()
+        return Response(body, content_type=content_type), 200
+
+    @app.route('/providers', methods=['GET'])
+    async def get_providers():
+        """Circuit breaker state, error rate and latency of each provider"""
+        if provider_health is None:
+            return jsonify({'enabled': False, 'providers': {}}), 200
+        return jsonify({'enabled': True, 'providers': provider_health.status()}), 200
+
+    @app.route('/stats', methods=['GET'])
+    async def get_stats():
+        return jsonify({
+            'parse_cache': parse_cache.stats(),
+            'insights_cache': insights_cache.stats(),
+            'rolling_summaries': rolling_summaries.stats(),
+            'race': race_stats.stats(),
+            'images': preprocess_stats.stats(),
+            'ocr': ocr_stats.stats(),
+            'templates': template_store.stats() if template_store is not None else None,
+            'duplicates': duplicate_index.stats() if duplicate_index is not None else None,
+            'jobs': job_queue.stats(),
+            'repairs': repair_stats.stats(),
+            'cassette': get_cassette().stats() if get_cassette() is not None else None,
+        }), 200
+
+    return app
+
+
+if __name__ == '__main__':
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config as HypercornConfig
+
+    hypercorn_config = HypercornConfig()
+    hypercorn_config.bind = [Config.ASYNC_BIND]
+    asyncio.run(serve(create_async_app(), hypercorn_config))
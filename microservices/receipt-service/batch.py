@@ -0,0 +1,146 @@
+from typing import Optional
+import json
+import os
+import zipfile
+from werkzeug.utils import secure_filename
+from pipeline import allowed_file, validate_api_keys, SpooledUpload
+
+# Batch upload: many receipts in one request, as several 'files' parts or a single zip archive
+# Every file is spooled to disk first, then parsed concurrently with the same logic as /upload.
+# Results come back in upload order in one json response, or as NDJSON lines as each file finishes.
+
+BATCH_FORMATS = {'json', 'ndjson'}
+
+
+class BatchItem:
+    """One file of a batch, either spooled to disk or rejected with an error"""
+    def __init__(self, index: int, filename: str, upload: SpooledUpload = None, error: str = None):
+        self.index = index
+        self.filename = filename
+        self.upload = upload
+        self.error = error
+
+
+def get_batch_format(form, headers) -> str:
+    batch_format = form.get('format')
+    if batch_format is None:
+        batch_format = 'ndjson' if 'application/x-ndjson' in headers.get('Accept', '') else 'json'
+    return batch_format.lower()
+
+
+def validate_batch(files, form) -> Optional[str]:
+    """Returns the error message if the batch request is incomplete"""
+    if not files.getlist('files'):
+        return 'No files received'
+
+    if get_batch_format(form, {}) not in BATCH_FORMATS:
+        return f"Invalid format parameter, expected one of {sorted(BATCH_FORMATS)}"
+
+    return validate_api_keys(form.get('defaultModel'), form.get('geminiKey'), form.get('openaiKey'))
+
+
+def is_zip(filename):
+    return filename.rsplit('.', 1)[-1].lower() == 'zip'
+
+
+def _too_large(max_total_size):
+    return f"Batch too large, at most {max_total_size} bytes of files per batch"
+
+
+def _spool_zip(path, items, max_files, max_file_size, max_total_size, total_size):
+    """Returns (error_msg, total_size), total_size adds up the files spooled so far"""
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            # Flatten the archive folders, secure_filename drops them anyway
+            filename = secure_filename(os.path.basename(info.filename))
+            if len(items) == max_files:
+                return f"Too many files, at most {max_files} per batch", total_size
+            if not allowed_file(filename):
+                items.append(BatchItem(len(items), filename, error='Invalid file type received'))
+            elif info.file_size > max_file_size:
+                items.append(BatchItem(len(items), filename, error='File too large'))
+            else:
+                # A small archive can declare far more than it holds on disk, stop before expanding past the total
+                total_size += info.file_size
+                if max_total_size and total_size > max_total_size:
+                    return _too_large(max_total_size), total_size
+                # Reads stop at the declared file_size, so the size checks also bound what is extracted
+                with archive.open(info) as stream:
+                    items.append(BatchItem(len(items), filename, SpooledUpload(stream)))
+    return None, total_size
+
+
+def spool_batch(files, max_files: int, max_file_size: int, max_total_size: int = 0):
+    """Spool every file of the batch to disk, zip archives are expanded
+
+    Returns (items, error_msg), the spooled uploads are already closed if there is an error. max_total_size bounds
+    the bytes of all spooled files together, 0 = unbounded.
+    """
+    items = []
+    error = None
+    total_size = 0
+    try:
+        for file in files:
+            if len(items) == max_files:
+                error = f"Too many files, at most {max_files} per batch"
+                break
+
+            if is_zip(file.filename):
+                with SpooledUpload(file.stream) as archive:
+                    try:
+                        error, total_size = _spool_zip(archive.path, items, max_files, max_file_size,
+                                                       max_total_size, total_size)
+                    except zipfile.BadZipFile:
+                        error = f"Invalid zip archive {file.filename}"
+                if error is not None:
+                    break
+                continue
+
+            filename = secure_filename(file.filename)
+            if not allowed_file(filename):
+                items.append(BatchItem(len(items), filename, error='Invalid file type received'))
+                continue
+
+            upload = SpooledUpload(file.stream)
+            file_size = os.path.getsize(upload.path)
+            if file_size > max_file_size:
+                upload.close()
+                items.append(BatchItem(len(items), filename, error='File too large'))
+                continue
+            total_size += file_size
+            if max_total_size and total_size > max_total_size:
+                upload.close()
+                error = _too_large(max_total_size)
+                break
+            items.append(BatchItem(len(items), filename, upload))
+    except BaseException:
+        close_batch(items)
+        raise
+
+    if error is not None:
+        close_batch(items)
+        return [], error
+    return items, None
+
+
+def close_batch(items):
+    for item in items:
+        if item.upload is not None:
+            item.upload.close()
+
+
+def batch_result(item: BatchItem, response_json: str = None, error: str = None, status: int = 400) -> dict:
+    result = {'index': item.index, 'filename': item.filename, 'status': status}
+    if error is not None:
+        result['error'] = error
+    else:
+        result['result'] = json.loads(response_json)
+    return result
+
+
+def summarize_batch(results) -> dict:
+    results = sorted(results, key=lambda result: result['index'])
+    parsed = sum(result['status'] == 200 for result in results)
+    return {'parsed': parsed, 'failed': len(results) - parsed, 'results': results}
@@ -0,0 +1,241 @@
+"""Load test of /upload and /review against the mock provider, reports throughput, latency and CPU per stage
+
+Run from microservices/receipt-service, either against a running service (see benchmarks/mock_provider.py):
+    python benchmarks/load_test.py --url http://127.0.0.1:8081 [--concurrency 1,4,16] [--requests 50]
+or let it start the mock provider and the service itself:
+    python benchmarks/load_test.py --start [--service sync|async] [--latency 0.8] [--jitter 0.3] [--error-rate 0]
+
+Every request uses a new file hash and query, so the parse and insights caches never answer it, --cached keeps
+them identical. CPU per stage comes from the receipt_stage_cpu_seconds_total and process_cpu_seconds_total
+metrics of the service, scraped before and after each run. Stages run in the async service's event loop only
+count where they do not await, its llm_call stage is not measured.
+Run it on two commits with the same options to compare them, --json saves the results.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+import requests
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_IMAGE = os.path.join(SERVICE_DIR, 'tests', 'media', 'receipts_images', 'food1.jpeg')
+CATEGORIES = ['Food', 'Transport', 'Clothing', 'Leisure', 'Healthcare', 'Housing', 'Others']
+
+
+def percentile(values, fraction: float) -> float:
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+def make_receipts(count: int, rng: random.Random):
+    receipts = []
+    for i in range(count):
+        cost = round(rng.uniform(3, 80), 2)
+        receipts.append({
+            'merchantName': f"Merchant {rng.randrange(12)}",
+            'date': f"2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}",
+            'category': rng.choice(CATEGORIES),
+            'totalCost': cost,
+            'itemizedList': [{'itemName': f"Item {rng.randrange(40)}", 'itemQuantity': 1, 'itemCost': cost}],
+        })
+    return receipts
+
+
+def read_metrics(url: str) -> dict:
+    """CPU seconds by stage, plus 'process' for the whole service process"""
+    cpu = {}
+    for line in requests.get(f"{url}/metrics", timeout=10).text.splitlines():
+        if line.startswith('receipt_stage_cpu_seconds_total{'):
+            stage = line.split('stage="', 1)[1].split('"', 1)[0]
+            cpu[stage] = float(line.rsplit(' ', 1)[1])
+        elif line.startswith('process_cpu_seconds_total '):
+            cpu['process'] = float(line.rsplit(' ', 1)[1])
+    return cpu
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.url = args.url.rstrip('/')
+        self.api_keys = {'defaultModel': args.model, 'geminiKey': args.gemini_key, 'openaiKey': args.openai_key}
+        with open(args.image, 'rb') as f:
+            self.image = f.read()
+        self.image_name = os.path.basename(args.image)
+        self.receipts = make_receipts(args.review_receipts, random.Random(0))
+        self.run_id = uuid.uuid4().hex[:8]
+        # Numbers every request of the run, so no two requests share a cache key
+        self.counter = itertools.count()
+
+    def upload(self, session: requests.Session, index: int) -> bool:
+        image = self.image
+        if not self.args.cached:
+            # Bytes after the end of the image change its hash, decoders ignore them
+            image += f"{self.run_id}:{index}".encode('ascii')
+        response = session.post(f"{self.url}/upload", data=self.api_keys,
+                                files={'file': (self.image_name, image)}, timeout=self.args.timeout)
+        return response.status_code == 200
+
+    def review(self, session: requests.Session, index: int) -> bool:
+        query = 'Where can I save?' if self.args.cached else f"Where can I save? ({self.run_id}:{index})"
+        response = session.post(f"{self.url}/review", json={
+            'apiKeys': self.api_keys, 'receipts': self.receipts, 'query': query, 'stream': self.args.stream,
+        }, timeout=self.args.timeout, stream=self.args.stream)
+        if self.args.stream:
+            # Latency of a stream is until its last event
+            for _ in response.iter_content(chunk_size=None):
+                pass
+        return response.status_code == 200
+
+    def run(self, endpoint: str, concurrency: int) -> dict:
+        call = self.upload if endpoint == 'upload' else self.review
+        sessions = [requests.Session() for _ in range(concurrency)]
+        latencies = []
+        failures = []
+
+        def worker(worker_index):
+            session = sessions[worker_index]
+            for _ in range(worker_index, self.args.requests, concurrency):
+                start = time.perf_counter()
+                try:
+                    ok = call(session, next(self.counter))
+                except requests.RequestException:
+                    ok = False
+                seconds = time.perf_counter() - start
+                (latencies if ok else failures).append(seconds)
+
+        cpu_before = read_metrics(self.url)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(worker, range(concurrency)))
+        elapsed = time.perf_counter() - start
+        cpu_after = read_metrics(self.url)
+
+        latencies.sort()
+        completed = len(latencies)
+        return {
+            'endpoint': endpoint,
+            'concurrency': concurrency,
+            'requests': self.args.requests,
+            'errors': len(failures),
+            'throughput': completed / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            # Includes the scrape of /metrics itself, a few ms per run
+            'cpu_ms_per_request': {stage: (cpu_after.get(stage, 0.0) - cpu_before.get(stage, 0.0))
+                                   * 1000 / max(completed, 1)
+                                   for stage in sorted(set(cpu_after) | set(cpu_before))},
+        }
+
+
+def print_results(results):
+    stages = sorted({stage for result in results for stage in result['cpu_ms_per_request']})
+    header = (f"{'endpoint':<8} {'conc':>4} {'ok':>5} {'err':>4} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'p99 ms':>8}  " + ' '.join(f"{stage:>12}" for stage in stages))
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        cpu = result['cpu_ms_per_request']
+        print(f"{result['endpoint']:<8} {result['concurrency']:>4} {result['requests'] - result['errors']:>5} "
+              f"{result['errors']:>4} {result['throughput']:>7.2f} {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} "
+              f"{result['p99_ms']:>8.1f}  " + ' '.join(f"{cpu.get(stage, 0.0):>12.2f}" for stage in stages))
+    print("CPU columns are ms per successful request, 'process' is the whole service process")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=2)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start within {timeout}s")
+
+
+def start_servers(args):
+    """Start the mock provider and the service as subprocesses, returns (processes, service_url)"""
+    mock_port, service_port = free_port(), free_port()
+    mock = subprocess.Popen([sys.executable, os.path.join('benchmarks', 'mock_provider.py'),
+                             '--port', str(mock_port), '--latency', str(args.latency), '--jitter', str(args.jitter),
+                             '--error-rate', str(args.error_rate), '--seed', '0'], cwd=SERVICE_DIR)
+    env = dict(os.environ, OPENAI_BASE_URL=f"http://127.0.0.1:{mock_port}/v1",
+               GEMINI_API_ENDPOINT=f"http://127.0.0.1:{mock_port}", GEMINI_TRANSPORT='rest',
+               ASYNC_BIND=f"127.0.0.1:{service_port}")
+    if args.service == 'async':
+        command = [sys.executable, 'asyncservice.py']
+    else:
+        command = [sys.executable, '-c', 'from receiptservice import create_app; '
+                   f'create_app().run(host="127.0.0.1", port={service_port}, threaded=True)']
+    service = subprocess.Popen(command, cwd=SERVICE_DIR, env=env, stdout=subprocess.DEVNULL)
+    service_url = f"http://127.0.0.1:{service_port}"
+    try:
+        wait_for(f"{service_url}/metrics")
+    except RuntimeError:
+        mock.terminate()
+        service.terminate()
+        raise
+    return [mock, service], service_url
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--url', default='http://127.0.0.1:8081', help='service to load, unless --start')
+    arg_parser.add_argument('--start', action='store_true', help='start the mock provider and the service')
+    arg_parser.add_argument('--service', choices=['sync', 'async'], default='sync')
+    arg_parser.add_argument('--latency', type=float, default=0.8, help='mock provider median latency, with --start')
+    arg_parser.add_argument('--jitter', type=float, default=0.3, help='mock provider latency sigma, with --start')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help='mock provider error rate, with --start')
+    arg_parser.add_argument('--endpoints', default='upload,review')
+    arg_parser.add_argument('--concurrency', default='1,4,16')
+    arg_parser.add_argument('--requests', type=int, default=50, help='requests per endpoint and concurrency')
+    arg_parser.add_argument('--model', default='OPENAI', choices=['OPENAI', 'GEMINI'])
+    arg_parser.add_argument('--gemini-key', default='BENCH')
+    arg_parser.add_argument('--openai-key', default='BENCH')
+    arg_parser.add_argument('--image', default=DEFAULT_IMAGE)
+    arg_parser.add_argument('--review-receipts', type=int, default=30, help='receipts in each /review request')
+    arg_parser.add_argument('--stream', action='store_true', help='stream /review as Server-Sent Events')
+    arg_parser.add_argument('--cached', action='store_true', help='repeat identical requests, so caches answer')
+    arg_parser.add_argument('--timeout', type=float, default=120)
+    arg_parser.add_argument('--json', help='also write the results to this file')
+    args = arg_parser.parse_args()
+
+    processes = []
+    if args.start:
+        processes, args.url = start_servers(args)
+    try:
+        load_test = LoadTest(args)
+        results = []
+        for endpoint in args.endpoints.split(','):
+            for concurrency in [int(level) for level in args.concurrency.split(',')]:
+                results.append(load_test.run(endpoint, concurrency))
+                print(f"{endpoint} at concurrency {concurrency}: {results[-1]['throughput']:.2f} req/s",
+                      file=sys.stderr)
+        print_results(results)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump({'options': vars(args), 'results': results}, f, indent=2)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+"""Local stand-in for the OpenAI and Gemini APIs, to benchmark the service without calling the real providers
+
+Run from microservices/receipt-service:
+    python benchmarks/mock_provider.py [--port 8765] [--latency 0.8] [--jitter 0.3] [--error-rate 0.0]
+
+Then start the service against it:
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 GEMINI_API_ENDPOINT=http://127.0.0.1:8765 GEMINI_TRANSPORT=rest \\
+        python receiptservice.py
+
+Speaks the chat completions API (POST /v1/chat/completions, plain and streamed) and the Gemini REST API
+(GET /v1beta/models/<model>, POST :generateContent and :streamGenerateContent). Requests that mention insights get
+a canned review, the others a canned receipt from --receipts. The API key INVALID is rejected like the real APIs
+do. Latency is lognormal around --latency seconds, --jitter is its sigma (0 = fixed), and --error-rate of the
+requests fail with --error-status after the latency has passed.
+The async client of Gemini only speaks gRPC, so the async service can only be benchmarked with defaultModel OPENAI.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+
+INVALID_KEY = 'INVALID'
+
+DEFAULT_RECEIPTS = [
+    {
+        'merchant_name': 'FAIRPRICE FINEST',
+        'date': '12/03/2024',
+        'total_cost': '48.20',
+        'category': 'Food',
+        'itemized_list': [
+            {'item_name': 'Fresh Milk 1L', 'item_quantity': '2', 'item_cost': '3.95'},
+            {'item_name': 'Wholemeal Bread', 'item_quantity': '1', 'item_cost': '2.80'},
+            {'item_name': 'Chicken Breast', 'item_quantity': '1', 'item_cost': '9.50'},
+            {'item_name': 'Olive Oil 500ml', 'item_quantity': '1', 'item_cost': '12.90'},
+            {'item_name': 'Bananas', 'item_quantity': '3', 'item_cost': '5.03'},
+        ],
+    },
+    {
+        'merchant_name': 'UNIQLO',
+        'date': '02/03/2024',
+        'total_cost': '59.80',
+        'category': 'Clothing',
+        'itemized_list': [
+            {'item_name': 'Airism T-Shirt', 'item_quantity': '2', 'item_cost': '29.90'},
+        ],
+    },
+]
+DEFAULT_INSIGHTS = ("Groceries are your largest expense. Planning meals for the week and buying staples in bulk "
+                    "could lower it, and a monthly clothing budget would keep one-off purchases in check.")
+
+
+class MockProvider:
+    """Canned responses and the latency and error model shared by the request handlers"""
+    def __init__(self, latency: float = 0.8, jitter: float = 0.3, error_rate: float = 0.0, error_status: int = 503,
+                 fail_provider: str = None, receipts=None, insights: str = DEFAULT_INSIGHTS, stream_chunks: int = 8,
+                 seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # Only this provider fails, None = both
+        self.fail_provider = fail_provider
+        self.receipts = receipts or DEFAULT_RECEIPTS
+        self.insights = insights
+        self.stream_chunks = stream_chunks
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def sample_latency(self) -> float:
+        with self._lock:
+            return self.latency * math.exp(self.jitter * self.random.gauss(0, 1)) if self.jitter else self.latency
+
+    def should_fail(self, provider: str) -> bool:
+        with self._lock:
+            self.requests += 1
+            if self.fail_provider not in (None, provider) or self.random.random() >= self.error_rate:
+                return False
+            self.errors += 1
+            return True
+
+    def response_text(self, body: bytes) -> str:
+        # Parser prompts never mention insights, review prompts and schemas always do
+        if b'insights' in body:
+            return json.dumps({'status': True, 'insights': self.insights})
+        with self._lock:
+            receipt = self.random.choice(self.receipts)
+        return json.dumps(receipt)
+
+    def chunks(self, text: str):
+        size = max(1, math.ceil(len(text) / self.stream_chunks))
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def estimate_tokens(data: bytes) -> int:
+    return max(1, len(data) // 4)
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    mock: MockProvider = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_stream(self, content_type: str):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def wait_or_fail(self, provider: str, latency: float) -> bool:
+        """Sleep out the latency, True if the request should fail"""
+        time.sleep(latency)
+        return self.mock.should_fail(provider)
+
+    def stream_delays(self, latency: float, count: int):
+        # The first chunk takes most of the latency, like the time to the first token of a real model
+        first = latency * 0.6
+        rest = (latency - first) / max(count - 1, 1)
+        return [first] + [rest] * (count - 1)
+
+    # Gemini
+
+    def gemini_key(self) -> str:
+        if 'key=' in self.path:
+            return self.path.split('key=', 1)[1].split('&', 1)[0]
+        return self.headers.get('x-goog-api-key', '')
+
+    def gemini_error(self, status: int, message: str):
+        self.send_json(status, {'error': {'code': status, 'message': message,
+                                          'status': 'INVALID_ARGUMENT' if status == 400 else 'UNAVAILABLE'}})
+
+    def gemini_model(self, name: str):
+        self.send_json(200, {
+            'name': name, 'baseModelId': name.split('/')[-1], 'version': '001', 'displayName': name,
+            'description': 'Mock model', 'inputTokenLimit': 1048576, 'outputTokenLimit': 8192,
+            'supportedGenerationMethods': ['generateContent', 'countTokens'],
+            'temperature': 1.0, 'maxTemperature': 2.0, 'topP': 0.95, 'topK': 64,
+        })
+
+    def gemini_response(self, text: str, prompt_tokens: int, finish: bool = True):
+        candidate = {'content': {'parts': [{'text': text}], 'role': 'model'}, 'index': 0}
+        if finish:
+            candidate['finishReason'] = 'STOP'
+        completion_tokens = estimate_tokens(text.encode('utf-8'))
+        return {'candidates': [candidate], 'usageMetadata': {
+            'promptTokenCount': prompt_tokens, 'candidatesTokenCount': completion_tokens,
+            'totalTokenCount': prompt_tokens + completion_tokens}}
+
+    def gemini_generate(self, body: bytes, stream: bool):
+        latency = self.mock.sample_latency()
+        text = self.mock.response_text(body)
+        prompt_tokens = estimate_tokens(body)
+        if not stream:
+            if self.wait_or_fail('gemini', latency):
+                return self.gemini_error(self.mock.error_status, 'Mock provider error')
+            return self.send_json(200, self.gemini_response(text, prompt_tokens))
+
+        chunks = self.mock.chunks(text)
+        delays = self.stream_delays(latency, len(chunks))
+        if self.wait_or_fail('gemini', delays[0]):
+            return self.gemini_error(self.mock.error_status, 'Mock provider error')
+        # The REST stream is a single json array, written one element at a time
+        self.start_stream('application/json')
+        for i, (chunk, delay) in enumerate(zip(chunks, delays)):
+            if i:
+                time.sleep(delay)
+            element = json.dumps(self.gemini_response(chunk, prompt_tokens, finish=i == len(chunks) - 1))
+            self.write_chunk((('[' if i == 0 else ',') + element).encode('utf-8'))
+        self.write_chunk(b']')
+        self.end_stream()
+
+    # OpenAI
+
+    def openai_completion(self, body: bytes):
+        if self.headers.get('Authorization', '') == f'Bearer {INVALID_KEY}':
+            return self.send_json(401, {'error': {'message': 'Incorrect API key provided', 'type': 'invalid_request_error',
+                                                  'code': 'invalid_api_key'}})
+        request = json.loads(body)
+        latency = self.mock.sample_latency()
+        text = self.mock.response_text(body)
+        prompt_tokens = estimate_tokens(body)
+        completion_tokens = estimate_tokens(text.encode('utf-8'))
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                 'total_tokens': prompt_tokens + completion_tokens}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        base = {'id': completion_id, 'created': int(time.time()), 'model': request.get('model', 'gpt-4o-mini'),
+                'system_fingerprint': 'fp_mock'}
+
+        if not request.get('stream'):
+            if self.wait_or_fail('openai', latency):
+                return self.send_json(self.mock.error_status, {'error': {'message': 'Mock provider error',
+                                                                         'type': 'server_error'}})
+            return self.send_json(200, {**base, 'object': 'chat.completion', 'usage': usage, 'choices': [{
+                'index': 0, 'finish_reason': 'stop', 'logprobs': None,
+                'message': {'role': 'assistant', 'content': text, 'refusal': None}}]})
+
+        chunks = self.mock.chunks(text)
+        delays = self.stream_delays(latency, len(chunks))
+        if self.wait_or_fail('openai', delays[0]):
+            return self.send_json(self.mock.error_status, {'error': {'message': 'Mock provider error',
+                                                                     'type': 'server_error'}})
+        self.start_stream('text/event-stream')
+
+        def send_event(payload):
+            self.write_chunk(f"data: {json.dumps(payload)}\n\n".encode('utf-8'))
+
+        for i, (chunk, delay) in enumerate(zip(chunks, delays)):
+            if i:
+                time.sleep(delay)
+            delta = {'content': chunk, **({'role': 'assistant'} if i == 0 else {})}
+            send_event({**base, 'object': 'chat.completion.chunk', 'choices': [
+                {'index': 0, 'delta': delta, 'finish_reason': None, 'logprobs': None}]})
+        send_event({**base, 'object': 'chat.completion.chunk', 'choices': [
+            {'index': 0, 'delta': {}, 'finish_reason': 'stop', 'logprobs': None}]})
+        if (request.get('stream_options') or {}).get('include_usage'):
+            send_event({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.end_stream()
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path.startswith('/v1beta/models/'):
+            if self.gemini_key() == INVALID_KEY:
+                return self.gemini_error(400, 'API key not valid. Please pass a valid API key.')
+            return self.gemini_model(path[len('/v1beta/'):])
+        self.send_json(404, {'error': {'message': f'Unknown path {path}'}})
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        body = self.read_body()
+        if path.endswith('/chat/completions'):
+            return self.openai_completion(body)
+        if path.startswith('/v1beta/models/') and ':' in path:
+            if self.gemini_key() == INVALID_KEY:
+                return self.gemini_error(400, 'API key not valid. Please pass a valid API key.')
+            method = path.rsplit(':', 1)[1]
+            if method in ('generateContent', 'streamGenerateContent'):
+                return self.gemini_generate(body, stream=method == 'streamGenerateContent')
+        self.send_json(404, {'error': {'message': f'Unknown path {path}'}})
+
+
+def start_mock_provider(mock: MockProvider, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """Serve the mock in a daemon thread, port 0 picks a free port (server.server_address[1])"""
+    handler = type('Handler', (MockProviderHandler,), {'mock': mock})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--latency', type=float, default=0.8, help='median seconds of a response')
+    arg_parser.add_argument('--jitter', type=float, default=0.3, help='sigma of the lognormal latency, 0 = fixed')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0)
+    arg_parser.add_argument('--error-status', type=int, default=503)
+    arg_parser.add_argument('--fail-provider', choices=['gemini', 'openai'], help='only this provider fails')
+    arg_parser.add_argument('--receipts', help='json file with a list of canned receipts in the parser schema')
+    arg_parser.add_argument('--insights', default=DEFAULT_INSIGHTS)
+    arg_parser.add_argument('--stream-chunks', type=int, default=8)
+    arg_parser.add_argument('--seed', type=int)
+    args = arg_parser.parse_args()
+
+    receipts = None
+    if args.receipts:
+        with open(args.receipts, 'r', encoding='utf-8') as f:
+            receipts = json.load(f)
+    mock = MockProvider(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        error_status=args.error_status, fail_provider=args.fail_provider, receipts=receipts,
+                        insights=args.insights, stream_chunks=args.stream_chunks, seed=args.seed)
+    server = start_mock_provider(mock, args.host, args.port)
+    print(f"Mock provider listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Microbenchmark of Receipt construction and serialization
+
+Run from microservices/receipt-service:
+    python benchmarks/receipt_bench.py [--receipts 2000] [--items 8] [--repeat 5]
+
+Reports the best per receipt time of each step, run it on two commits to compare them.
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Receipt import Receipt, ReceiptEncoder  # noqa: E402
+
+
+def make_receipt_dict(item_count):
+    return {
+        'merchant_name': 'FAIRPRICE FINEST',
+        'date': '12/03/2024',
+        'total_cost': 'S$ 48.20',
+        'category': 'Food',
+        'itemized_list': [{'item_name': f"Item {i}", 'item_cost': f"{i + 1}.25", 'item_quantity': 1}
+                          for i in range(item_count)],
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--receipts', type=int, default=2000)
+    arg_parser.add_argument('--items', type=int, default=8)
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    receipt_dicts = [make_receipt_dict(args.items) for _ in range(args.receipts)]
+    receipts = [Receipt(**copy.deepcopy(receipt_dict)) for receipt_dict in receipt_dicts]
+
+    def construct():
+        # Receipt replaces the item costs in place, so construct from fresh copies like the parsers do
+        for receipt_dict in copy.deepcopy(receipt_dicts):
+            Receipt(**receipt_dict)
+
+    def copy_only():
+        copy.deepcopy(receipt_dicts)
+
+    steps = {
+        'to_dict': lambda: [receipt.to_dict() for receipt in receipts],
+        'repr': lambda: [repr(receipt) for receipt in receipts],
+        'json.dumps ReceiptEncoder': lambda: json.dumps(receipts, cls=ReceiptEncoder),
+    }
+    if hasattr(Receipt, 'to_json'):
+        steps['to_json'] = lambda: [receipt.to_json() for receipt in receipts]
+
+    copy_seconds = min(timeit.repeat(copy_only, number=1, repeat=args.repeat))
+    construct_seconds = min(timeit.repeat(construct, number=1, repeat=args.repeat)) - copy_seconds
+    print(f"{args.receipts} receipts, {args.items} items each, best of {args.repeat}")
+    print(f"{'construct':<28}{construct_seconds / args.receipts * 1e6:>10.1f} us/receipt")
+    for name, step in steps.items():
+        seconds = min(timeit.repeat(step, number=1, repeat=args.repeat))
+        print(f"{name:<28}{seconds / args.receipts * 1e6:>10.1f} us/receipt")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+from collections import deque
+import asyncio
+from typing import Optional
+import statistics
+import threading
+import time
+from Exceptions import APIKeyError
+from metrics import CIRCUIT_OPEN, FALLBACKS
+
+# Provider circuit breakers and health-aware routing
+# A degraded provider used to be tried first on every request, each one waiting out its timeout and retries before
+# falling back. Each provider now has a breaker over a rolling window of its calls: once enough of them fail the
+# breaker opens and the provider is skipped without a call. After open_seconds one request is let through as a
+# probe (half-open), its success closes the breaker again and its failure keeps it open. route only reads the
+# breakers, the probe is taken by take_call right before the call, so a provider routed behind one that answers
+# does not use up its probe.
+# Among the providers that are let through, the defaultModel order is kept unless a provider is degraded: failing
+# at half the error rate that opens the breaker, or a median latency far above the fastest provider of the task.
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# OpenAI connection errors and timeouts, google.api_core retries that ran out on transient errors
+TRANSPORT_ERRORS = {'APIConnectionError', 'APITimeoutError', 'RetryError'}
+
+
+class CircuitBreaker:
+    """Breaker of one provider, calls of all tasks count toward its error rate"""
+    def __init__(self, name: str, window_seconds: float = 60, min_calls: int = 5, error_rate: float = 0.5,
+                 open_seconds: float = 30, slow_call_seconds: float = 0, clock=time.monotonic):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        # Calls slower than this count as failures, 0 = latency never opens the breaker
+        self.slow_call_seconds = slow_call_seconds
+        self.clock = clock
+        self.state = CLOSED
+        self.opened_at = None
+        # Start of the probe in flight while half-open, a probe that never reports back expires after open_seconds
+        self.probe_started_at = None
+        # (timestamp, ok, task, seconds) of the calls in the window
+        self.calls = deque()
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        while self.calls and self.calls[0][0] < now - self.window_seconds:
+            self.calls.popleft()
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.probe_started_at = None
+        self.opened += 1
+        CIRCUIT_OPEN.labels(self.name).set(1)
+        print(f'Circuit breaker of {self.name} opened')
+
+    def _close(self):
+        self.state = CLOSED
+        self.opened_at = None
+        self.probe_started_at = None
+        # The failures that opened the breaker are not held against the recovered provider
+        self.calls.clear()
+        CIRCUIT_OPEN.labels(self.name).set(0)
+        print(f'Circuit breaker of {self.name} closed')
+
+    def current_state(self) -> str:
+        """State without taking a probe, an open breaker past open_seconds reads as half-open"""
+        with self._lock:
+            if self.state == OPEN and self.clock() - self.opened_at >= self.open_seconds:
+                return HALF_OPEN
+            return self.state
+
+    def available(self) -> bool:
+        """True if allow would let a call through now, without taking the probe"""
+        with self._lock:
+            now = self.clock()
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                return now - self.opened_at >= self.open_seconds
+            return self.probe_started_at is None or now - self.probe_started_at >= self.open_seconds
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def allow(self) -> bool:
+        """True if a call may go to the provider, while half-open only one probe is let through at a time"""
+        with self._lock:
+            now = self.clock()
+            if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+                self.probe_started_at = None
+            if self.state == HALF_OPEN:
+                if self.probe_started_at is None or now - self.probe_started_at >= self.open_seconds:
+                    self.probe_started_at = now
+                    return True
+            elif self.state == CLOSED:
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, task: str, ok: Optional[bool], seconds: float):
+        """Result of a call, ok None is neither a success nor a failure of the provider (e.g. an invalid API key)"""
+        if ok and self.slow_call_seconds and seconds >= self.slow_call_seconds:
+            ok = False
+        with self._lock:
+            now = self.clock()
+            if self.state == HALF_OPEN:
+                if ok is None:
+                    # Let the next request probe instead
+                    self.probe_started_at = None
+                elif ok:
+                    self._close()
+                else:
+                    self._open(now)
+                return
+            if ok is None:
+                return
+            self.calls.append((now, ok, task, seconds))
+            self._trim(now)
+            if self.state == CLOSED and len(self.calls) >= self.min_calls:
+                failures = sum(1 for call in self.calls if not call[1])
+                if failures / len(self.calls) >= self.error_rate:
+                    self._open(now)
+
+    def window(self, task: str = None):
+        """(calls, failures, median seconds of the successful calls of task) in the window"""
+        with self._lock:
+            self._trim(self.clock())
+            failures = sum(1 for call in self.calls if not call[1])
+            latencies = [call[3] for call in self.calls if call[1] and (task is None or call[2] == task)]
+            return len(self.calls), failures, statistics.median(latencies) if latencies else None
+
+    def status(self):
+        calls, failures, latency = self.window()
+        return {
+            'state': self.current_state(),
+            'calls': calls,
+            'error_rate': failures / calls if calls else 0.0,
+            'median_seconds': latency,
+            'opened': self.opened,
+            'rejected': self.rejected,
+        }
+
+
+class ProviderHealth:
+    """Breakers of every provider, used by the fallback, race and stream dispatch to order and skip candidates"""
+    def __init__(self, window_seconds: float = 60, min_calls: int = 5, error_rate: float = 0.5,
+                 open_seconds: float = 30, slow_call_seconds: float = 0, latency_ratio: float = 3.0,
+                 clock=time.monotonic):
+        self.options = {'window_seconds': window_seconds, 'min_calls': min_calls, 'error_rate': error_rate,
+                        'open_seconds': open_seconds, 'slow_call_seconds': slow_call_seconds, 'clock': clock}
+        # A provider this many times slower than the fastest one is degraded, 0 = latency does not reorder
+        self.latency_ratio = latency_ratio
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, model_name: str) -> CircuitBreaker:
+        with self._lock:
+            if model_name not in self.breakers:
+                self.breakers[model_name] = CircuitBreaker(model_name, **self.options)
+            return self.breakers[model_name]
+
+    def route(self, candidates, task_name: str):
+        """Candidates the breakers let through, healthy ones first, otherwise in the given defaultModel order"""
+        windows = {}
+        allowed = []
+        for model_name, handler_cls, api_key in candidates:
+            # Unset keys are skipped by the dispatch without a call
+            if api_key != 'UNSET' and not self.breaker(model_name).available():
+                print(f'Skipping {model_name} {task_name}, circuit breaker is open')
+                FALLBACKS.labels(task_name, model_name, 'circuit_open').inc()
+                self.breaker(model_name).reject()
+                continue
+            windows[model_name] = self.breaker(model_name).window(task_name)
+            allowed.append((model_name, handler_cls, api_key))
+
+        latencies = [window[2] for window in windows.values() if window[2] is not None]
+        fastest = min(latencies) if latencies else None
+
+        def degraded(candidate):
+            calls, failures, latency = windows[candidate[0]]
+            # Failing at half the rate that opens the breaker
+            if calls and failures / calls >= self.options['error_rate'] / 2:
+                return True
+            return bool(self.latency_ratio and fastest and latency is not None
+                        and latency > fastest * self.latency_ratio)
+
+        # sort is stable, so the defaultModel order holds between providers of the same health
+        return sorted(allowed, key=degraded)
+
+    def record(self, model_name: str, task_name: str, ok: Optional[bool], seconds: float):
+        self.breaker(model_name).record(task_name, ok, seconds)
+
+    def status(self):
+        with self._lock:
+            breakers = dict(self.breakers)
+        return {model_name: breaker.status() for model_name, breaker in sorted(breakers.items())}
+
+
+def take_call(health: Optional[ProviderHealth], model_name: str, task_name: str) -> bool:
+    """Right before calling a routed provider, False if a concurrent request took its half-open probe meanwhile"""
+    if health is None or health.breaker(model_name).allow():
+        return True
+    print(f'Skipping {model_name} {task_name}, circuit breaker is open')
+    FALLBACKS.labels(task_name, model_name, 'circuit_open').inc()
+    return False
+
+
+def is_provider_failure(e: Exception) -> bool:
+    """True if e is the provider failing, not the request or the user's API key
+
+    The breakers are shared by every user of a provider, so one user's quota or rate limit (429), a rejected request
+    (4xx) or a reply that could not be used must not open them for everyone. Only server errors (5xx), timeouts and
+    connection errors count. The SDKs are not imported here, their errors carry the HTTP status as status_code
+    (OpenAI) or code (google.api_core), and their transport errors are told apart by class name.
+    """
+    status = getattr(e, 'status_code', None)
+    if not isinstance(status, int):
+        status = getattr(e, 'code', None)
+    if isinstance(status, int) and 100 <= status < 600:
+        return status >= 500
+    if isinstance(e, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    return any(cls.__name__ in TRANSPORT_ERRORS for cls in type(e).__mro__)
+
+
+def record_call(health: Optional[ProviderHealth], model_name: str, task_name: str, start: float, result):
+    """Record a finished dispatch attempt, result is the response or the raised exception"""
+    if health is None:
+        return
+    if isinstance(result, APIKeyError):
+        ok = None
+    elif isinstance(result, Exception):
+        # Errors of the request or the key are neither a success nor a failure of the provider
+        ok = False if is_provider_failure(result) else None
+    else:
+        ok = True
+    health.record(model_name, task_name, ok, time.perf_counter() - start)
+
+
+def create_provider_health(config) -> Optional[ProviderHealth]:
+    if not config['BREAKER_ENABLED']:
+        return None
+    return ProviderHealth(window_seconds=config['BREAKER_WINDOW_SECONDS'], min_calls=config['BREAKER_MIN_CALLS'],
+                          error_rate=config['BREAKER_ERROR_RATE'], open_seconds=config['BREAKER_OPEN_SECONDS'],
+                          slow_call_seconds=config['BREAKER_SLOW_CALL_SECONDS'],
+                          latency_ratio=config['ROUTING_LATENCY_RATIO'])
@@ -0,0 +1,299 @@
+from types import SimpleNamespace
+from typing import Optional
+import asyncio
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from Exceptions import APIKeyError
+from conversation import CorrectionTurn
+
+# Record / replay of provider calls
+# With a cassette in use, every message a parser or reviewer sends goes through it: in record mode the provider is
+# called and its reply stored, in replay mode the stored reply is returned without any network. Replies are keyed
+# by a hash of the normalized conversation so far (provider, task, model, prompt version and every message, images
+# by the hash of their bytes), never by the API key, so a cassette recorded with one key replays with any key.
+# Cassettes are a single gzipped json file of replies and latencies, the requests themselves are not stored.
+# Modes: 'record' always calls the provider, 'replay' never does (a missing reply raises CassetteMiss), 'auto'
+# replays what is recorded and records the rest. Latency 'collapse' replays at once, 'preserve' sleeps as long as
+# the provider took, chunk by chunk for streams.
+
+CASSETTE_MODES = {'record', 'replay', 'auto'}
+LATENCY_MODES = {'preserve', 'collapse'}
+CASSETTE_VERSION = 1
+
+
+class CassetteMiss(Exception):
+    """Replay mode and no recorded reply for the request"""
+
+
+def _normalize(value):
+    """json compatible form of a message, stable across processes"""
+    if isinstance(value, (bytes, bytearray)):
+        return {'sha256': hashlib.sha256(value).hexdigest()}
+    if isinstance(value, str):
+        # Base64 data URLs of images (OpenAI) are as large as the image, only their hash matters
+        if value.startswith('data:') and len(value) > 256:
+            return {'sha256': hashlib.sha256(value.encode('utf-8')).hexdigest()}
+        return value
+    if isinstance(value, CorrectionTurn):
+        return {'correction': value.text}
+    if isinstance(value, dict):
+        return {str(key): _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if value is None or isinstance(value, (int, float, bool)):
+        return value
+    return repr(value)
+
+
+def _chain(previous: str, value) -> str:
+    canonical = json.dumps(_normalize(value), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(f"{previous}:{canonical}".encode('utf-8')).hexdigest()
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str = 'replay', latency: str = 'collapse'):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Unknown cassette mode '{mode}', expected one of {sorted(CASSETTE_MODES)}")
+        if latency not in LATENCY_MODES:
+            raise ValueError(f"Unknown cassette latency '{latency}', expected one of {sorted(LATENCY_MODES)}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                self.entries = json.load(f)['entries']
+
+    def conversation_key(self, handler) -> str:
+        """Start of the key chain of a conversation of handler"""
+        return _chain('', [handler.provider, handler.task_name, handler.model_name,
+                           getattr(handler, 'prompt_version', None)])
+
+    def lookup(self, key: str) -> Optional[dict]:
+        if self.mode == 'record':
+            return None
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+        if self.mode == 'replay':
+            raise CassetteMiss(f"No recorded reply in {self.path} for request {key[:12]}")
+        return None
+
+    def store(self, key: str, entry: dict):
+        with self._lock:
+            self.entries[key] = entry
+            self.recorded += 1
+            data = json.dumps({'version': CASSETTE_VERSION, 'entries': self.entries}, separators=(',', ':'))
+        # Written after every reply, so an interrupted recording keeps what it has
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(gzip.compress(data.encode('utf-8'), mtime=0))
+            # mkstemp creates it private, cassettes are meant to be committed with the tests
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def delay(self, entry: dict) -> float:
+        return entry['seconds'] if self.latency == 'preserve' else 0.0
+
+    def stats(self):
+        with self._lock:
+            return {'mode': self.mode, 'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'recorded': self.recorded}
+
+
+_active = None
+
+
+def get_cassette() -> Optional[Cassette]:
+    return _active
+
+
+def set_cassette(cassette: Optional[Cassette]):
+    """Use the cassette for every provider call of the process, None stops using it"""
+    global _active
+    _active = cassette
+
+
+@contextlib.contextmanager
+def use_cassette(path: str, mode: str = 'replay', latency: str = 'collapse'):
+    previous = get_cassette()
+    cassette = Cassette(path, mode, latency)
+    set_cassette(cassette)
+    try:
+        yield cassette
+    finally:
+        set_cassette(previous)
+
+
+def configure_cassette(config) -> Optional[Cassette]:
+    """Cassette of the CASSETTE_* config, None when it is off"""
+    mode = (config['CASSETTE_MODE'] or 'off').lower()
+    if mode == 'off':
+        return None
+    cassette = Cassette(config['CASSETTE_PATH'], mode, config['CASSETTE_LATENCY'].lower())
+    set_cassette(cassette)
+    return cassette
+
+
+def _replay(entry: dict):
+    if entry.get('error') == 'api_key':
+        raise APIKeyError()
+    return entry['response_text'], entry['total_tokens']
+
+
+def recorded(handler, send_message):
+    """send_message of handler through the active cassette, one call per conversation"""
+    cassette = get_cassette()
+    if cassette is None:
+        return send_message
+    key = cassette.conversation_key(handler)
+
+    def send(message):
+        nonlocal key
+        key = _chain(key, message)
+        entry = cassette.lookup(key)
+        if entry is not None:
+            time.sleep(cassette.delay(entry))
+            return _replay(entry)
+        start = time.perf_counter()
+        try:
+            response_text, total_tokens = send_message(message)
+        except APIKeyError:
+            cassette.store(key, {'error': 'api_key', 'seconds': time.perf_counter() - start})
+            raise
+        cassette.store(key, {'response_text': response_text, 'total_tokens': total_tokens,
+                             'seconds': time.perf_counter() - start})
+        return response_text, total_tokens
+    return send
+
+
+def recorded_async(handler, send_message_async):
+    """Same as recorded, for send_message_async"""
+    cassette = get_cassette()
+    if cassette is None:
+        return send_message_async
+    key = cassette.conversation_key(handler)
+
+    async def send(message):
+        nonlocal key
+        key = _chain(key, message)
+        entry = cassette.lookup(key)
+        if entry is not None:
+            await asyncio.sleep(cassette.delay(entry))
+            return _replay(entry)
+        start = time.perf_counter()
+        try:
+            response_text, total_tokens = await send_message_async(message)
+        except APIKeyError:
+            cassette.store(key, {'error': 'api_key', 'seconds': time.perf_counter() - start})
+            raise
+        cassette.store(key, {'response_text': response_text, 'total_tokens': total_tokens,
+                             'seconds': time.perf_counter() - start})
+        return response_text, total_tokens
+    return send
+
+
+def _stream_key(cassette: Cassette, handler, message) -> str:
+    # Streams have their own keys, a streamed reply is stored as chunks
+    return _chain(_chain(cassette.conversation_key(handler), 'stream'), message)
+
+
+def recorded_stream(handler, stream_message):
+    """stream_message of handler through the active cassette, chunks are stored with the delay before each"""
+    cassette = get_cassette()
+    if cassette is None:
+        return stream_message
+
+    def stream(message):
+        key = _stream_key(cassette, handler, message)
+        entry = cassette.lookup(key)
+        if entry is not None:
+            if entry.get('error') == 'api_key':
+                raise APIKeyError()
+            for delay, chunk in entry['chunks']:
+                time.sleep(delay if cassette.latency == 'preserve' else 0.0)
+                yield chunk
+            return
+        chunks = []
+        start = last = time.perf_counter()
+        try:
+            for chunk in stream_message(message):
+                now = time.perf_counter()
+                chunks.append([now - last, chunk])
+                last = now
+                yield chunk
+        except APIKeyError:
+            cassette.store(key, {'error': 'api_key', 'seconds': time.perf_counter() - start})
+            raise
+        cassette.store(key, {'chunks': chunks, 'seconds': time.perf_counter() - start})
+    return stream
+
+
+def recorded_stream_async(handler, stream_message_async):
+    """Same as recorded_stream, for stream_message_async"""
+    cassette = get_cassette()
+    if cassette is None:
+        return stream_message_async
+
+    async def stream(message):
+        key = _stream_key(cassette, handler, message)
+        entry = cassette.lookup(key)
+        if entry is not None:
+            if entry.get('error') == 'api_key':
+                raise APIKeyError()
+            for delay, chunk in entry['chunks']:
+                await asyncio.sleep(delay if cassette.latency == 'preserve' else 0.0)
+                yield chunk
+            return
+        chunks = []
+        start = last = time.perf_counter()
+        try:
+            async for chunk in stream_message_async(message):
+                now = time.perf_counter()
+                chunks.append([now - last, chunk])
+                last = now
+                yield chunk
+        except APIKeyError:
+            cassette.store(key, {'error': 'api_key', 'seconds': time.perf_counter() - start})
+            raise
+        cassette.store(key, {'chunks': chunks, 'seconds': time.perf_counter() - start})
+    return stream
+
+
+def recorded_model_info(model_name: str, fetch):
+    """Model info of the Gemini model, only its input_token_limit is recorded"""
+    cassette = get_cassette()
+    if cassette is None:
+        return fetch()
+    key = _chain('model_info', model_name)
+    entry = cassette.lookup(key)
+    if entry is not None:
+        if entry.get('error') == 'api_key':
+            raise APIKeyError()
+        return SimpleNamespace(name=model_name, input_token_limit=entry['input_token_limit'])
+    try:
+        model_info = fetch()
+    except APIKeyError:
+        cassette.store(key, {'error': 'api_key', 'seconds': 0.0})
+        raise
+    cassette.store(key, {'input_token_limit': model_info.input_token_limit, 'seconds': 0.0})
+    return model_info
@@ -0,0 +1,68 @@
+import asyncio
+
+
+class CorrectionTurn:
+    """Text only retry turn, sent as a standalone request without the images and the earlier turns"""
+    def __init__(self, text: str):
+        self.text = text
+
+    def __eq__(self, other):
+        return isinstance(other, CorrectionTurn) and other.text == self.text
+
+    def __repr__(self):
+        return f"CorrectionTurn({self.text!r})"
+
+
+class TokenBudget:
+    """Tokens a conversation may spend on retries, based on the usage the provider reported"""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.spent = 0
+
+    def spend(self, tokens: int):
+        self.spent += tokens
+
+    def can_afford(self, tokens: int) -> bool:
+        return self.spent + tokens <= self.limit
+
+
+def run_conversation(steps, send_message, cancel_event=None):
+    """Drive a conversation generator
+
+    The generator yields each message to send and receives the reply from send_message, its return value is the
+    result of the conversation. Keeping the retry logic in a generator lets the sync and async paths share it.
+    If cancel_event is set, the conversation stops before the next message and returns None.
+    """
+    try:
+        message = next(steps)
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                steps.close()
+                return None
+            message = steps.send(send_message(message))
+    except StopIteration as stop:
+        return stop.value
+
+
+def _first_step(steps):
+    """(done, first message or the result), a StopIteration cannot be raised out of a thread into a future"""
+    try:
+        return False, next(steps)
+    except StopIteration as stop:
+        return True, stop.value
+
+
+async def run_conversation_async(steps, send_message_async):
+    """Same as run_conversation, but awaits each reply, cancel the awaiting task to stop it
+
+    The first message carries the page images, it is built in a thread since resizing and encoding them would
+    block the event loop. The retry turns are text only and built on the loop.
+    """
+    done, message = await asyncio.to_thread(_first_step, steps)
+    if done:
+        return message
+    try:
+        while True:
+            message = steps.send(await send_message_async(message))
+    except StopIteration as stop:
+        return stop.value
@@ -1,13 +1,22 @@
 # from werkzeug.datastructures import FileStorage
 # import typing_extensions
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
-import json
-from Receipt import Receipt, ReceiptError, Category
+import threading
+from Receipt import Category
 from Exceptions import APIKeyError
-from google.api_core.exceptions import InvalidArgument
+# BadRequest, so the InvalidArgument of gRPC and the plain 400 of the REST transport are both caught
+from google.api_core.exceptions import BadRequest
 from ReceiptParser import AbstractParser
 from ReceiptReview import AbstractReview
+from ClientRegistry import ClientRegistry, schedule_async_close
+from Config import Config
+from preprocess import ImagePreprocessor, gemini_image_tokens
+from metrics import time_llm_call, record_tokens
+from tokens import estimate_gemini_tokens
+from conversation import CorrectionTurn
+from cassette import recorded_model_info
 
 
 # Define the template of the return json obj
@@ -26,8 +35,235 @@ from ReceiptReview import AbstractReview
 #     itemized_list: list[LineItemSchema]
 
 
-class GeminiReceiptParser(AbstractParser):
-    def __init__(self, api_key: str, model_version: str = 'models/gemini-1.5-flash'):
+def client_options(api_key: str) -> dict:
+    options = {'api_key': api_key}
+    # Another server than Google's, e.g. the mock provider of the benchmarks
+    if Config.GEMINI_API_ENDPOINT:
+        options['api_endpoint'] = Config.GEMINI_API_ENDPOINT
+    return options
+
+
+def bind_client(model: genai.GenerativeModel, attribute: str, client):
+    """Make a model handle send its requests through client
+
+    GenerativeModel takes no client argument, so its private client attribute is set. google-generativeai is pinned
+    in the Dockerfile; if a new version renames the attribute, fail instead of silently falling back to the
+    process wide default client.
+    """
+    if attribute not in vars(model):
+        raise RuntimeError(f"google-generativeai {genai.__version__} has no GenerativeModel.{attribute}, "
+                           f"update bind_client for this version")
+    setattr(model, attribute, client)
+
+
+class GeminiClients:
+    """Gemini clients and model handles bound to a single API key"""
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        # Clients are created per key instead of using genai.configure, which is global to the process
+        self.generative_client = glm.GenerativeServiceClient(client_options=client_options(api_key),
+                                                             transport=Config.GEMINI_TRANSPORT)
+        self.model_client = glm.ModelServiceClient(client_options=client_options(api_key),
+                                                   transport=Config.GEMINI_TRANSPORT)
+        # Created on first async use, grpc asyncio channels must be created inside the event loop
+        self.generative_async_client = None
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get_generative_async_client(self):
+        with self._lock:
+            if self.generative_async_client is None:
+                # Only grpc_asyncio exists for the async client, GEMINI_TRANSPORT does not apply
+                self.generative_async_client = glm.GenerativeServiceAsyncClient(
+                    client_options=client_options(self.api_key))
+            return self.generative_async_client
+
+    def get_model(self, key, factory) -> genai.GenerativeModel:
+        # Model handles only hold config, so they can be shared by concurrent chats
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = factory()
+                bind_client(model, '_client', self.generative_client)
+                self._models[key] = model
+            return model
+
+    def close(self):
+        self.generative_client.transport.close()
+        self.model_client.transport.close()
+        if self.generative_async_client is not None:
+            schedule_async_close(self.generative_async_client.transport.close())
+
+
+gemini_clients = ClientRegistry(factory=GeminiClients, max_size=Config.CLIENT_REGISTRY_MAX_SIZE,
+                                idle_ttl=Config.CLIENT_REGISTRY_IDLE_TTL, close=GeminiClients.close)
+
+# Model metadata (e.g. input_token_limit) does not depend on the API key, fetch it once per model name
+_model_info_cache = {}
+_model_info_lock = threading.Lock()
+
+
+def get_model_info(clients: GeminiClients, model_name: str):
+    # Recorded like the provider calls, so a replayed handler is built without any request
+    return recorded_model_info(model_name, lambda: fetch_model_info(clients, model_name))
+
+
+def fetch_model_info(clients: GeminiClients, model_name: str):
+    with _model_info_lock:
+        model_info = _model_info_cache.get(model_name)
+    if model_info is None:
+        try:
+            model_info = genai.get_model(model_name, client=clients.model_client)
+        except BadRequest as e:
+            raise_if_api_key_error(e, clients.api_key)
+            raise
+        with _model_info_lock:
+            _model_info_cache[model_name] = model_info
+    return model_info
+
+
+def chunk_text(chunk) -> str:
+    # The last chunk of a stream may only carry the finish reason and usage, .text raises for it
+    try:
+        return chunk.text
+    except ValueError:
+        return ''
+
+
+def describe_message(message) -> str:
+    """Part types and sizes of a message for the logs, image parts carry the raw image bytes"""
+    if isinstance(message, CorrectionTurn):
+        return f"correction ({len(message.text)} chars)"
+    parts = message if isinstance(message, list) else [message]
+    described = []
+    for part in parts:
+        if isinstance(part, dict) and 'data' in part:
+            described.append(f"{part['mime_type']} ({len(part['data'])} bytes)")
+        elif isinstance(part, str):
+            described.append(f"text ({len(part)} chars)")
+        else:
+            described.append(type(part).__name__)
+    return ', '.join(described)
+
+
+def raise_if_api_key_error(e: BadRequest, api_key: str):
+    if e.code == 400 and "API key not valid" in str(e):
+        # A rejected key's clients are never used again, free their registry slot
+        gemini_clients.discard(api_key)
+        raise APIKeyError()
+
+
+gemini_preprocessor = ImagePreprocessor('GEMINI', gemini_image_tokens, max_dimension=Config.GEMINI_IMAGE_MAX_DIMENSION,
+                                        image_format=Config.IMAGE_FORMAT, quality=Config.IMAGE_QUALITY)
+
+
+class GeminiChatMixin:
+    """Sends the turns of a parser or reviewer conversation through a Gemini chat session"""
+    provider = 'GEMINI'
+
+    def build_retry_message(self, error_msg: str):
+        return [error_msg]
+
+    def send_message(self, message):
+        print(f"Sending {describe_message(message)}")
+        if isinstance(message, CorrectionTurn):
+            return self.send_correction(message)
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                self.response = self.chat_instance.send_message(message,
+                                                                generation_config=self.generation_config,
+                                                                safety_settings=self.safety_settings)
+        except BadRequest as e:
+            # Model info is cached, so an invalid key is only detected here
+            raise_if_api_key_error(e, self.api_key)
+            raise
+        return self.handle_response()
+
+    async def send_message_async(self, message):
+        print(f"Sending {describe_message(message)}")
+        self.set_async_client()
+        if isinstance(message, CorrectionTurn):
+            return await self.send_correction_async(message)
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                self.response = await self.chat_instance.send_message_async(
+                    message, generation_config=self.generation_config, safety_settings=self.safety_settings)
+        except BadRequest as e:
+            raise_if_api_key_error(e, self.api_key)
+            raise
+        return self.handle_response()
+
+    def set_async_client(self):
+        if getattr(self.model, '_async_client', None) is None:
+            bind_client(self.model, '_async_client', self.clients.get_generative_async_client())
+
+    def stream_message(self, message):
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                self.response = self.chat_instance.send_message(message, stream=True,
+                                                                generation_config=self.generation_config,
+                                                                safety_settings=self.safety_settings)
+                for chunk in self.response:
+                    yield chunk_text(chunk)
+        except BadRequest as e:
+            raise_if_api_key_error(e, self.api_key)
+            raise
+        self.handle_response()
+
+    async def stream_message_async(self, message):
+        self.set_async_client()
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                self.response = await self.chat_instance.send_message_async(
+                    message, stream=True, generation_config=self.generation_config,
+                    safety_settings=self.safety_settings)
+                async for chunk in self.response:
+                    yield chunk_text(chunk)
+        except BadRequest as e:
+            raise_if_api_key_error(e, self.api_key)
+            raise
+        self.handle_response()
+
+    def send_correction(self, turn: CorrectionTurn):
+        # Outside the chat, so the images and earlier turns are not sent again
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                self.response = self.model.generate_content(turn.text, generation_config=self.correction_config,
+                                                            safety_settings=self.safety_settings)
+        except BadRequest as e:
+            raise_if_api_key_error(e, self.api_key)
+            raise
+        return self.handle_response()
+
+    async def send_correction_async(self, turn: CorrectionTurn):
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                self.response = await self.model.generate_content_async(
+                    turn.text, generation_config=self.correction_config, safety_settings=self.safety_settings)
+        except BadRequest as e:
+            raise_if_api_key_error(e, self.api_key)
+            raise
+        return self.handle_response()
+
+    def handle_response(self):
+        usage = self.response.usage_metadata
+        record_tokens(self.provider, self.task_name, usage.prompt_token_count, usage.candidates_token_count,
+                      usage.cached_content_token_count)
+        return self.response.text, usage.total_token_count
+
+    def get_input_token_limit(self) -> int:
+        return self.model_info.input_token_limit
+
+    def get_token_count(self, prompt):
+        # Local estimate, count_tokens would be an API request inside the retry loop
+        return estimate_gemini_tokens(prompt)
+
+
+class GeminiReceiptParser(GeminiChatMixin, AbstractParser):
+    default_model_version = 'models/gemini-1.5-flash'
+    preprocessor = gemini_preprocessor
+
+    def __init__(self, api_key: str, model_version: str = default_model_version):
         # Method 2
         receipt_schema = genai.protos.Schema(
             type=genai.protos.Type.OBJECT,
@@ -55,8 +291,6 @@ class GeminiReceiptParser(AbstractParser):
         )
         # Call the parent class constructor
         super().__init__(api_key=api_key, receipt_schema=receipt_schema, model_name=model_version)
-        # Configure the API key
-        genai.configure(api_key=self.api_key)
         # Setup model config
         # Chat instance attributes
         self.response = None
@@ -72,6 +306,15 @@ class GeminiReceiptParser(AbstractParser):
                 response_mime_type="application/json", # Output in json
                 response_schema=self.receipt_schema, # Also follow json schema
         )
+        # Corrections only return the fixed fields, so the receipt schema does not apply
+        self.correction_config = genai.types.GenerationConfig(
+                candidate_count=1,
+                max_output_tokens=self.buffer,
+                temperature=0.1,
+                top_p=0.1,
+                top_k=1,
+                response_mime_type="application/json",
+        )
         # Turn off safety settings to ensure explicit shop names or line items can be parsed
         self.safety_settings = {
                 HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
@@ -80,63 +323,32 @@ class GeminiReceiptParser(AbstractParser):
                 HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
         }
 
-        # Init the model
-        self.model = genai.GenerativeModel(model_name=self.model_name, system_instruction=self.system_instruction,
-                                           generation_config=self.generation_config, safety_settings=self.safety_settings)
-        try:
-            self.model_info = genai.get_model(self.model_name)
-        except InvalidArgument as e:
-            if e.code == 400 and "API key not valid" in str(e):
-                raise APIKeyError()
+        # Reuse the model handle and model info, only the chat is per request
+        self.clients = gemini_clients.get(self.api_key)
+        self.model = self.clients.get_model(
+            (type(self).__name__, self.model_name),
+            lambda: genai.GenerativeModel(model_name=self.model_name, system_instruction=self.system_instruction,
+                                          generation_config=self.generation_config,
+                                          safety_settings=self.safety_settings))
+        self.model_info = get_model_info(self.clients, self.model_name)
 
         # Init chat instance
         self.chat_instance = self.model.start_chat(history=[], enable_automatic_function_calling=False)
 
-    def get_token_count(self, prompt):
-            return int(self.model.count_tokens(prompt).total_tokens)
-
-    def parse(self, receipt_obj_list):
-        messages = [[self.initial_prompt, *receipt_obj_list]]
-
-        for attempt_num in range(self.max_retry):
-            # Generate the receipt
-            print(messages[-1])
-            self.response = self.chat_instance.send_message(messages[-1],
-                                                       generation_config=self.generation_config,
-                                                       safety_settings=self.safety_settings)
-
-            # Attempt to parse the receipt
-            try:
-                receipt_dict = json.loads(self.response.text)
+    def build_initial_message(self, receipt_obj_list):
+        # The static prompt goes first so the request prefix never changes
+        return [self.initial_prompt, *self.build_receipt_parts(receipt_obj_list)]
 
-                # If model returns None for all fields, return None
-                if receipt_dict['category'] == Category.INVALID.value:
-                    print("Image is not a receipt.")
-                    return None
+    def build_text_part(self, text: str):
+        return text
 
-                receipt_instance = Receipt(**receipt_dict)
-                print(f"Attempt {attempt_num + 1} Success")
+    def build_image_part(self, img, thumbnail: bool = False):
+        # Send encoded bytes instead of PIL images, so the size and quality are ours instead of the SDK's
+        mime_type, data = self.preprocessor.encode(img)
+        return {'mime_type': mime_type, 'data': data}
 
-                return receipt_instance
-            except ReceiptError as e:
-                print(f"Attempt {attempt_num + 1} Error: {e}")
 
-                # If max retry reached or token limit reached, return None
-                if (attempt_num + 1 == self.max_retry or
-                        self.response.usage_metadata.total_token_count +
-                        self.get_token_count(str(e)) + self.buffer >
-                        self.model_info.input_token_limit):
-                    print("Max retry reached. Unable to parse receipt.")
-                    return None
-
-                # Still have retries left, retry
-                messages.append([str(e)])
-                continue
-
-        return None
-
-
-class GeminiReceiptReview(AbstractReview):
+class GeminiReceiptReview(GeminiChatMixin, AbstractReview):
     def __init__(self, api_key: str, model_version: str = 'models/gemini-1.5-flash'):
         # Method 2
         review_schema = genai.protos.Schema(
@@ -149,8 +361,6 @@ class GeminiReceiptReview(AbstractReview):
         )
         # Call the parent class constructor
         super().__init__(api_key=api_key, review_schema=review_schema, model_name=model_version)
-        # Configure the API key
-        genai.configure(api_key=self.api_key)
         # Setup model config
         # Chat instance attributes
         self.response = None
@@ -174,46 +384,17 @@ class GeminiReceiptReview(AbstractReview):
             HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
         }
 
-        # Init the model
-        self.model = genai.GenerativeModel(model_name=self.model_name, system_instruction=self.system_instruction,
-                                           generation_config=self.generation_config,
-                                           safety_settings=self.safety_settings)
-        try:
-            self.model_info = genai.get_model(self.model_name)
-        except InvalidArgument as e:
-            if e.code == 400 and "API key not valid" in str(e):
-                raise APIKeyError()
+        # Reuse the model handle and model info, only the chat is per request
+        self.clients = gemini_clients.get(self.api_key)
+        self.model = self.clients.get_model(
+            (type(self).__name__, self.model_name),
+            lambda: genai.GenerativeModel(model_name=self.model_name, system_instruction=self.system_instruction,
+                                          generation_config=self.generation_config,
+                                          safety_settings=self.safety_settings))
+        self.model_info = get_model_info(self.clients, self.model_name)
 
         # Init chat instance
         self.chat_instance = self.model.start_chat(history=[], enable_automatic_function_calling=False)
 
-    def review(self, receipt_str, query):
-        messages = [[self.initial_prompt, receipt_str, query]]
-
-        for attempt_num in range(self.max_retry):
-            # Generate the receipt
-            print(messages[-1])
-            self.response = self.chat_instance.send_message(messages[-1],
-                                                       generation_config=self.generation_config,
-                                                       safety_settings=self.safety_settings)
-
-            # Attempt to parse review response
-            review_dict = json.loads(self.response.text)
-
-            # If model unable to generate review
-            if not review_dict['status']:
-                if (attempt_num + 1 == self.max_retry or
-                        self.response.usage_metadata.total_token_count +
-                        self.get_token_count(self.error_response) + self.buffer >
-                        self.model_info.input_token_limit):
-                    return None
-                # Still have retries left, retry
-                messages.append(self.error_response)
-                continue
-            else:
-                print(f"Attempt {attempt_num + 1} Success")
-                return review_dict['insights']
-        return None
-
-    def get_token_count(self, prompt):
-            return int(self.model.count_tokens(prompt).total_tokens)
\ No newline at end of file
+    def build_initial_message(self, receipt_str, query):
+        return [self.initial_prompt, receipt_str, query]
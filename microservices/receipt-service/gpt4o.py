@@ -1,18 +1,198 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from pydantic import BaseModel
 from typing import Optional
-from Receipt import Receipt, ReceiptError, Category
+from Receipt import Category
 from Exceptions import APIKeyError
-import json
-import tiktoken
-import base64
-from io import BytesIO
 from openai import AuthenticationError
 from ReceiptParser import AbstractParser
 from ReceiptReview import AbstractReview
+from ClientRegistry import ClientRegistry, schedule_async_close
+from Config import Config
+from preprocess import ImagePreprocessor, openai_image_tokens
+from metrics import time_llm_call, record_tokens
+from conversation import CorrectionTurn
+from tokens import count_openai_tokens
+
+
+# One client per API key, reusing its HTTP connection pool across requests
+# base_url None is the SDK default, api.openai.com or the OPENAI_BASE_URL environment variable
+openai_clients = ClientRegistry(factory=lambda api_key: OpenAI(api_key=api_key, base_url=Config.OPENAI_BASE_URL,
+                                                               max_retries=2, timeout=60.0),
+                                max_size=Config.CLIENT_REGISTRY_MAX_SIZE, idle_ttl=Config.CLIENT_REGISTRY_IDLE_TTL,
+                                close=lambda client: client.close())
+# Async clients are only used by the async service
+openai_async_clients = ClientRegistry(factory=lambda api_key: AsyncOpenAI(api_key=api_key,
+                                                                          base_url=Config.OPENAI_BASE_URL,
+                                                                          max_retries=2, timeout=60.0),
+                                      max_size=Config.CLIENT_REGISTRY_MAX_SIZE,
+                                      idle_ttl=Config.CLIENT_REGISTRY_IDLE_TTL,
+                                      close=lambda client: schedule_async_close(client.close()))
+
+
+def reject_api_key(api_key: str) -> APIKeyError:
+    """Drop the clients of a key the API rejected, it is never used again"""
+    openai_clients.discard(api_key)
+    openai_async_clients.discard(api_key)
+    return APIKeyError()
+
+
+# (base, per 512px tile) image tokens for detail high images, gpt-4o-mini bills images at a higher token rate
+IMAGE_TOKEN_COSTS = {
+    'gpt-4o-mini': (2833, 5667),
+    'gpt-4o': (85, 170),
+    'gpt-4-turbo': (85, 170),
+}
+
+
+def cached_prompt_tokens(usage) -> int:
+    """Prompt tokens the API served from its prefix cache"""
+    # prompt_tokens_details is newer than this SDK, so it is only an extra field of the usage model
+    details = getattr(usage, 'prompt_tokens_details', None)
+    if isinstance(details, dict):
+        return details.get('cached_tokens') or 0
+    return getattr(details, 'cached_tokens', None) or 0
+
+
+class OpenAIChatMixin:
+    """Sends the turns of a parser or reviewer conversation through the chat completions API"""
+    provider = 'OPENAI'
+
+    def build_retry_message(self, error_msg: str):
+        return error_msg
+
+    def send_message(self, message):
+        if isinstance(message, CorrectionTurn):
+            return self.send_correction(message)
+        self.append_message("user", message)
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                response = self.client.beta.chat.completions.parse(
+                    model=self.model_name,
+                    messages=self.messages,
+                    **self.generation_config
+                )
+        except AuthenticationError:
+            # Exit out to receipt service
+            raise reject_api_key(self.api_key)
+        return self.handle_response(response)
+
+    async def send_message_async(self, message):
+        if isinstance(message, CorrectionTurn):
+            return await self.send_correction_async(message)
+        self.append_message("user", message)
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                response = await openai_async_clients.get(self.api_key).beta.chat.completions.parse(
+                    model=self.model_name,
+                    messages=self.messages,
+                    **self.generation_config
+                )
+        except AuthenticationError:
+            raise reject_api_key(self.api_key)
+        return self.handle_response(response)
+
+    def send_correction(self, turn: CorrectionTurn):
+        # Standalone request, so the images and earlier turns are not sent again
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                response = self.client.chat.completions.create(model=self.model_name,
+                                                               messages=self.correction_messages(turn),
+                                                               **self.correction_config)
+        except AuthenticationError:
+            raise reject_api_key(self.api_key)
+        return self.handle_correction_response(response)
+
+    async def send_correction_async(self, turn: CorrectionTurn):
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                response = await openai_async_clients.get(self.api_key).chat.completions.create(
+                    model=self.model_name, messages=self.correction_messages(turn), **self.correction_config)
+        except AuthenticationError:
+            raise reject_api_key(self.api_key)
+        return self.handle_correction_response(response)
+
+    def stream_message(self, message):
+        self.append_message("user", message)
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                with self.client.beta.chat.completions.stream(model=self.model_name, messages=self.messages,
+                                                              stream_options={'include_usage': True},
+                                                              **self.generation_config) as stream:
+                    for event in stream:
+                        if event.type == 'content.delta':
+                            yield event.delta
+                    completion = stream.get_final_completion()
+        except AuthenticationError:
+            raise reject_api_key(self.api_key)
+        self.handle_stream_completion(completion)
+
+    async def stream_message_async(self, message):
+        self.append_message("user", message)
+        try:
+            with time_llm_call(self.provider, self.task_name):
+                async with openai_async_clients.get(self.api_key).beta.chat.completions.stream(
+                        model=self.model_name, messages=self.messages, stream_options={'include_usage': True},
+                        **self.generation_config) as stream:
+                    async for event in stream:
+                        if event.type == 'content.delta':
+                            yield event.delta
+                    completion = await stream.get_final_completion()
+        except AuthenticationError:
+            raise reject_api_key(self.api_key)
+        self.handle_stream_completion(completion)
+
+    def handle_stream_completion(self, completion):
+        self.append_message("assistant", completion.choices[0].message.content)
+        # Only reported on the last chunk, with stream_options include_usage
+        if completion.usage is not None:
+            self.record_usage(completion.usage)
+
+    def record_usage(self, usage):
+        record_tokens(self.provider, self.task_name, usage.prompt_tokens, usage.completion_tokens,
+                      cached_prompt_tokens(usage))
+
+    def correction_messages(self, turn: CorrectionTurn):
+        return [{"role": "system", "content": self.system_instruction}, {"role": "user", "content": turn.text}]
+
+    def handle_correction_response(self, response):
+        self.record_usage(response.usage)
+        return response.choices[0].message.content, response.usage.total_tokens
+
+    def handle_response(self, response):
+        # Append response to messages
+        response_content = response.choices[0].message.content
+        self.append_message("assistant", response_content)
+        self.record_usage(response.usage)
+        return response_content, response.usage.total_tokens
+
+    def get_input_token_limit(self) -> int:
+        return self.get_token_limit(self.model_name)
 
-class OpenAIReceiptParser(AbstractParser):
-    def __init__(self, api_key, model_version: str = 'gpt-4o-mini'):
+    @staticmethod
+    def get_token_limit(model_version: str) -> int:
+        # Only include vision models
+        mapper_dict = {
+            'gpt-4o-mini': 128000,
+            'gpt-4o': 128000,
+            'gpt-4-turbo': 128000,
+        }
+        return mapper_dict[model_version]
+
+    def get_token_count(self, prompt: str) -> int:
+        # Encoder is loaded once per process, not on every count
+        return count_openai_tokens(prompt, self.model_name)
+
+    def append_message(self, role, content):
+        if role not in ["user", "system", "assistant"]:
+            raise ValueError("Role must be one of 'user', 'system', or 'assistant'")
+
+        self.messages.append({"role": role, "content": content})
+
+
+class OpenAIReceiptParser(OpenAIChatMixin, AbstractParser):
+    default_model_version = 'gpt-4o-mini'
+
+    def __init__(self, api_key, model_version: str = default_model_version):
         # Response schema
         class LineItemSchema(BaseModel):
             item_name: str
@@ -26,9 +206,14 @@ class OpenAIReceiptParser(AbstractParser):
             date: str
             itemized_list: Optional[list[LineItemSchema]]
         super().__init__(api_key=api_key, receipt_schema=ReceiptResponseSchema, model_name=model_version)
-        self.client = OpenAI(api_key=self.api_key, max_retries=2, timeout=60.0)
+        self.client = openai_clients.get(self.api_key)
         # Chat session specific attributes
         self.messages = []
+        base_tokens, tile_tokens = IMAGE_TOKEN_COSTS.get(self.model_name, (85, 170))
+        self.preprocessor = ImagePreprocessor(
+            'OPENAI', lambda size: openai_image_tokens(size, base_tokens, tile_tokens),
+            max_dimension=Config.OPENAI_IMAGE_MAX_DIMENSION, max_short_side=Config.OPENAI_IMAGE_MAX_SHORT_SIDE,
+            image_format=Config.IMAGE_FORMAT, quality=Config.IMAGE_QUALITY)
 
         # Generation config
         self.generation_config = {
@@ -38,97 +223,39 @@ class OpenAIReceiptParser(AbstractParser):
             'top_p': 0.1, # Low top_p to because OCR is deterministic
             'response_format': self.receipt_schema, # Define the schema of the response
         }
+        # Corrections only return the fixed fields, so the receipt schema does not apply
+        self.correction_config = {
+            'n': 1,
+            'max_tokens': self.buffer,
+            'temperature': 0.1,
+            'top_p': 0.1,
+            'response_format': {'type': 'json_object'},
+        }
 
-    def parse(self, img_list):
-        # Convert to base64 first
-        img_b64_list = []
-        for img in img_list:
-            img_b64_list.append(self.encode_img(img))
-
+    def build_initial_message(self, img_list):
         # Add system instruction
         self.append_message("system", self.system_instruction)
         # Combine user prompt and image
-        combined_prompt = [
+        return [
             {"type": "text", "text": self.initial_prompt},
-            *[{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}", "detail": "high"}} for img_b64 in img_b64_list]
+            *self.build_receipt_parts(img_list)
         ]
-        # Add user request and image
-        self.append_message("user", combined_prompt)
-
-        for attempt_num in range(self.max_retry):
-            # Send the request
-            try:
-                response = self.client.beta.chat.completions.parse(
-                    model=self.model_name,
-                    messages=self.messages,
-                    **self.generation_config
-                )
-            except AuthenticationError:
-                # Exit out to receipt service
-                raise APIKeyError()
-
-            # Append response to messages
-            response_content = response.choices[0].message.content
-            self.append_message("assistant", response_content)
-
-            try:
-                # Parse json response
-                receipt_dict = json.loads(response_content)
-
-                # If model returns invalid category, return None
-                if receipt_dict['category'] == Category.INVALID.value:
-                    print("Image is not a receipt.")
-                    return None
-
-                receipt_instance = Receipt(**receipt_dict)
-                print(f"Attempt {attempt_num + 1} Success")
-                return receipt_instance
-            except ReceiptError as e:
-                print(f"Attempt {attempt_num + 1} Error: {e}")
-
-                # If max retry reached or token limit reached, return None
-                if (attempt_num + 1 == self.max_retry or
-                        response.usage.total_tokens + self.get_token_count(str(e)) +
-                        self.buffer > self.get_token_limit(self.model_name)):
-                    print("Max retry reached. Unable to parse receipt.")
-                    return None
-
-                # Continue the conversation, highlighting the error
-                self.append_message("user", str(e))
-
-        return None
-
-    @staticmethod
-    def get_token_limit(model_version: str) -> int:
-        # Only include vision models
-        mapper_dict = {
-            'gpt-4o-mini': 128000,
-            'gpt-4o': 128000,
-            'gpt-4-turbo': 128000,
-        }
-        return mapper_dict[model_version]
 
-    def get_token_count(self, prompt: str) -> int:
-        encoding = tiktoken.encoding_for_model(self.model_name)
-        num_tokens = len(encoding.encode(prompt))
-        return num_tokens
+    def build_text_part(self, text: str):
+        return {"type": "text", "text": text}
 
-    def append_message(self, role, content):
-        if role not in ["user", "system", "assistant"]:
-            raise ValueError("Role must be one of 'user', 'system', or 'assistant'")
-
-        self.messages.append({"role": role, "content": content})
+    def build_image_part(self, img, thumbnail: bool = False):
+        # A thumbnail only backs up the OCR text, detail low bills it at the base tokens only
+        mime_type, img_b64 = self.encode_img(img)
+        return {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{img_b64}",
+                                                   "detail": "low" if thumbnail else "high"}}
 
-    @staticmethod
-    def encode_img(img):
-        buffer = BytesIO()
-        img.save(buffer, format="JPEG")
-        buffer.seek(0)
-        image_b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        return image_b64
+    def encode_img(self, img):
+        # Downscaled to what OpenAI would keep of the image anyway
+        return self.preprocessor.encode_b64(img)
 
 
-class OpenAIReceiptReview(AbstractReview):
+class OpenAIReceiptReview(OpenAIChatMixin, AbstractReview):
     def __init__(self, api_key, model_version: str = 'gpt-4o-mini'):
         # Response schema
         class ReceiptReviewSchema(BaseModel):
@@ -136,7 +263,7 @@ class OpenAIReceiptReview(AbstractReview):
             insights: str
 
         super().__init__(api_key=api_key, review_schema=ReceiptReviewSchema, model_name=model_version)
-        self.client = OpenAI(api_key=self.api_key, max_retries=2, timeout=60.0)
+        self.client = openai_clients.get(self.api_key)
         # Chat session specific attributes
         self.messages = []
 
@@ -149,69 +276,12 @@ class OpenAIReceiptReview(AbstractReview):
             'response_format': self.review_schema, # Define the schema of the response
         }
 
-    def review(self, receipt_str, query):
+    def build_initial_message(self, receipt_str, query):
         # Add system instruction
         self.append_message("system", self.system_instruction)
-        # Combine user prompt and image
-        combined_prompt = [
+        # Combine user prompt and their spending data
+        return [
             {"type": "text", "text": self.initial_prompt},
             {"type": "text", "text": receipt_str},
             {"type": "text", "text": query}
         ]
-        # Add user request and their spending data
-        self.append_message("user", combined_prompt)
-
-        for attempt_num in range(self.max_retry):
-            # Send the request
-            try:
-                response = self.client.beta.chat.completions.parse(
-                    model=self.model_name,
-                    messages=self.messages,
-                    **self.generation_config
-                )
-            except AuthenticationError:
-                # Exit out to receipt service
-                raise APIKeyError()
-
-            # Append response to messages
-            response_content = response.choices[0].message.content
-            self.append_message("assistant", response_content)
-
-            # Parse json response
-            review_dict = json.loads(response_content)
-
-            if not review_dict['status']:
-                print(f"Attempt {attempt_num + 1} Error: status is False")
-                if (attempt_num + 1 == self.max_retry or
-                        response.usage.total_tokens + self.get_token_count(self.error_response) +
-                        self.buffer > self.get_token_limit(self.model_name)):
-                    print("Max retry reached. Unable to generate insights.")
-                    return None
-
-                self.append_message("user", self.error_response)
-            else:
-                print(f"Attempt {attempt_num + 1} Success")
-                return review_dict["insights"]
-
-        return None
-
-    @staticmethod
-    def get_token_limit(model_version: str) -> int:
-        # Only include vision models
-        mapper_dict = {
-            'gpt-4o-mini': 128000,
-            'gpt-4o': 128000,
-            'gpt-4-turbo': 128000,
-        }
-        return mapper_dict[model_version]
-
-    def get_token_count(self, prompt: str) -> int:
-        encoding = tiktoken.encoding_for_model(self.model_name)
-        num_tokens = len(encoding.encode(prompt))
-        return num_tokens
-
-    def append_message(self, role, content):
-        if role not in ["user", "system", "assistant"]:
-            raise ValueError("Role must be one of 'user', 'system', or 'assistant'")
-
-        self.messages.append({"role": role, "content": content})
@@ -0,0 +1,379 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import urlparse
+import http.client
+import ipaddress
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import ssl
+import threading
+import time
+import uuid
+
+# Background parse jobs: /upload with async=true returns a job id at once, /jobs/<id> reports the result
+# Jobs are kept in a local SQLite database so their status survives restarts. API keys are never written to disk,
+# they only live in memory until the job runs, so jobs whose process stopped are marked failed instead of resumed.
+# Several processes can share the database: each one renews a lease on its unfinished jobs, and only jobs whose
+# lease expired are failed by the others.
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class JobUpload:
+    """Upload file kept for a job, same interface as SpooledUpload for parse_upload"""
+    def __init__(self, path: str, content_hash: str):
+        self.path = path
+        self.content_hash = content_hash
+        self.duplicate = None
+
+    def close(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class JobStore:
+    """Job rows in a SQLite database, a new connection per call so it can be used from any thread"""
+    def __init__(self, path: str):
+        self.path = path
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connect(self):
+        with self._init_lock:
+            if not self._initialized:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                with sqlite3.connect(self.path) as connection:
+                    connection.execute('PRAGMA journal_mode=WAL')
+                    connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                        id TEXT PRIMARY KEY,
+                        status TEXT NOT NULL,
+                        filename TEXT NOT NULL,
+                        callback_url TEXT,
+                        status_code INTEGER,
+                        result TEXT,
+                        error TEXT,
+                        created_at REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    )""")
+                    connection.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+                    # Databases created before leases were added
+                    columns = {row[1] for row in connection.execute('PRAGMA table_info(jobs)')}
+                    if 'owner' not in columns:
+                        connection.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+                    if 'lease_until' not in columns:
+                        connection.execute('ALTER TABLE jobs ADD COLUMN lease_until REAL')
+                self._initialized = True
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _execute(self, query, params=()):
+        connection = self._connect()
+        try:
+            with connection:
+                return connection.execute(query, params).fetchall()
+        finally:
+            connection.close()
+
+    def create(self, job_id: str, filename: str, callback_url: str = None, owner: str = None, lease: float = 0):
+        now = time.time()
+        self._execute('INSERT INTO jobs (id, status, filename, callback_url, created_at, updated_at, owner, '
+                      'lease_until) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                      (job_id, JOB_QUEUED, filename, callback_url, now, now, owner, now + lease))
+
+    def renew_leases(self, owner: str, lease: float):
+        """Extend the lease of the unfinished jobs of owner"""
+        self._execute('UPDATE jobs SET lease_until = ? WHERE owner = ? AND status IN (?, ?)',
+                      (time.time() + lease, owner, JOB_QUEUED, JOB_RUNNING))
+
+    def update(self, job_id: str, status: str, status_code: int = None, result: str = None, error: str = None):
+        self._execute('UPDATE jobs SET status = ?, status_code = ?, result = ?, error = ?, updated_at = ? '
+                      'WHERE id = ?', (status, status_code, result, error, time.time(), job_id))
+
+    def get(self, job_id: str):
+        rows = self._execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        return dict(rows[0]) if rows else None
+
+    def fail_expired(self, error: str) -> list:
+        """Mark queued and running jobs whose lease expired failed, returns their ids"""
+        if not os.path.exists(self.path):
+            return []
+        # Rows without a lease are from before leases were added
+        rows = self._execute('SELECT id FROM jobs WHERE status IN (?, ?) AND (lease_until IS NULL OR lease_until < ?)',
+                             (JOB_QUEUED, JOB_RUNNING, time.time()))
+        for row in rows:
+            self.update(row['id'], JOB_FAILED, 500, error=error)
+        return [row['id'] for row in rows]
+
+    def delete_finished(self, older_than: float):
+        self._execute('DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?',
+                      (JOB_DONE, JOB_FAILED, time.time() - older_than))
+
+
+def job_to_dict(job: dict) -> dict:
+    """Public view of a job row"""
+    result = {
+        'job_id': job['id'],
+        'status': job['status'],
+        'filename': job['filename'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+    }
+    if job['status'] == JOB_DONE:
+        result['result'] = json.loads(job['result'])
+    if job['status'] in (JOB_DONE, JOB_FAILED):
+        result['status_code'] = job['status_code']
+    if job['error'] is not None:
+        result['error'] = job['error']
+    return result
+
+
+def get_job_options(form, allowed_hosts=()):
+    """Returns (run_async, callback_url, error_msg) from the optional async and callbackUrl form fields"""
+    run_async = form.get('async', 'false').lower() == 'true'
+    callback_url = form.get('callbackUrl') or None
+    if callback_url is not None:
+        if not run_async:
+            return None, None, 'callbackUrl parameter is only supported with async=true'
+        # Host names are resolved when the callback is sent, not while the request waits
+        error = check_callback_url(callback_url, allowed_hosts, resolve=False)
+        if error is not None:
+            return None, None, error
+    return run_async, callback_url, None
+
+
+def is_public_address(address: str) -> bool:
+    # Drop the zone of scoped IPv6 addresses, e.g. fe80::1%eth0
+    return ipaddress.ip_address(address.split('%')[0]).is_global
+
+
+def resolve_callback_url(callback_url: str, allowed_hosts=(), resolve: bool = True):
+    """Returns (address, error_msg), the address a callback to callback_url may be sent to
+
+    With allowed_hosts, only those hosts are allowed. Otherwise the host must only resolve to public addresses, so a
+    callback cannot reach the service's own network, e.g. /metrics or a cloud metadata endpoint. Without resolve,
+    host names are not looked up and the address is None.
+    """
+    parsed = urlparse(callback_url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return None, 'Invalid callbackUrl parameter, expected an http or https URL'
+    host = parsed.hostname.lower()
+    if allowed_hosts and host not in allowed_hosts:
+        return None, 'Invalid callbackUrl parameter, host is not allowed'
+
+    try:
+        public = is_public_address(host)
+        addresses = [host]
+    except ValueError:
+        # A host name
+        if host == 'localhost' or host.endswith('.localhost'):
+            if not allowed_hosts:
+                return None, 'Invalid callbackUrl parameter, expected a public host'
+        if not resolve:
+            return None, None
+        try:
+            addresses = list(dict.fromkeys(info[4][0] for info in socket.getaddrinfo(host, parsed.port or None)))
+        except socket.gaierror:
+            return None, 'Invalid callbackUrl parameter, host does not resolve'
+        public = all(is_public_address(address) for address in addresses)
+    # Allowed hosts are trusted, they may well be on the service's own network
+    if not public and not allowed_hosts:
+        return None, 'Invalid callbackUrl parameter, expected a public host'
+    return addresses[0], None
+
+
+def check_callback_url(callback_url: str, allowed_hosts=(), resolve: bool = True) -> Optional[str]:
+    """Returns the error message if job results may not be posted to callback_url"""
+    return resolve_callback_url(callback_url, allowed_hosts, resolve)[1]
+
+
+class PinnedHTTPConnection(http.client.HTTPConnection):
+    """Connects to an address resolved and checked beforehand instead of resolving the host again"""
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout, self.source_address)
+
+
+class PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """Same as PinnedHTTPConnection, the certificate is still checked against the host name"""
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, context=ssl.create_default_context(), **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout, self.source_address)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def send_callback(callback_url: str, address: str, data: bytes, timeout: float) -> int:
+    """POST data to callback_url at address, returns the status code, redirects are not followed"""
+    parsed = urlparse(callback_url)
+    connection_cls = PinnedHTTPSConnection if parsed.scheme == 'https' else PinnedHTTPConnection
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    connection = connection_cls(parsed.hostname, address, port=port, timeout=timeout)
+    path = parsed.path or '/'
+    if parsed.query:
+        path = f"{path}?{parsed.query}"
+    try:
+        connection.request('POST', path, body=data, headers={'Content-Type': 'application/json'})
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+def post_callback(callback_url: str, payload: dict, timeout: float = 10.0, attempts: int = 3, allowed_hosts=()):
+    """POST the finished job to the callback URL, with a short backoff between attempts"""
+    # Resolved and checked again now, the host may point somewhere else than when the job was created. The
+    # callback is sent to the checked address, so the host cannot be re-resolved to another one (DNS rebinding),
+    # and a redirect counts as a failure, so it cannot send the callback on to an internal address either.
+    address, error = resolve_callback_url(callback_url, allowed_hosts)
+    if error is not None:
+        print(f"Not sending the callback to {callback_url}: {error}")
+        return False
+    data = json.dumps(payload).encode('utf-8')
+    for attempt_num in range(attempts):
+        try:
+            status = send_callback(callback_url, address, data, timeout)
+            if 200 <= status < 300:
+                return True
+            print(f"Callback to {callback_url} failed, attempt {attempt_num + 1}: status {status}")
+        except Exception as e:
+            print(f"Callback to {callback_url} failed, attempt {attempt_num + 1}: {e}")
+        time.sleep(2 ** attempt_num)
+    return False
+
+
+class JobQueue:
+    """Runs parse jobs on a bounded worker pool, new jobs are refused once max_pending jobs are waiting
+
+    The leases of the queue's unfinished jobs are renewed every lease / 3 seconds while the process runs.
+    Callbacks are sent from their own threads, so their retries do not hold up the job workers.
+    """
+    def __init__(self, store: JobStore, upload_dir: str, workers: int = 4, max_pending: int = 100,
+                 ttl: int = 24 * 60 * 60, callback_timeout: float = 10.0, lease: float = 120,
+                 callback_workers: int = 4, callback_allowed_hosts=()):
+        self.store = store
+        self.upload_dir = upload_dir
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.callback_timeout = callback_timeout
+        self.lease = lease
+        self.callback_allowed_hosts = callback_allowed_hosts
+        # Jobs of this process, other processes sharing the store only fail them once their lease expired
+        self.owner = uuid.uuid4().hex
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.callback_executor = ThreadPoolExecutor(max_workers=callback_workers, thread_name_prefix='job-callback')
+        self._pending = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self._renew_leases, name='job-lease', daemon=True).start()
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(self.lease / 3)
+            with self._lock:
+                pending = self._pending
+            if not pending:
+                continue
+            try:
+                self.store.renew_leases(self.owner, self.lease)
+            except Exception as e:
+                print(f"Unable to renew the job leases: {e}")
+
+    def recover(self):
+        """Fail the jobs whose process stopped before they finished, their API keys are gone"""
+        failed = self.store.fail_expired('Service restarted before the job finished, please upload again')
+        if failed:
+            print(f"Marked {len(failed)} unfinished jobs of stopped processes as failed")
+        if not os.path.isdir(self.upload_dir):
+            return
+        # Their uploads are not needed anymore either, nor files left without an unfinished job
+        failed = set(failed)
+        for name in os.listdir(self.upload_dir):
+            path = os.path.join(self.upload_dir, name)
+            job_id = os.path.splitext(name)[0]
+            if job_id not in failed:
+                job = self.store.get(job_id)
+                if job is not None and job['status'] in (JOB_QUEUED, JOB_RUNNING):
+                    continue
+                try:
+                    # Uploads are moved in just before their job row is created
+                    if os.path.getmtime(path) > time.time() - self.lease:
+                        continue
+                except FileNotFoundError:
+                    continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def submit(self, filename: str, upload, run, callback_url: str = None):
+        """Queue run(job_upload) -> (response_json, error_msg, status_code), returns the job id or None if full
+
+        The spooled upload is moved into the job directory, so the request can return before it is parsed.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return None
+            self._pending += 1
+
+        try:
+            job_id = uuid.uuid4().hex
+            os.makedirs(self.upload_dir, exist_ok=True)
+            job_path = os.path.join(self.upload_dir, job_id + os.path.splitext(filename)[1])
+            shutil.move(upload.path, job_path)
+            job_upload = JobUpload(job_path, upload.content_hash)
+            self.store.create(job_id, filename, callback_url, self.owner, self.lease)
+            if self.ttl:
+                self.store.delete_finished(self.ttl)
+            self.executor.submit(self._run, job_id, job_upload, run, callback_url)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return job_id
+
+    def _run(self, job_id, job_upload, run, callback_url):
+        try:
+            self.store.update(job_id, JOB_RUNNING)
+            try:
+                response_json, error, status = run(job_upload)
+            except Exception as e:
+                print(f"Unexpected error occurred in job {job_id}: {e}")
+                response_json, error, status = None, 'Error parsing receipt', 500
+            finally:
+                job_upload.close()
+
+            if error is None:
+                self.store.update(job_id, JOB_DONE, status, result=response_json)
+            else:
+                self.store.update(job_id, JOB_FAILED, status, error=error)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+        if callback_url is not None:
+            self.callback_executor.submit(post_callback, callback_url, job_to_dict(self.store.get(job_id)),
+                                          self.callback_timeout, allowed_hosts=self.callback_allowed_hosts)
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self._pending, 'max_pending': self.max_pending}
+
+
+def create_job_queue(config) -> JobQueue:
+    queue = JobQueue(JobStore(config['JOB_DB_PATH']), config['JOB_UPLOAD_DIR'], config['JOB_WORKERS'],
+                     config['JOB_MAX_PENDING'], config['JOB_TTL'], config['JOB_CALLBACK_TIMEOUT'],
+                     config['JOB_LEASE'], config['JOB_CALLBACK_WORKERS'], config['JOB_CALLBACK_ALLOWED_HOSTS'])
+    queue.recover()
+    return queue
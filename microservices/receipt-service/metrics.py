@@ -0,0 +1,96 @@
+from contextlib import contextmanager
+import asyncio
+import time
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# Prometheus metrics of the receipt service, scraped from GET /metrics
+# Metrics are process wide, so every app created in the process reports into the same registry.
+
+# LLM calls take seconds, the default buckets stop at 10s
+LLM_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120)
+
+REQUEST_SECONDS = Histogram('receipt_request_duration_seconds', 'HTTP request latency',
+                            ['route', 'method', 'status'], buckets=LLM_BUCKETS)
+LLM_CALL_SECONDS = Histogram('receipt_llm_call_duration_seconds', 'Latency of a single LLM API call',
+                             ['provider', 'task', 'outcome'], buckets=LLM_BUCKETS)
+LLM_TOKENS = Counter('receipt_llm_tokens_total', 'Tokens reported by the LLM API usage',
+                     ['provider', 'task', 'kind'])
+PARSE_ATTEMPTS = Histogram('receipt_parse_attempts', 'Messages sent to a parser before it finished',
+                           ['provider', 'result'], buckets=(1, 2, 3, 4, 5, 6, 8))
+FALLBACKS = Counter('receipt_fallbacks_total', 'Model attempts that failed, so the next model is tried',
+                    ['task', 'model', 'reason'])
+CIRCUIT_OPEN = Gauge('receipt_circuit_open', 'Whether the circuit breaker of a provider is open (1) or closed (0)',
+                     ['provider'])
+LOCAL_REPAIRS = Counter('receipt_local_repairs_total', 'Receipt fields repaired locally instead of by the model',
+                        ['field'])
+RETRIES_AVOIDED = Counter('receipt_retries_avoided_total',
+                          'Parses that validated after local repairs, without a retry')
+PDF_PAGE_RENDER_SECONDS = Histogram('receipt_pdf_page_render_seconds', 'Time to rasterize one PDF page')
+IMAGE_NORMALIZE_SECONDS = Histogram('receipt_image_normalize_seconds',
+                                    'Time to orient, crop and clean up an uploaded photo')
+STAGE_CPU_SECONDS = Counter('receipt_stage_cpu_seconds_total', 'CPU time of the thread running a request stage',
+                            ['stage'])
+IMAGE_ENCODE_SECONDS = Histogram('receipt_image_encode_seconds', 'Time to downscale and encode an image for a provider',
+                                 ['provider'])
+OCR_SECONDS = Histogram('receipt_ocr_seconds', 'Time of the local OCR pre-pass of one page, in its worker process')
+OCR_PAGES = Counter('receipt_ocr_pages_total', 'Pages read by the local OCR pre-pass, by how they were sent',
+                    ['outcome'])
+TEMPLATE_LOOKUPS = Counter('receipt_template_lookups_total',
+                           'OCR pages looked up in the merchant templates, hit = parsed without a model', ['outcome'])
+TEMPLATES_LEARNED = Counter('receipt_templates_learned_total', 'Merchant templates learned from model parses')
+DUPLICATE_LOOKUPS = Counter('receipt_duplicate_lookups_total',
+                            'Photo uploads looked up in the near-duplicate index, by what was done', ['outcome'])
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+@contextmanager
+def time_stage(stage):
+    """Count the CPU time of the with block toward the stage, the block must not await"""
+    start = time.thread_time()
+    try:
+        yield
+    finally:
+        STAGE_CPU_SECONDS.labels(stage).inc(time.thread_time() - start)
+
+
+@contextmanager
+def time_llm_call(provider, task):
+    """Observe the latency of the LLM call in the with block, labelled by whether it raised
+
+    The CPU time of the client (request encoding, response decoding) counts toward the llm_call stage, except in
+    an event loop where other requests run during the await.
+    """
+    start = time.perf_counter()
+    cpu_start = None if _in_event_loop() else time.thread_time()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'success'
+    finally:
+        LLM_CALL_SECONDS.labels(str(provider), task, outcome).observe(time.perf_counter() - start)
+        if cpu_start is not None:
+            STAGE_CPU_SECONDS.labels('llm_call').inc(time.thread_time() - cpu_start)
+
+
+def record_tokens(provider, task, prompt_tokens, completion_tokens, cached_tokens=0):
+    LLM_TOKENS.labels(str(provider), task, 'prompt').inc(prompt_tokens or 0)
+    LLM_TOKENS.labels(str(provider), task, 'completion').inc(completion_tokens or 0)
+    # Prompt tokens served from the provider's prompt cache, already included in the prompt tokens
+    LLM_TOKENS.labels(str(provider), task, 'cached_prompt').inc(cached_tokens or 0)
+
+
+def record_request(rule, method, status, seconds):
+    # Label by the route rule, not the path, so /jobs/<job_id> stays a single series
+    REQUEST_SECONDS.labels(rule or 'unmatched', method, str(status)).observe(seconds)
+
+
+def metrics_response():
+    """(body, content_type) of the metrics page"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,197 @@
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Optional
+import asyncio
+import statistics
+import threading
+import time
+import PIL.Image
+from metrics import OCR_SECONDS, OCR_PAGES
+
+try:
+    import pytesseract
+except ImportError:
+    # Optional, without it the OCR pre-pass is off and every page is sent as an image
+    pytesseract = None
+
+# Local OCR pre-pass
+# Images are the most expensive and slowest input of the vision parsers. With OCR_ENABLED each page is first read
+# locally by Tesseract in a worker process; if its words are recognised confidently the parsers get the text, with
+# the layout of its rows kept, and at most a small thumbnail instead of the full image. Pages read with a low
+# confidence or too few words (photos of crumpled receipts, non receipts) keep the full image.
+
+OCR_OUTCOME_TEXT = 'text'
+OCR_OUTCOME_LOW_CONFIDENCE = 'low_confidence'
+OCR_OUTCOME_ERROR = 'error'
+
+
+class OcrPage:
+    """A page the parsers get as OCR text, plus an optional thumbnail of it"""
+    def __init__(self, text: str, confidence: float, thumbnail: Optional[PIL.Image.Image] = None):
+        self.text = text
+        self.confidence = confidence
+        self.thumbnail = thumbnail
+
+
+def ocr_options(config) -> dict:
+    return {
+        'lang': config['OCR_LANG'],
+        'min_confidence': config['OCR_MIN_CONFIDENCE'],
+        'min_words': config['OCR_MIN_WORDS'],
+        'thumbnail_max_dimension': config['OCR_THUMBNAIL_MAX_DIMENSION'],
+    }
+
+
+def layout_text(words) -> str:
+    """Text of (left, top, width, height, text) words, one line per row of the page
+
+    Tesseract orders words by block, and on receipts the prices are often a block of their own, away from their
+    items. Words are grouped into rows by their vertical center instead, and the gaps between them kept as spaces,
+    so an item and its price stay on one line.
+    """
+    if not words:
+        return ''
+    words = sorted(words, key=lambda word: word[1] + word[3] / 2)
+    rows = []
+    for word in words:
+        center = word[1] + word[3] / 2
+        if rows and abs(center - rows[-1]['center']) <= rows[-1]['height'] / 2:
+            row = rows[-1]
+            row['words'].append(word)
+            row['center'] += (center - row['center']) / len(row['words'])
+            row['height'] = max(row['height'], word[3])
+        else:
+            rows.append({'center': center, 'height': word[3], 'words': [word]})
+
+    char_width = statistics.median(word[2] / len(word[4]) for word in words) or 1
+    margin = min(word[0] for word in words)
+    lines = []
+    for row in rows:
+        line = ''
+        for left, _, _, _, text in sorted(row['words']):
+            column = round((left - margin) / char_width)
+            line += ' ' * max(column - len(line), 1 if line else 0) + text
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def read_page(img: PIL.Image.Image, lang: str = 'eng'):
+    """(text, confidence 0-100, word count, seconds) of a page, runs in a worker process"""
+    start = time.perf_counter()
+    data = pytesseract.image_to_data(img, lang=lang, output_type=pytesseract.Output.DICT)
+    words = []
+    confidence_sum = 0.0
+    for left, top, width, height, conf, text in zip(data['left'], data['top'], data['width'], data['height'],
+                                                    data['conf'], data['text']):
+        text = text.strip()
+        # -1 is a block, paragraph or line, not a word
+        if not text or float(conf) < 0:
+            continue
+        words.append((left, top, width, height, text))
+        confidence_sum += float(conf) * len(text)
+    characters = sum(len(word[4]) for word in words)
+    confidence = confidence_sum / characters if characters else 0.0
+    return layout_text(words), confidence, len(words), time.perf_counter() - start
+
+
+class OcrStats:
+    def __init__(self):
+        self.pages = 0
+        self.text_pages = 0
+        self.low_confidence = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, outcome: str, seconds: float = 0.0):
+        OCR_PAGES.labels(outcome).inc()
+        with self._lock:
+            self.pages += 1
+            self.seconds += seconds
+            if outcome == OCR_OUTCOME_TEXT:
+                self.text_pages += 1
+            elif outcome == OCR_OUTCOME_LOW_CONFIDENCE:
+                self.low_confidence += 1
+            else:
+                self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pages': self.pages,
+                'text_pages': self.text_pages,
+                'low_confidence': self.low_confidence,
+                'errors': self.errors,
+                'seconds': self.seconds,
+            }
+
+
+ocr_stats = OcrStats()
+
+
+class OcrPrepass:
+    """Replaces the pages OCR reads confidently by OcrPage, the reader runs in executor (a process pool)"""
+    def __init__(self, executor: Executor, lang: str = 'eng', min_confidence: float = 80, min_words: int = 10,
+                 thumbnail_max_dimension: int = 0, reader=read_page, stats: OcrStats = ocr_stats):
+        self.executor = executor
+        self.lang = lang
+        self.min_confidence = min_confidence
+        self.min_words = min_words
+        # 0 = text only
+        self.thumbnail_max_dimension = thumbnail_max_dimension
+        self.reader = reader
+        self.stats = stats
+
+    def submit(self, images):
+        # All pages are read in parallel, each in its own worker
+        return [self.executor.submit(self.reader, img, self.lang) for img in images]
+
+    def finish(self, images, results):
+        """Pages of the parsers, results are (text, confidence, words, seconds) or the exception of each image"""
+        pages = []
+        for img, result in zip(images, results):
+            if isinstance(result, Exception):
+                print(f"OCR failed, sending the image: {result!r}")
+                self.stats.record(OCR_OUTCOME_ERROR)
+                pages.append(img)
+                continue
+            text, confidence, word_count, seconds = result
+            OCR_SECONDS.observe(seconds)
+            if confidence < self.min_confidence or word_count < self.min_words:
+                print(f"OCR read {word_count} words at {confidence:.0f}% confidence, sending the image")
+                self.stats.record(OCR_OUTCOME_LOW_CONFIDENCE, seconds)
+                pages.append(img)
+                continue
+            print(f"OCR read {word_count} words at {confidence:.0f}% confidence in {seconds:.2f}s, sending the text")
+            self.stats.record(OCR_OUTCOME_TEXT, seconds)
+            pages.append(OcrPage(text, confidence, self.make_thumbnail(img)))
+        return pages
+
+    def make_thumbnail(self, img: PIL.Image.Image) -> Optional[PIL.Image.Image]:
+        if not self.thumbnail_max_dimension:
+            return None
+        thumbnail = img.copy()
+        thumbnail.thumbnail((self.thumbnail_max_dimension, self.thumbnail_max_dimension))
+        return thumbnail
+
+    def apply(self, images):
+        results = []
+        for future in self.submit(images):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return self.finish(images, results)
+
+    async def apply_async(self, images):
+        futures = [asyncio.wrap_future(future) for future in self.submit(images)]
+        return self.finish(images, await asyncio.gather(*futures, return_exceptions=True))
+
+
+def create_ocr_prepass(config) -> Optional[OcrPrepass]:
+    """OcrPrepass of the OCR_* config, None when it is off or pytesseract is not installed"""
+    if not config['OCR_ENABLED']:
+        return None
+    if pytesseract is None:
+        print('OCR_ENABLED is set but pytesseract is not installed, every page is sent as an image')
+        return None
+    return OcrPrepass(ProcessPoolExecutor(max_workers=config['OCR_WORKERS'] or None), **ocr_options(config))
@@ -0,0 +1,130 @@
+from collections import Counter
+from concurrent.futures import Executor
+from typing import List
+import asyncio
+import threading
+from Receipt import Receipt, Category
+from pipeline import FallbackOutcome
+
+# Page parallel parsing of multi-page PDFs
+# 'combined' = every page in one prompt (default)
+# 'merge'    = each page group is parsed on its own, then merged into one receipt
+# 'split'    = each page group is a separate receipt, a list of receipts is returned
+PAGE_MODES = {'combined', 'merge', 'split'}
+
+
+def get_page_mode(form, config):
+    """Returns (page_mode, pages_per_group, error_msg) from the optional pageMode and pagesPerGroup form fields"""
+    page_mode = (form.get('pageMode') or config['PAGE_MODE']).lower()
+    if page_mode not in PAGE_MODES:
+        return None, None, f"Invalid pageMode parameter, expected one of {sorted(PAGE_MODES)}"
+
+    try:
+        pages_per_group = int(form.get('pagesPerGroup', config['PAGES_PER_GROUP']))
+    except ValueError:
+        return None, None, 'Invalid pagesPerGroup parameter, expected a positive integer'
+    if pages_per_group <= 0:
+        return None, None, 'Invalid pagesPerGroup parameter, expected a positive integer'
+
+    return page_mode, pages_per_group, None
+
+
+def max_groups_in_flight(prefetch_pages: int, pages_per_group: int) -> int:
+    """Page groups parsed at once, so the pages held by the parsers stay within PDF_PREFETCH_PAGES"""
+    return max(1, prefetch_pages // pages_per_group)
+
+
+def parse_page_groups(page_groups, parse_group, executor: Executor, max_in_flight: int) -> list:
+    """Outcomes of parse_group(group) for every group of page_groups in page order
+
+    The next group is only pulled, and so rendered, once fewer than max_in_flight groups are being parsed, so the
+    memory held stays flat however many pages the document has.
+    """
+    slots = threading.BoundedSemaphore(max_in_flight)
+    futures = []
+    while True:
+        slots.acquire()
+        group = next(page_groups, None)
+        if group is None:
+            slots.release()
+            break
+        future = executor.submit(parse_group, group)
+        future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+    return [future.result() for future in futures]
+
+
+async def parse_page_groups_async(page_groups, parse_group, max_in_flight: int) -> list:
+    """Same as parse_page_groups, page_groups is an async iterator and parse_group(group) an awaitable"""
+    slots = asyncio.Semaphore(max_in_flight)
+
+    async def parse(group):
+        try:
+            return await parse_group(group)
+        finally:
+            slots.release()
+
+    tasks = []
+    try:
+        while True:
+            await slots.acquire()
+            try:
+                group = await page_groups.__anext__()
+            except StopAsyncIteration:
+                break
+            tasks.append(asyncio.ensure_future(parse(group)))
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+def group_pages(pages: list, pages_per_group: int) -> List[list]:
+    return [pages[i:i + pages_per_group] for i in range(0, len(pages), pages_per_group)]
+
+
+def merge_receipts(receipts: List[Receipt]) -> Receipt:
+    """Merge the receipts parsed from the pages of a single document, in page order"""
+    if len(receipts) == 1:
+        return receipts[0]
+
+    # The grand total is the largest amount, the other pages only have subtotals or carried forward totals
+    total_receipt = max(receipts, key=lambda receipt: receipt._total_cost.amount)
+    # Category that most pages agree on, the first page breaks ties
+    category = Counter(receipt.category for receipt in receipts).most_common(1)[0][0]
+
+    return Receipt(
+        merchant_name=receipts[0].merchant_name,
+        date=receipts[0].date,
+        total_cost=total_receipt.total_cost,
+        category=Category[category].value,
+        itemized_list=[item.to_dict() for receipt in receipts for item in receipt.itemized_list],
+    )
+
+
+def combine_page_outcomes(outcomes: list, page_mode: str) -> FallbackOutcome:
+    """Combine the outcome of every page group into the outcome of the whole document"""
+    combined = FallbackOutcome()
+    parsed = [outcome for outcome in outcomes if outcome.response is not None]
+    for outcome in outcomes:
+        for model_name in outcome.api_key_error_models:
+            if model_name not in combined.api_key_error_models:
+                combined.api_key_error_models.append(model_name)
+
+    if not parsed:
+        # Only report invalid keys if no page could be parsed because of them
+        combined.invalid_api_keys = any(outcome.invalid_api_keys for outcome in outcomes)
+        return combined
+
+    if len(parsed) < len(outcomes):
+        # A document missing pages would lose their items and maybe the total, it is not returned nor cached
+        failed = [str(group_num) for group_num, outcome in enumerate(outcomes, 1) if outcome.response is None]
+        print(f"Parsed {len(parsed)} of {len(outcomes)} page groups")
+        combined.error = f"Error parsing page groups {', '.join(failed)} of {len(outcomes)}"
+        return combined
+
+    receipts = [outcome.response for outcome in parsed]
+    combined.response = receipts if page_mode == 'split' else merge_receipts(receipts)
+    combined.handler = parsed[0].handler
+    return combined
@@ -0,0 +1,244 @@
+from typing import Optional
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from gemini import GeminiReceiptParser, GeminiReceiptReview
+from gpt4o import OpenAIReceiptParser, OpenAIReceiptReview
+from Exceptions import APIKeyError
+from breaker import ProviderHealth, record_call, take_call
+from rasterize import iter_pdf_pages
+from preprocess import normalize_image
+from metrics import FALLBACKS, IMAGE_NORMALIZE_SECONDS, time_stage
+import PIL.Image
+
+# Shared by the sync (receiptservice.py) and async (asyncservice.py) apps, so both keep the same contract
+
+VALID_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
+
+DEFAULT_INSIGHTS = """Track your spending diligently to identify unnecessary expenses, prioritize needs over wants, and create a realistic budget.
+Cut costs by meal planning, reducing utility usage, and canceling unused subscriptions.
+Pay down high-interest debt aggressively while exploring cheaper alternatives for insurance, transportation, and entertainment.""".strip()
+
+
+def allowed_file(filename):
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in VALID_IMAGE_EXTENSIONS
+
+
+def validate_api_keys(default_model, gemini_api_key, openai_api_key) -> Optional[str]:
+    """Returns the error message if the model settings are incomplete"""
+    if not default_model:
+        return 'Missing defaultModel parameter'
+
+    if (gemini_api_key in [None, 'UNSET']) and (openai_api_key in [None, 'UNSET']):
+        return 'Missing geminiKey or openaiKey parameter, at least 1 key is needed'
+
+    return None
+
+
+def validate_upload(files, form) -> Optional[str]:
+    """Returns the error message if the upload request is incomplete"""
+    if 'file' not in files:
+        return 'No file received'
+
+    if files['file'].filename == '':
+        return 'No selected file'
+
+    return validate_api_keys(form.get('defaultModel'), form.get('geminiKey'), form.get('openaiKey'))
+
+
+def get_parsers(default_model, gemini_api_key, openai_api_key):
+    parsers = [
+        ('GEMINI', GeminiReceiptParser, gemini_api_key),
+        ('OPENAI', OpenAIReceiptParser, openai_api_key),
+        # Additional parsers can be added here
+    ]
+    # Make sure the default_model parser is the first in the list
+    parsers.sort(key=lambda x: x[0] != default_model.upper())
+    return parsers
+
+
+def get_reviewers(default_model, gemini_api_key, openai_api_key):
+    reviewers = [
+        ('GEMINI', GeminiReceiptReview, gemini_api_key),
+        ('OPENAI', OpenAIReceiptReview, openai_api_key),
+        # Additional reviewers can be added here
+    ]
+    # Make sure the default_model reviewer is the first in the list
+    reviewers.sort(key=lambda x: x[0] != default_model.upper())
+    return reviewers
+
+
+def get_cache_candidates(parsers):
+    """(model_name, prompt_version) of every parser that can be used with the given keys"""
+    return [(parser_cls.default_model_version, parser_cls.prompt_version)
+            for _, parser_cls, api_key in parsers if api_key not in [None, 'UNSET']]
+
+
+def is_pdf(filename):
+    return filename.rsplit('.', 1)[1].lower() == 'pdf'
+
+
+class SpooledUpload:
+    """Copies an upload stream to a temp file in chunks, hashing it on the way
+
+    The upload is never held in memory as a whole, and poppler needs a file to render from anyway.
+    content_hash is the same as ParseCache.hash_content of the uploaded bytes.
+    """
+    def __init__(self, stream, suffix: str = '', chunk_size: int = 1024 * 1024):
+        hasher = hashlib.sha256()
+        fd, self.path = tempfile.mkstemp(suffix=suffix)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            self.close()
+            raise
+        self.content_hash = hasher.hexdigest()
+        # DuplicateMatch set by parse_upload when this is a near-duplicate of an earlier upload
+        self.duplicate = None
+
+    def close(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_receipt_images(filename, path, dpi: int = 200, grayscale: bool = False, max_pages: int = 0,
+                        image_options: dict = None):
+    with time_stage('load_images'):
+        # Different format handler
+        if is_pdf(filename):
+            images = list(iter_pdf_pages(path, dpi=dpi, grayscale=grayscale, max_pages=max_pages))
+        else:
+            # Single Png/jpg image, photos are cropped and cleaned up once here, before any parser encodes them
+            with IMAGE_NORMALIZE_SECONDS.time():
+                images = [normalize_image(PIL.Image.open(path), source_bytes=os.path.getsize(path), source_path=path,
+                                          **(image_options or {}))]
+
+        # Decode now, PIL decodes lazily and the images may be shared by parsers running in parallel
+        for img in images:
+            img.load()
+    return images
+
+
+def format_receipts(receipts) -> str:
+    """Format list of receipts to string"""
+    lines = []
+    for receipt in receipts:
+        lines.append(f"Merchant: {receipt['merchantName']}")
+        lines.append(f"Date: {receipt['date']}")
+        lines.append(f"Category: {receipt['category']}")
+        lines.append(f"Total Cost: {receipt['totalCost']}")
+        lines.append("Itemized List:")
+        for item in receipt['itemizedList']:
+            lines.append(f"  - {item['itemName']}: {item['itemQuantity']} x ${item['itemCost']}")
+        lines.append("")  # Add an extra newline to separate receipts
+    return "\n".join(lines).rstrip()
+
+
+class FallbackOutcome:
+    def __init__(self):
+        # Result of the first model that succeeded, None if all failed
+        self.response = None
+        # Parser/reviewer instance that produced the response
+        self.handler = None
+        self.api_key_error_models = []
+        # True if the last model in the list was tried and its key was rejected
+        self.invalid_api_keys = False
+        # Error for the client when there is no response, None = the default parse error
+        self.error = None
+
+
+def run_with_fallback(candidates, call, task_name: str, health: ProviderHealth = None) -> FallbackOutcome:
+    """Try each (model_name, cls, api_key) in order, default_model first, until call(instance) returns a result
+
+    With health, providers whose circuit breaker is open are skipped and degraded ones are tried last.
+    """
+    outcome = FallbackOutcome()
+    if health is not None:
+        candidates = health.route(candidates, task_name)
+    for model_name, handler_cls, api_key in candidates:
+        if api_key == 'UNSET':
+            print(f'Skipping {model_name} {task_name}, {model_name} API key is not set')
+            continue
+        if not take_call(health, model_name, task_name):
+            continue
+        start = time.perf_counter()
+        try:
+            print(f'Running {model_name} {task_name}')
+            handler = handler_cls(api_key)
+            outcome.response = call(handler)
+            record_call(health, model_name, task_name, start, outcome.response)
+
+            # If response is not None, the model succeeded
+            if outcome.response is not None:
+                outcome.handler = handler
+                break
+            FALLBACKS.labels(task_name, model_name, 'no_result').inc()
+        except APIKeyError as e:
+            record_call(health, model_name, task_name, start, e)
+            FALLBACKS.labels(task_name, model_name, 'api_key').inc()
+            outcome.api_key_error_models.append(model_name)
+            if model_name == candidates[-1][0]:
+                outcome.invalid_api_keys = True
+                break
+        except Exception as e:
+            record_call(health, model_name, task_name, start, e)
+            FALLBACKS.labels(task_name, model_name, 'error').inc()
+            print(f"Unexpected error occurred with {model_name} {task_name}: {e}")
+            continue
+    return outcome
+
+
+async def run_with_fallback_async(candidates, call_async, task_name: str,
+                                  health: ProviderHealth = None) -> FallbackOutcome:
+    """Same as run_with_fallback, call_async(instance) returns an awaitable"""
+    outcome = FallbackOutcome()
+    if health is not None:
+        candidates = health.route(candidates, task_name)
+    for model_name, handler_cls, api_key in candidates:
+        if api_key == 'UNSET':
+            print(f'Skipping {model_name} {task_name}, {model_name} API key is not set')
+            continue
+        if not take_call(health, model_name, task_name):
+            continue
+        start = time.perf_counter()
+        try:
+            print(f'Running {model_name} {task_name}')
+            # Construction may fetch model info on first use, keep it off the event loop
+            handler = await asyncio.to_thread(handler_cls, api_key)
+            outcome.response = await call_async(handler)
+            record_call(health, model_name, task_name, start, outcome.response)
+
+            if outcome.response is not None:
+                outcome.handler = handler
+                break
+            FALLBACKS.labels(task_name, model_name, 'no_result').inc()
+        except APIKeyError as e:
+            record_call(health, model_name, task_name, start, e)
+            FALLBACKS.labels(task_name, model_name, 'api_key').inc()
+            outcome.api_key_error_models.append(model_name)
+            if model_name == candidates[-1][0]:
+                outcome.invalid_api_keys = True
+                break
+        except Exception as e:
+            record_call(health, model_name, task_name, start, e)
+            FALLBACKS.labels(task_name, model_name, 'error').inc()
+            print(f"Unexpected error occurred with {model_name} {task_name}: {e}")
+            continue
+    return outcome
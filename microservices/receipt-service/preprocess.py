@@ -0,0 +1,267 @@
+from io import BytesIO
+import base64
+import math
+import threading
+import time
+import PIL.Image
+import PIL.ImageFilter
+import PIL.ImageOps
+from metrics import IMAGE_ENCODE_SECONDS
+
+# Image preprocessing ahead of the vision parsers
+# normalize_image runs once per upload: EXIF orientation, crop to the receipt, grayscale + contrast.
+# ImagePreprocessor.encode runs per provider: downscale to the provider's max size and re-encode at a tuned quality.
+# Phone photos are 12 MP, mostly background, so the payload (and for OpenAI the image tokens) shrink a lot.
+# Uploads that normalization and downscaling left as they were are sent as uploaded. Changed images that would grow
+# when re-encoded are re-encoded smaller instead, the upload itself lacks their rotation, crop and colour changes.
+
+IMAGE_FORMATS = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+# Upload formats both providers accept as is
+SOURCE_MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+
+
+def image_options(config) -> dict:
+    return {
+        'autocrop': config['IMAGE_AUTOCROP'],
+        'grayscale': config['IMAGE_GRAYSCALE'],
+        'autocontrast': config['IMAGE_AUTOCONTRAST'],
+    }
+
+
+def find_receipt_box(img: PIL.Image.Image, sample_size: int = 256, margin: float = 0.02):
+    """Bounding box of the receipt paper, or None if the image does not look like paper on a background
+
+    Receipts are bright paper on a darker background, so threshold a small copy halfway between the background and
+    the paper brightness and take the bounding box of what remains.
+    """
+    small = img.convert('L')
+    small.thumbnail((sample_size, sample_size))
+    # Median filter removes specks so the box is not stretched by stray bright pixels
+    small = small.filter(PIL.ImageFilter.MedianFilter(5))
+
+    histogram = small.histogram()
+    pixel_count = sum(histogram)
+    mean = sum(value * count for value, count in enumerate(histogram)) / pixel_count
+    # Brightness of the brightest 10% of pixels, the paper
+    seen = 0
+    paper = 255
+    for value in range(255, -1, -1):
+        seen += histogram[value]
+        if seen >= pixel_count * 0.1:
+            paper = value
+            break
+    if paper - mean < 30:
+        # Not enough contrast between paper and background, e.g. a scan or a screenshot
+        return None
+
+    threshold = (paper + mean) / 2
+    box = small.point(lambda value: 255 if value > threshold else 0).getbbox()
+    if box is None:
+        return None
+
+    scale_x = img.width / small.width
+    scale_y = img.height / small.height
+    left, top, right, bottom = box
+    # Only crop when a meaningful part of the image is background, otherwise keep the whole image
+    if (right - left) * (bottom - top) > small.width * small.height * 0.9:
+        return None
+    if (right - left) * (bottom - top) < small.width * small.height * 0.05:
+        return None
+
+    pad_x = img.width * margin
+    pad_y = img.height * margin
+    return (max(0, int(left * scale_x - pad_x)), max(0, int(top * scale_y - pad_y)),
+            min(img.width, int(right * scale_x + pad_x)), min(img.height, int(bottom * scale_y + pad_y)))
+
+
+def normalize_image(img: PIL.Image.Image, autocrop: bool = True, grayscale: bool = True,
+                    autocontrast: bool = True, source_bytes: int = None, source_path: str = None) -> PIL.Image.Image:
+    """Provider independent preprocessing of an uploaded receipt photo
+
+    source_path is the uploaded file, ImagePreprocessor.encode may send it instead of a re-encode.
+    """
+    original_size = img.size
+    source_mime_type = SOURCE_MIME_TYPES.get(img.format)
+    # Phones store the rotation in EXIF instead of rotating the pixels
+    geometry_changed = img.getexif().get(0x0112, 1) != 1
+    img = PIL.ImageOps.exif_transpose(img)
+
+    if autocrop:
+        box = find_receipt_box(img)
+        if box is not None:
+            img = img.crop(box)
+            geometry_changed = True
+
+    # Whether the pixels differ from the upload's, then it cannot be sent in their place
+    pixels_changed = img.mode != 'L' and grayscale
+    if grayscale:
+        img = img.convert('L')
+    elif img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+        pixels_changed = True
+
+    if autocontrast:
+        before = img.histogram()
+        img = PIL.ImageOps.autocontrast(img, cutoff=1)
+        # The contrast curve is monotonic, the same histogram means no level moved
+        pixels_changed = pixels_changed or img.histogram() != before
+
+    # Kept for the size report in ImagePreprocessor.encode
+    img.info['original_size'] = original_size
+    if source_bytes is not None:
+        img.info['source_bytes'] = source_bytes
+    if source_path is not None and source_mime_type is not None:
+        img.info['source_path'] = source_path
+        img.info['source_mime_type'] = source_mime_type
+        img.info['geometry_changed'] = geometry_changed
+        img.info['pixels_changed'] = pixels_changed
+    return img
+
+
+def read_source(img: PIL.Image.Image):
+    """Bytes of the upload img was normalized from, None if unknown or gone"""
+    source_path = img.info.get('source_path')
+    if source_path is None:
+        return None
+    try:
+        with open(source_path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def fit_size(size, max_dimension: int = 0, max_short_side: int = 0):
+    """Size after downscaling to fit max_dimension and max_short_side, never upscales"""
+    width, height = size
+    scale = 1.0
+    if max_dimension:
+        scale = min(scale, max_dimension / max(width, height))
+    if max_short_side:
+        scale = min(scale, max_short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def openai_image_tokens(size, base_tokens: int = 85, tile_tokens: int = 170) -> int:
+    """Image tokens billed by OpenAI for a detail high image
+
+    The image is scaled to fit 2048 x 2048, then to a shortest side of 768, then counted in 512 x 512 tiles.
+    """
+    width, height = fit_size(size, 2048, 768)
+    return base_tokens + tile_tokens * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def gemini_image_tokens(size) -> int:
+    # Gemini 1.5 bills a flat 258 tokens per image whatever its size
+    return 258
+
+
+class PreprocessStats:
+    def __init__(self):
+        self.images = 0
+        # Uploaded file size, only known for image uploads, not rendered PDF pages
+        self.source_bytes = 0
+        self.bytes_sent = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self._lock = threading.Lock()
+
+    def record(self, source_bytes, bytes_sent, tokens_before, tokens_after):
+        with self._lock:
+            self.images += 1
+            self.source_bytes += source_bytes or 0
+            self.bytes_sent += bytes_sent
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+
+    def stats(self):
+        with self._lock:
+            return {
+                'images': self.images,
+                'source_bytes': self.source_bytes,
+                'bytes_sent': self.bytes_sent,
+                'estimated_tokens_before': self.tokens_before,
+                'estimated_tokens_after': self.tokens_after,
+            }
+
+
+preprocess_stats = PreprocessStats()
+
+
+class ImagePreprocessor:
+    """Downscales and encodes images for one provider"""
+    def __init__(self, name: str, estimate_tokens, max_dimension: int = 0, max_short_side: int = 0,
+                 image_format: str = 'jpeg', quality: int = 85, stats: PreprocessStats = preprocess_stats):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Image format must be one of {sorted(IMAGE_FORMATS)}")
+        self.name = name
+        self.estimate_tokens = estimate_tokens
+        self.max_dimension = max_dimension
+        self.max_short_side = max_short_side
+        self.image_format = image_format
+        self.mime_type = IMAGE_FORMATS[image_format]
+        self.quality = quality
+        self.stats = stats
+
+    def estimate_image_tokens(self, img: PIL.Image.Image) -> int:
+        """Tokens the provider bills for img once encode has downscaled it"""
+        return self.estimate_tokens(fit_size(img.size, self.max_dimension, self.max_short_side))
+
+    def encode(self, img: PIL.Image.Image):
+        """(mime_type, data) of img for the provider"""
+        start = time.perf_counter()
+        original_size = img.info.get('original_size', img.size)
+        source_bytes = img.info.get('source_bytes')
+        size = fit_size(img.size, self.max_dimension, self.max_short_side)
+        # Neither rotated, cropped, recoloured nor downscaled, a re-encode would only lose quality for about the
+        # same bytes
+        unchanged = (img.info.get('geometry_changed') is False and img.info.get('pixels_changed') is False and
+                     img.size == original_size and size == img.size)
+        source = read_source(img) if unchanged else None
+
+        if source is not None:
+            mime_type, data = img.info['source_mime_type'], source
+            sent_as = 'as uploaded'
+        else:
+            image_format, quality = self.image_format, self.quality
+            data = self._reencode(img, size, image_format, quality)
+            if source_bytes is not None and len(data) > source_bytes:
+                # Larger than the upload, e.g. a small heavily compressed photo, try smaller encodings
+                for fallback_format, fallback_quality in self._smaller_encodings():
+                    fallback = self._reencode(img, size, fallback_format, fallback_quality)
+                    if len(fallback) < len(data):
+                        image_format, quality, data = fallback_format, fallback_quality, fallback
+                    if len(data) <= source_bytes:
+                        break
+            mime_type = IMAGE_FORMATS[image_format]
+            sent_as = f"{image_format} q{quality}"
+        IMAGE_ENCODE_SECONDS.labels(self.name).observe(time.perf_counter() - start)
+
+        tokens_before = self.estimate_tokens(original_size)
+        tokens_after = self.estimate_tokens(size)
+        print(f"{self.name} image {original_size[0]}x{original_size[1]} -> {size[0]}x{size[1]} "
+              f"{sent_as}: {source_bytes or '?'} -> {len(data)} bytes, ~{tokens_before} -> ~{tokens_after} tokens")
+        if self.stats is not None:
+            self.stats.record(source_bytes, len(data), tokens_before, tokens_after)
+        return mime_type, data
+
+    def _smaller_encodings(self):
+        """(image_format, quality) to try when the configured encoding is larger than the upload"""
+        encodings = [(self.image_format, min(self.quality, 60))]
+        if self.image_format != 'webp':
+            encodings.append(('webp', min(self.quality, 60)))
+        return [encoding for encoding in encodings if encoding != (self.image_format, self.quality)]
+
+    def _reencode(self, img: PIL.Image.Image, size, image_format: str, quality: int) -> bytes:
+        if size != img.size:
+            img = img.resize(size, PIL.Image.LANCZOS)
+        if img.mode not in ('RGB', 'L'):
+            # JPEG has no alpha channel or palette
+            img = img.convert('RGB')
+        buffer = BytesIO()
+        img.save(buffer, format=image_format.upper(), quality=quality)
+        return buffer.getvalue()
+
+    def encode_b64(self, img: PIL.Image.Image):
+        """(mime_type, base64 data) of img for the provider"""
+        mime_type, data = self.encode(img)
+        return mime_type, base64.b64encode(data).decode('utf-8')
@@ -0,0 +1,231 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import Counter
+import asyncio
+import threading
+import time
+from Exceptions import APIKeyError
+from pipeline import FallbackOutcome
+from metrics import FALLBACKS
+from breaker import ProviderHealth, record_call, take_call
+
+# Hedged requests: the default model starts first, the next model starts after hedge_delay seconds
+# (or as soon as a running model fails), and the first valid result wins. Bounds the tail latency
+# of a slow provider instead of waiting out all of its retries before falling back.
+
+PARSE_POLICIES = {'fallback', 'race'}
+
+
+class RaceStats:
+    def __init__(self):
+        self.races = 0
+        # Races where the next model had to be started
+        self.hedged = 0
+        self.wins = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, hedged: bool, winner):
+        with self._lock:
+            self.races += 1
+            self.hedged += int(hedged)
+            self.wins[winner or 'NONE'] += 1
+
+    def stats(self):
+        with self._lock:
+            return {'races': self.races, 'hedged': self.hedged, 'wins': dict(self.wins)}
+
+
+def get_parse_policy(form, config):
+    """Returns (policy, hedge_delay, error_msg) from the optional parsePolicy and hedgeDelay form fields"""
+    policy = (form.get('parsePolicy') or config['PARSE_POLICY']).lower()
+    if policy not in PARSE_POLICIES:
+        return None, None, f"Invalid parsePolicy parameter, expected one of {sorted(PARSE_POLICIES)}"
+
+    try:
+        hedge_delay = float(form.get('hedgeDelay', config['PARSE_HEDGE_DELAY']))
+    except ValueError:
+        return None, None, 'Invalid hedgeDelay parameter, expected a number of seconds'
+    if hedge_delay < 0:
+        return None, None, 'Invalid hedgeDelay parameter, expected a number of seconds'
+
+    return policy, hedge_delay, None
+
+
+def _usable(candidates, task_name):
+    usable = []
+    for model_name, handler_cls, api_key in candidates:
+        if api_key == 'UNSET':
+            print(f'Skipping {model_name} {task_name}, {model_name} API key is not set')
+            continue
+        usable.append((model_name, handler_cls, api_key))
+    return usable
+
+
+def _record_result(outcome, candidates, model_name, result, task_name):
+    """Apply a finished attempt to the outcome, result is (handler, response) or the raised exception"""
+    if isinstance(result, APIKeyError):
+        FALLBACKS.labels(task_name, model_name, 'api_key').inc()
+        outcome.api_key_error_models.append(model_name)
+        if model_name == candidates[-1][0]:
+            outcome.invalid_api_keys = True
+    elif isinstance(result, Exception):
+        FALLBACKS.labels(task_name, model_name, 'error').inc()
+        print(f"Unexpected error occurred with {model_name}: {result}")
+    elif result[1] is None:
+        FALLBACKS.labels(task_name, model_name, 'no_result').inc()
+    elif outcome.response is None:
+        outcome.handler, outcome.response = result
+        print(f'{model_name} won the race')
+
+
+def run_race(candidates, call, task_name: str, hedge_delay: float, executor: ThreadPoolExecutor,
+             stats: RaceStats = None, health: ProviderHealth = None) -> FallbackOutcome:
+    """Race (model_name, cls, api_key) candidates in threads, returns the first non None call(instance) result
+
+    Threads cannot be interrupted, so the losers are cancelled through their cancel_event and stop before their
+    next retry.
+    """
+    outcome = FallbackOutcome()
+    if health is not None:
+        candidates = health.route(candidates, task_name)
+    usable = _usable(candidates, task_name)
+    cancel_event = threading.Event()
+    pending = {}
+    next_index = 0
+    hedged = False
+    winner = None
+
+    def attempt(model_name, handler_cls, api_key):
+        start = time.perf_counter()
+        try:
+            handler = handler_cls(api_key)
+            handler.cancel_event = cancel_event
+            response = call(handler)
+        except Exception as e:
+            record_call(health, model_name, task_name, start, e)
+            raise
+        # A loser stopped through cancel_event returns None after the winner's time, only a lower bound
+        record_call(health, model_name, task_name, start, response)
+        return handler, response
+
+    def launch():
+        nonlocal next_index
+        while next_index < len(usable):
+            model_name, handler_cls, api_key = usable[next_index]
+            next_index += 1
+            if not take_call(health, model_name, task_name):
+                continue
+            print(f'Running {model_name} {task_name}')
+            pending[executor.submit(attempt, model_name, handler_cls, api_key)] = model_name
+            return
+
+    # Nothing to race
+    if not usable:
+        return outcome
+
+    launch()
+    while pending:
+        can_hedge = next_index < len(usable)
+        done, _ = wait(pending, timeout=hedge_delay if can_hedge else None, return_when=FIRST_COMPLETED)
+        if not done:
+            # The running models are too slow, start the next one
+            hedged = True
+            launch()
+            continue
+
+        for future in done:
+            model_name = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            _record_result(outcome, candidates, model_name, result, task_name)
+            if outcome.response is not None and winner is None:
+                winner = model_name
+
+        if outcome.response is not None:
+            break
+        # Every running model failed, start the next one without waiting for the hedge delay
+        if not pending and next_index < len(usable):
+            launch()
+
+    cancel_event.set()
+    if outcome.response is not None:
+        outcome.invalid_api_keys = False
+    if stats is not None:
+        stats.record(hedged, winner)
+    return outcome
+
+
+async def run_race_async(candidates, call_async, task_name: str, hedge_delay: float,
+                         stats: RaceStats = None, health: ProviderHealth = None) -> FallbackOutcome:
+    """Same as run_race, the losing tasks are cancelled immediately"""
+    outcome = FallbackOutcome()
+    if health is not None:
+        candidates = health.route(candidates, task_name)
+    usable = _usable(candidates, task_name)
+    pending = {}
+    next_index = 0
+    hedged = False
+    winner = None
+
+    async def attempt(model_name, handler_cls, api_key):
+        start = time.perf_counter()
+        try:
+            handler = await asyncio.to_thread(handler_cls, api_key)
+            response = await call_async(handler)
+        except Exception as e:
+            # Cancelled losers raise CancelledError, which is not recorded
+            record_call(health, model_name, task_name, start, e)
+            raise
+        record_call(health, model_name, task_name, start, response)
+        return handler, response
+
+    def launch():
+        nonlocal next_index
+        while next_index < len(usable):
+            model_name, handler_cls, api_key = usable[next_index]
+            next_index += 1
+            if not take_call(health, model_name, task_name):
+                continue
+            print(f'Running {model_name} {task_name}')
+            pending[asyncio.ensure_future(attempt(model_name, handler_cls, api_key))] = model_name
+            return
+
+    if not usable:
+        return outcome
+
+    launch()
+    try:
+        while pending:
+            can_hedge = next_index < len(usable)
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay if can_hedge else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                launch()
+                continue
+
+            for task in done:
+                model_name = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    result = e
+                _record_result(outcome, candidates, model_name, result, task_name)
+                if outcome.response is not None and winner is None:
+                    winner = model_name
+
+            if outcome.response is not None:
+                break
+            if not pending and next_index < len(usable):
+                launch()
+    finally:
+        # Cancel the losers, also when the request itself is cancelled
+        for task in pending:
+            task.cancel()
+
+    if outcome.response is not None:
+        outcome.invalid_api_keys = False
+    if stats is not None:
+        stats.record(hedged, winner)
+    return outcome
@@ -0,0 +1,100 @@
+from collections import deque
+from concurrent.futures import Executor
+import asyncio
+import time
+from pdf2image import convert_from_path, pdfinfo_from_path
+from Exceptions import PageLimitError
+from metrics import PDF_PAGE_RENDER_SECONDS
+
+# Bounded memory PDF rasterization
+# Pages are rendered one at a time from the spooled upload instead of rendering the whole document into memory,
+# so the first page can be parsed while later pages are still rendering.
+
+
+def raster_options(config) -> dict:
+    return {
+        'dpi': config['PDF_DPI'],
+        'grayscale': config['PDF_GRAYSCALE'],
+        'max_pages': config['PDF_MAX_PAGES'],
+    }
+
+
+def get_page_count(path: str, max_pages: int = 0) -> int:
+    """Raises PageLimitError if the PDF has more than max_pages pages, a receipt missing pages would be wrong"""
+    page_count = pdfinfo_from_path(path)['Pages']
+    if max_pages and page_count > max_pages:
+        raise PageLimitError(page_count, max_pages)
+    return page_count
+
+
+def render_page(path: str, page_number: int, dpi: int = 200, grayscale: bool = False):
+    """Rasterize a single page, can run in a worker process"""
+    start = time.perf_counter()
+    page = convert_from_path(path, dpi=dpi, grayscale=grayscale, first_page=page_number, last_page=page_number)[0]
+    page.load()
+    # Metrics of a worker process are not scraped, the render time travels back with the page instead
+    page.info['render_seconds'] = time.perf_counter() - start
+    return page
+
+
+def _observe_render(page):
+    render_seconds = page.info.pop('render_seconds', None)
+    if render_seconds is not None:
+        PDF_PAGE_RENDER_SECONDS.observe(render_seconds)
+    return page
+
+
+def iter_pdf_pages(path: str, dpi: int = 200, grayscale: bool = False, max_pages: int = 0):
+    """Render the pages of a PDF lazily, in order"""
+    for page_number in range(1, get_page_count(path, max_pages) + 1):
+        yield _observe_render(render_page(path, page_number, dpi, grayscale))
+
+
+def iter_page_groups(path: str, executor: Executor, pages_per_group: int, prefetch: int,
+                     dpi: int = 200, grayscale: bool = False, max_pages: int = 0):
+    """Render pages in the executor, yielding each group of pages as soon as it is rendered
+
+    At most prefetch pages are rendered ahead of the consumer.
+    """
+    page_count = get_page_count(path, max_pages)
+    rendering = deque()
+    next_page = 1
+    group = []
+    while next_page <= page_count or rendering:
+        while next_page <= page_count and len(rendering) < prefetch:
+            rendering.append(executor.submit(render_page, path, next_page, dpi, grayscale))
+            next_page += 1
+
+        group.append(_observe_render(rendering.popleft().result()))
+        if len(group) == pages_per_group:
+            yield group
+            group = []
+
+    if group:
+        yield group
+
+
+async def iter_page_groups_async(path: str, executor: Executor, pages_per_group: int, prefetch: int,
+                                 dpi: int = 200, grayscale: bool = False, max_pages: int = 0):
+    """Same as iter_page_groups, without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    page_count = await asyncio.to_thread(get_page_count, path, max_pages)
+    rendering = deque()
+    next_page = 1
+    group = []
+    try:
+        while next_page <= page_count or rendering:
+            while next_page <= page_count and len(rendering) < prefetch:
+                rendering.append(loop.run_in_executor(executor, render_page, path, next_page, dpi, grayscale))
+                next_page += 1
+
+            group.append(_observe_render(await rendering.popleft()))
+            if len(group) == pages_per_group:
+                yield group
+                group = []
+
+        if group:
+            yield group
+    finally:
+        for future in rendering:
+            future.cancel()
@@ -1,25 +1,186 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-from gemini import GeminiReceiptParser, GeminiReceiptReview
-from Receipt import ReceiptEncoder
-from Exceptions import APIKeyError
-from gpt4o import OpenAIReceiptParser, OpenAIReceiptReview
+from Receipt import ReceiptEncoder, dumps_receipts
 from flask import Response
-from pdf2image import convert_from_bytes
+from Config import Config
+from ParseCache import create_parse_cache
+from breaker import create_provider_health
+from cassette import configure_cassette, get_cassette
+from InsightsCache import InsightsCache, create_insights_cache
+from RollingSummary import RollingSummaryStore, create_rolling_summary_store, get_user_key, PLAN_UNCHANGED
+from ReceiptReview import AbstractReview
+from race import RaceStats, get_parse_policy, run_race
+from pages import get_page_mode, combine_page_outcomes, parse_page_groups, max_groups_in_flight
+from preprocess import image_options, preprocess_stats
+from ocr import create_ocr_prepass, ocr_stats
+from TemplateStore import create_template_store, get_template_scope
+from DuplicateIndex import create_duplicate_index, get_duplicate_scope
+from rasterize import raster_options, iter_page_groups
+from metrics import record_request, metrics_response, time_stage
+from repair import repair_stats
+from jobs import create_job_queue, get_job_options, job_to_dict, JOB_QUEUED
+from batch import validate_batch, get_batch_format, spool_batch, close_batch, batch_result, summarize_batch
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from Exceptions import PageLimitError
+from pipeline import (allowed_file, is_pdf, validate_api_keys, validate_upload, get_parsers, get_reviewers,
+                      get_cache_candidates, load_receipt_images, run_with_fallback,
+                      SpooledUpload, DEFAULT_INSIGHTS)
+from summary import format_review_data
+from streaming import wants_stream, stream_review, sse_event, sse_insights, SSE_HEADERS
+import itertools
 import json
-import PIL.Image
+import time
 
-def create_app():
+def create_app(test_config=None):
     app = Flask(__name__)
+    app.config.from_object(Config)
+    if test_config is not None:
+        app.config.update(test_config)
     app.json_encoder = ReceiptEncoder
     CORS(app, resources={r"/*": {"origins": "*"}})
 
-    VALID_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
+    parse_cache = create_parse_cache(app.config)
+    app.extensions['parse_cache'] = parse_cache
+    insights_cache = create_insights_cache(app.config)
+    app.extensions['insights_cache'] = insights_cache
+    rolling_summaries = create_rolling_summary_store(app.config)
+    app.extensions['rolling_summaries'] = rolling_summaries
+    # Provider calls of the process go through the cassette, if CASSETTE_MODE is set
+    configure_cassette(app.config)
+    race_stats = RaceStats()
+    # None when the circuit breakers are disabled
+    provider_health = create_provider_health(app.config)
+    race_executor = ThreadPoolExecutor(max_workers=app.config['RACE_MAX_WORKERS'], thread_name_prefix='race')
+    raster_executor = ProcessPoolExecutor(max_workers=app.config['PDF_RASTER_WORKERS'] or None)
+    # None unless OCR_ENABLED, pages are then read locally first and sent as text when OCR is confident
+    ocr_prepass = create_ocr_prepass(app.config)
+    # Merchant templates learned from OCR pages, None when disabled
+    template_store = create_template_store(app.config)
+    # Perceptual hashes of parsed photos, None when disabled
+    duplicate_index = create_duplicate_index(app.config)
+    page_executor = ThreadPoolExecutor(max_workers=app.config['PAGE_PARSE_WORKERS'], thread_name_prefix='page')
+    batch_executor = ThreadPoolExecutor(max_workers=app.config['BATCH_MAX_WORKERS'], thread_name_prefix='batch')
+    job_queue = create_job_queue(app.config)
+    def insights_response(insights, stream, headers):
+        """Response of insights that are already complete"""
+        if stream:
+            return Response(sse_insights(insights), mimetype='text/event-stream', headers={**SSE_HEADERS, **headers}), 200
+        return jsonify(insights), 200, headers
+
+    # Background refreshes of stale cached insights
+    review_executor = ThreadPoolExecutor(max_workers=app.config['REVIEW_REFRESH_WORKERS'], thread_name_prefix='review')
+
+    def refresh_insights(cache_key, reviewers, receipt_str, query):
+        try:
+            outcome = run_with_fallback(reviewers, lambda reviewer: reviewer.review(receipt_str, query), 'reviewer',
+                                        provider_health)
+            if outcome.response is not None:
+                insights_cache.store(cache_key, outcome.response)
+        except Exception as e:
+            print(f"Unexpected error occurred refreshing insights: {e}")
+        finally:
+            insights_cache.finish_refresh(cache_key)
+
+    def parse_upload(filename, upload, parsers, parse_policy, hedge_delay, page_mode, pages_per_group,
+                     duplicate_scope=None, template_scope=None):
+        """Parse a spooled upload, returns (response_json, error_msg, status_code)
+
+        With duplicate_scope, re-uploads of the same file and photos in the near-duplicate index are flagged.
+        With template_scope, OCR pages are matched against and teach the merchant templates of that scope.
+        """
+        paged = page_mode != 'combined' and is_pdf(filename)
+
+        # Return the stored result if this exact file was already parsed by one of the usable models
+        content_hash = upload.content_hash
+        if paged:
+            content_hash = f"{content_hash}:{page_mode}:{pages_per_group}"
+        cached_json = parse_cache.lookup(content_hash, get_cache_candidates(parsers))
+        if cached_json is not None:
+            if duplicate_index is not None and duplicate_scope is not None:
+                cached_json = duplicate_index.check_cached(duplicate_scope, upload, cached_json)
+            return cached_json, None, 200
+
+        def parse_images(receipt_obj_list):
+            if ocr_prepass is not None:
+                receipt_obj_list = ocr_prepass.apply(receipt_obj_list)
+            if template_store is not None and template_scope is not None:
+                # Known merchant layouts are extracted from the OCR text without a model
+                outcome = template_store.match(template_scope, receipt_obj_list)
+                if outcome is not None:
+                    return outcome
+            if parse_policy == 'race':
+                # Start the next parser if the default one is slow, first valid receipt wins
+                outcome = run_race(parsers, lambda parser: parser.parse(receipt_obj_list), 'parser',
+                                   hedge_delay, race_executor, race_stats, provider_health)
+            else:
+                # Try each parser in order, default_model first, then the rest
+                outcome = run_with_fallback(parsers, lambda parser: parser.parse(receipt_obj_list), 'parser',
+                                            provider_health)
+            if template_store is not None and template_scope is not None:
+                template_store.learn(template_scope, receipt_obj_list, outcome)
+            return outcome
+
+        # (phash, dhash) of a photo to index once it is parsed, and the earlier upload it looks like
+        duplicate_hashes = None
+        duplicate_match = None
+        if paged:
+            # Parse each page group as soon as its pages are rendered, each prompt only carries its own pages
+            page_groups = iter_page_groups(upload.path, raster_executor, pages_per_group,
+                                           app.config['PDF_PREFETCH_PAGES'], **raster_options(app.config))
+            try:
+                # The page count is checked before the first page is rendered
+                outcomes = parse_page_groups(page_groups, parse_images, page_executor,
+                                             max_groups_in_flight(app.config['PDF_PREFETCH_PAGES'], pages_per_group))
+            except PageLimitError as e:
+                return None, str(e), 400
+            outcome = combine_page_outcomes(outcomes, page_mode)
+        else:
+            try:
+                receipt_obj_list = load_receipt_images(filename, upload.path, **raster_options(app.config),
+                                                       image_options=image_options(app.config))
+            except PageLimitError as e:
+                return None, str(e), 400
+            if duplicate_index is not None and duplicate_scope is not None and not is_pdf(filename):
+                # The same receipt photographed again is flagged, hashed before OCR replaces the image
+                duplicate_hashes, duplicate_match = duplicate_index.check(duplicate_scope, receipt_obj_list[0])
+                if duplicate_match is not None and duplicate_index.can_answer(duplicate_match):
+                    # Close enough to answer with the earlier parse without calling a model
+                    earlier_json = parse_cache.lookup(duplicate_match.content_hash, get_cache_candidates(parsers))
+                    duplicate_json = duplicate_index.answer(duplicate_match, upload, earlier_json)
+                    if duplicate_json is not None:
+                        return duplicate_json, None, 200
+            outcome = parse_images(receipt_obj_list)
+
+        if outcome.invalid_api_keys:
+            return None, f"Invalid API keys for {outcome.api_key_error_models}", 401
 
-    def allowed_file(filename):
-        return '.' in filename and \
-               filename.rsplit('.', 1)[1].lower() in VALID_IMAGE_EXTENSIONS
+        # After all parsers have been tried, if response is still None, return an error
+        if outcome.response is None:
+            return None, outcome.error or 'Image is not a receipt or error parsing receipt', 400
+
+        with time_stage('serialize'):
+            response_json = dumps_receipts(outcome.response).decode('utf-8')
+        parse_cache.store(content_hash, outcome.handler.model_name, outcome.handler.prompt_version, response_json)
+        if duplicate_index is not None and duplicate_scope is not None:
+            duplicate_index.add_upload(duplicate_scope, upload.content_hash)
+        if duplicate_hashes is not None:
+            duplicate_index.add(duplicate_scope, duplicate_hashes, upload.content_hash)
+        if duplicate_match is not None:
+            earlier_json = parse_cache.lookup(duplicate_match.content_hash, get_cache_candidates(parsers))
+            response_json = duplicate_index.resolve(duplicate_match, upload, response_json, earlier_json)
+        return response_json, None, 200
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_latency(response):
+        if 'request_start' in g:
+            rule = request.url_rule.rule if request.url_rule is not None else None
+            record_request(rule, request.method, response.status_code, time.perf_counter() - g.request_start)
+        return response
 
     @app.route('/review', methods=['POST'])
     def get_review():
@@ -35,80 +196,93 @@ def create_app():
             query = ""
 
         # Check if everything is received
-        if not default_model:
-            return jsonify({'error': 'Missing defaultModel parameter'}), 400
-
-        if (gemini_api_key in [None, 'UNSET']) and (openai_api_key in [None, 'UNSET']):
-            return jsonify({'error': 'Missing geminiKey or openaiKey parameter, at least 1 key is needed'}), 400
+        error = validate_api_keys(default_model, gemini_api_key, openai_api_key)
+        if error is not None:
+            return jsonify({'error': error}), 400
 
         if receipts is None:
             return jsonify({'error': 'Missing receipts parameter'}), 400
 
-        # Format list of receipts to string
-        receipt_str = ""
-        for receipt in receipts:
-            receipt_str += f"Merchant: {receipt['merchantName']}\n"
-            receipt_str += f"Date: {receipt['date']}\n"
-            receipt_str += f"Category: {receipt['category']}\n"
-            receipt_str += f"Total Cost: {receipt['totalCost']}\n"
-            receipt_str += "Itemized List:\n"
-            for item in receipt['itemizedList']:
-                receipt_str += f"  - {item['itemName']}: {item['itemQuantity']} x ${item['itemCost']}\n"
-            receipt_str += "\n"  # Add an extra newline to separate receipts
-        receipt_str = receipt_str.rstrip()
-
-        # Get insights for spending pattern
         # Receipts is a list of dicts
-        reviewers = [
-            ('GEMINI', GeminiReceiptReview, gemini_api_key),
-            ('OPENAI', OpenAIReceiptReview, openai_api_key),
-            # Additional reviewers can be added here
-        ]
-        # Make sure the default_model parser is the first in the list
-        reviewers.sort(key=lambda x: x[0] != default_model.upper())
-
-        response = None
-        api_key_error_models = []
-        # Try each parser in order, default_model first, then the rest
-        for model_name, parser_cls, api_key in reviewers:
-            if api_key == 'UNSET':
-                print(f'Skipping {model_name} reviewer, {model_name} API key is not set')
-                continue
-            try:
-                print(f'Reviewing with {model_name} reviewer')
-                # Init the parser
-                receipt_reviewer = parser_cls(api_key)
-                # Parse the receipt
-                response = receipt_reviewer.review(receipt_str, query)
-
-                # If response is not None, we successfully generated insights to the receipt
-                if response is not None:
-                    break
-            except APIKeyError:
-                api_key_error_models.append(model_name)
-                if model_name == reviewers[-1][0]:
-                    return jsonify({'error': f"Invalid API keys for {api_key_error_models}"}), 401
-            except Exception as e:
-                print(f"Unexpected error occurred while reviewing with {model_name}: {e}")
-                continue
-
-        # After all parsers have been tried, if response is still None, return an error
-        if response is None:
-            # Return standard insights
-            return jsonify("""Track your spending diligently to identify unnecessary expenses, prioritize needs over wants, and create a realistic budget.
-Cut costs by meal planning, reducing utility usage, and canceling unused subscriptions.
-Pay down high-interest debt aggressively while exploring cheaper alternatives for insurance, transportation, and entertainment.""".strip()), 200
-
-        # Use ReceiptEncoder explicitly because some error with pytest not using
-        print(response)
-        return jsonify(response), 200
+        reviewers = get_reviewers(default_model, gemini_api_key, openai_api_key)
+        stream = wants_stream(data, request.headers)
+
+        # Same receipts and query as a recent request, e.g. a dashboard reload
+        cache_key = InsightsCache.make_key(receipts, query, AbstractReview.prompt_version)
+        insights, stale = insights_cache.lookup(cache_key)
+        if insights is not None:
+            if stale and insights_cache.start_refresh(cache_key):
+                receipt_str = format_review_data(receipts, app.config['REVIEW_MAX_RAW_RECEIPTS'],
+                                                 app.config['REVIEW_SAMPLE_RECEIPTS'])
+                review_executor.submit(refresh_insights, cache_key, reviewers, receipt_str, query)
+            return insights_response(insights, stream, {'X-Insights-Cache': 'stale' if stale else 'hit'})
+
+        headers = {'X-Insights-Cache': 'miss'}
+        plan = None
+        if data.get('incremental'):
+            # Only the receipts added since the last summary of this user go to the reviewer
+            summary_key = RollingSummaryStore.make_key(get_user_key(data), query, AbstractReview.prompt_version)
+            plan = rolling_summaries.plan(summary_key, receipts)
+            headers['X-Review-Mode'] = plan.mode
+            if plan.mode == PLAN_UNCHANGED:
+                return insights_response(plan.insights, stream, headers)
+            receipt_str = plan.receipt_str
+        else:
+            # Long histories are summarized, so the prompt stays bounded
+            receipt_str = format_review_data(receipts, app.config['REVIEW_MAX_RAW_RECEIPTS'],
+                                             app.config['REVIEW_SAMPLE_RECEIPTS'])
+
+        def remember(insights):
+            insights_cache.store(cache_key, insights)
+            if plan is not None:
+                rolling_summaries.commit(plan, insights)
+
+        if stream:
+            events = stream_review(reviewers, receipt_str, query, health=provider_health)
+            # The first event arrives with the first insight text, or tells that the API keys are invalid
+            first_event = next(events)
+            if first_event[0] == 'invalid_api_keys':
+                return jsonify({'error': f"Invalid API keys for {first_event[1]}"}), 401
+
+            def generate():
+                for event in itertools.chain([first_event], events):
+                    if event[0] == 'done' and event[1]['insights'] != DEFAULT_INSIGHTS:
+                        remember(event[1]['insights'])
+                    yield sse_event(*event)
+            return Response(generate(), mimetype='text/event-stream', headers={**SSE_HEADERS, **headers}), 200
+
+        outcome = run_with_fallback(reviewers, lambda reviewer: reviewer.review(receipt_str, query), 'reviewer',
+                                    provider_health)
+        if outcome.invalid_api_keys:
+            return jsonify({'error': f"Invalid API keys for {outcome.api_key_error_models}"}), 401
+
+        # After all reviewers have been tried, if response is still None, return standard insights
+        if outcome.response is None:
+            return jsonify(DEFAULT_INSIGHTS), 200
+
+        print(outcome.response)
+        remember(outcome.response)
+        return jsonify(outcome.response), 200, headers
 
 
     @app.route('/upload', methods=['POST'])
     def upload_file():
-        # Check for parameters
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file received'}), 400
+        # Check if everything is received
+        error = validate_upload(request.files, request.form)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        parse_policy, hedge_delay, error = get_parse_policy(request.form, app.config)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        page_mode, pages_per_group, error = get_page_mode(request.form, app.config)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        run_async, callback_url, error = get_job_options(request.form, app.config['JOB_CALLBACK_ALLOWED_HOSTS'])
+        if error is not None:
+            return jsonify({'error': error}), 400
 
         # Unpack
         file = request.files['file']
@@ -116,76 +290,136 @@ Pay down high-interest debt aggressively while exploring cheaper alternatives fo
         gemini_api_key = request.form.get('geminiKey')
         openai_api_key = request.form.get('openaiKey')
 
-
-        # Check if everything is received
-        if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
-
-        if not default_model:
-            return jsonify({'error': 'Missing defaultModel parameter'}), 400
-
-        if (gemini_api_key in [None, 'UNSET']) and (openai_api_key in [None, 'UNSET']):
-            return jsonify({'error': 'Missing geminiKey or openaiKey parameter, at least 1 key is needed'}), 400
-
         # If file is present and correct type
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            # file.save(filename)
-
-            # Different format handler
-            if filename.rsplit('.', 1)[1].lower() == 'pdf':
-                file = convert_from_bytes(file.read())
-                receipt_obj_list = [img for img in file]
-            else:
-                # Single Png/jpg image
-                receipt_obj_list = [PIL.Image.open(file)]
-
-            parsers = [
-                ('GEMINI', GeminiReceiptParser, gemini_api_key),
-                ('OPENAI', OpenAIReceiptParser, openai_api_key),
-                # Additional parsers can be added here
-            ]
-            # Make sure the default_model parser is the first in the list
-            parsers.sort(key=lambda x: x[0] != default_model.upper())
-
-            response = None
-            api_key_error_models = []
-            # Try each parser in order, default_model first, then the rest
-            for model_name, parser_cls, api_key in parsers:
-                if api_key == 'UNSET':
-                    print(f'Skipping {model_name} parser, {model_name} API key is not set')
-                    continue
-                try:
-                    print(f'Parsing with {model_name} parser')
-                    # Init the parser
-                    receipt_parser = parser_cls(api_key)
-                    # Parse the receipt
-                    response = receipt_parser.parse(receipt_obj_list)
-
-                    # If response is not None, we successfully parsed the receipt
-                    if response is not None:
-                        break
-                except APIKeyError:
-                    api_key_error_models.append(model_name)
-                    if model_name == parsers[-1][0]:
-                        return jsonify({'error': f"Invalid API keys for {api_key_error_models}"}), 401
-                except Exception as e:
-                    print(f"Unexpected error occurred while parsing with {model_name}: {e}")
-                    continue
-
-            # After all parsers have been tried, if response is still None, return an error
-            if response is None:
-                return jsonify({'error': 'Image is not a receipt or error parsing receipt'}), 400
-
-            # Use ReceiptEncoder explicitly because some error with pytest not using
-            response_json = json.dumps(response, cls=ReceiptEncoder)
-            return Response(response_json, mimetype='application/json'), 200
+            parsers = get_parsers(default_model, gemini_api_key, openai_api_key)
+            duplicate_scope = get_duplicate_scope(request.form)
+            template_scope = get_template_scope(request.form)
+
+            # Spool the upload to a temp file instead of reading it into memory
+            with SpooledUpload(file.stream) as upload:
+                if run_async:
+                    # Parse in the background, the client polls /jobs/<id> or gets a callback
+                    job_id = job_queue.submit(
+                        filename, upload,
+                        lambda job_upload: parse_upload(filename, job_upload, parsers, parse_policy, hedge_delay,
+                                                        page_mode, pages_per_group, duplicate_scope,
+                                                        template_scope),
+                        callback_url)
+                    if job_id is None:
+                        return jsonify({'error': 'Too many queued jobs, try again later'}), 503, {'Retry-After': '30'}
+                    return jsonify({'job_id': job_id, 'status': JOB_QUEUED}), 202, {'Location': f'/jobs/{job_id}'}
+
+                response_json, error, status = parse_upload(filename, upload, parsers, parse_policy, hedge_delay,
+                                                             page_mode, pages_per_group, duplicate_scope,
+                                                             template_scope)
+            if error is not None:
+                return jsonify({'error': error}), status
+            headers = upload.duplicate.headers() if upload.duplicate is not None else {}
+            return Response(response_json, mimetype='application/json', headers=headers), status
 
         return jsonify({'error': 'Invalid file type received'}), 400
 
+    @app.route('/upload/batch', methods=['POST'])
+    def upload_batch():
+        # Check if everything is received
+        error = validate_batch(request.files, request.form)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        parse_policy, hedge_delay, error = get_parse_policy(request.form, app.config)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        page_mode, pages_per_group, error = get_page_mode(request.form, app.config)
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        batch_format = get_batch_format(request.form, request.headers)
+        parsers = get_parsers(request.form.get('defaultModel'), request.form.get('geminiKey'),
+                              request.form.get('openaiKey'))
+        duplicate_scope = get_duplicate_scope(request.form)
+        template_scope = get_template_scope(request.form)
+
+        items, error = spool_batch(request.files.getlist('files'), app.config['BATCH_MAX_FILES'],
+                                   app.config['BATCH_MAX_FILE_SIZE'], app.config['BATCH_MAX_TOTAL_SIZE'])
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+        def parse_item(item):
+            if item.error is not None:
+                return batch_result(item, error=item.error)
+            try:
+                response_json, error, status = parse_upload(item.filename, item.upload, parsers, parse_policy,
+                                                             hedge_delay, page_mode, pages_per_group, duplicate_scope,
+                                                             template_scope)
+            except Exception as e:
+                print(f"Unexpected error occurred parsing {item.filename}: {e}")
+                response_json, error, status = None, 'Error parsing receipt', 500
+            finally:
+                # Free the disk space as soon as the file is parsed
+                if item.upload is not None:
+                    item.upload.close()
+            return batch_result(item, response_json, error, status)
+
+        futures = [batch_executor.submit(parse_item, item) for item in items]
+
+        if batch_format == 'ndjson':
+            def generate():
+                try:
+                    for future in as_completed(futures):
+                        yield json.dumps(future.result()) + '\n'
+                finally:
+                    # Client went away, skip the files not started yet
+                    for future in futures:
+                        future.cancel()
+                    close_batch(items)
+            return Response(generate(), mimetype='application/x-ndjson'), 200
+
+        try:
+            return jsonify(summarize_batch([future.result() for future in futures])), 200
+        finally:
+            close_batch(items)
+
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    def get_job(job_id):
+        job = job_queue.store.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job_to_dict(job)), 200
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        body, content_type = metrics_response()
+        return Response(body, content_type=content_type), 200
+
+    @app.route('/providers', methods=['GET'])
+    def get_providers():
+        """Circuit breaker state, error rate and latency of each provider"""
+        if provider_health is None:
+            return jsonify({'enabled': False, 'providers': {}}), 200
+        return jsonify({'enabled': True, 'providers': provider_health.status()}), 200
+
+    @app.route('/stats', methods=['GET'])
+    def get_stats():
+        return jsonify({
+            'parse_cache': parse_cache.stats(),
+            'insights_cache': insights_cache.stats(),
+            'rolling_summaries': rolling_summaries.stats(),
+            'race': race_stats.stats(),
+            'images': preprocess_stats.stats(),
+            'ocr': ocr_stats.stats(),
+            'templates': template_store.stats() if template_store is not None else None,
+            'duplicates': duplicate_index.stats() if duplicate_index is not None else None,
+            'jobs': job_queue.stats(),
+            'repairs': repair_stats.stats(),
+            'cassette': get_cassette().stats() if get_cassette() is not None else None,
+        }), 200
+
     return app
 
 
 if __name__ == '__main__':
     app = create_app()
-    app.run(host='0.0.0.0', port=8081)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8081)
@@ -0,0 +1,198 @@
+from datetime import datetime
+import copy
+from decimal import Decimal
+import difflib
+import re
+import threading
+from dateutil import parser
+from dateutil.parser import ParserError
+from price_parser import Price
+from Receipt import Receipt, Category
+from Exceptions import ReceiptError
+from metrics import LOCAL_REPAIRS, RETRIES_AVOIDED
+
+# Local repair of receipt fields that failed validation
+# Most field errors are formatting the model got slightly wrong, fixing them here takes microseconds instead of
+# a correction round trip to the model. Only fields that cannot be repaired with confidence are sent back.
+
+DATE_FORMATS = ['%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%d/%m/%y', '%d-%m-%y', '%d.%m.%y', '%Y-%m-%d', '%Y/%m/%d',
+                '%Y.%m.%d', '%Y%m%d', '%d %b %Y', '%d %B %Y', '%b %d %Y', '%B %d %Y', '%d%b%Y', '%d%b%y']
+
+# Words models and receipts use for our categories
+CATEGORY_SYNONYMS = {
+    'grocery': Category.FOOD, 'groceries': Category.FOOD, 'restaurant': Category.FOOD, 'dining': Category.FOOD,
+    'drinks': Category.FOOD, 'cafe': Category.FOOD, 'supermarket': Category.FOOD,
+    'taxi': Category.TRANSPORT, 'fuel': Category.TRANSPORT, 'petrol': Category.TRANSPORT,
+    'parking': Category.TRANSPORT, 'travel': Category.TRANSPORT, 'transportation': Category.TRANSPORT,
+    'apparel': Category.CLOTHING, 'fashion': Category.CLOTHING, 'shoes': Category.CLOTHING,
+    'medical': Category.HEALTHCARE, 'pharmacy': Category.HEALTHCARE, 'health': Category.HEALTHCARE,
+    'clinic': Category.HEALTHCARE, 'hospital': Category.HEALTHCARE,
+    'entertainment': Category.LEISURE, 'movie': Category.LEISURE, 'cinema': Category.LEISURE,
+    'recreation': Category.LEISURE, 'sports': Category.LEISURE,
+    'hotel': Category.HOUSING, 'rent': Category.HOUSING, 'accommodation': Category.HOUSING,
+    'utilities': Category.HOUSING, 'lodging': Category.HOUSING,
+    'other': Category.OTHERS, 'misc': Category.OTHERS, 'miscellaneous': Category.OTHERS,
+    'electronics': Category.OTHERS, 'insurance': Category.OTHERS,
+}
+
+# OCR style letter for digit confusions
+_DIGIT_LOOKALIKES = {'O': '0', 'o': '0', 'l': '1', 'I': '1'}
+_ORDINAL_SUFFIX = re.compile(r'(?<=\d)(st|nd|rd|th)\b', re.IGNORECASE)
+
+
+def repair_date(value):
+    """Date string in the dd/mm/YYYY format Receipt expects, or None"""
+    if not isinstance(value, str):
+        return None
+    text = _ORDINAL_SUFFIX.sub('', value).strip()
+
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).strftime('%d/%m/%Y')
+        except ValueError:
+            continue
+
+    # Fuzzy parsing skips unknown words such as time zones, but also fills missing parts from the default,
+    # so only accept it when two different defaults give the same date
+    try:
+        first = parser.parse(text, dayfirst=True, fuzzy=True, default=datetime(2000, 1, 1))
+        second = parser.parse(text, dayfirst=True, fuzzy=True, default=datetime(2001, 2, 2))
+    except (ParserError, ValueError, OverflowError):
+        return None
+    if first.date() != second.date():
+        return None
+    return first.strftime('%d/%m/%Y')
+
+
+def repair_amount(value):
+    """Amount string, fixing OCR letters in numbers and decimal commas, or None"""
+    if value is None:
+        return None
+    text = str(value)
+    for letter, digit in _DIGIT_LOOKALIKES.items():
+        # Next to a digit and not part of a word, so 'Total12' keeps its l
+        text = re.sub(rf'(?<=\d){letter}(?![A-Za-z])|(?<![A-Za-z]){letter}(?=\d)', digit, text)
+    amount = Price.fromstring(text).amount
+    return None if amount is None else str(amount)
+
+
+def repair_category(value):
+    """Category value matching a misspelled, wrongly cased or synonym category, or None"""
+    if not isinstance(value, str):
+        return None
+    text = value.strip().lower()
+    for category in Category:
+        if category != Category.INVALID and text in (category.value.lower(), category.name.lower()):
+            return category.value
+    if text in CATEGORY_SYNONYMS:
+        return CATEGORY_SYNONYMS[text].value
+
+    names = [category.value.lower() for category in Category if category != Category.INVALID]
+    matches = difflib.get_close_matches(text, names + list(CATEGORY_SYNONYMS), n=1, cutoff=0.8)
+    if not matches:
+        return None
+    match = matches[0]
+    return CATEGORY_SYNONYMS[match].value if match in CATEGORY_SYNONYMS else Category(match.capitalize()).value
+
+
+def repair_itemized_list(items):
+    """Items with empty entries dropped and their costs repaired, or None if an item cannot be repaired"""
+    if items is None:
+        return []
+    if not isinstance(items, list):
+        return None
+    repaired = []
+    for item in items:
+        if not isinstance(item, dict):
+            return None
+        name = str(item.get('item_name') or '').strip()
+        cost = repair_amount(item.get('item_cost'))
+        if not name or name == 'None':
+            # Blank rows without a name are dropped, they add nothing to the receipt
+            continue
+        if cost is None:
+            return None
+        repaired.append({**item, 'item_cost': cost, 'item_quantity': item.get('item_quantity') or 1})
+    return repaired
+
+
+def total_from_items(items):
+    """Sum of the item costs, the costs on a receipt are line totals"""
+    amounts = [Price.fromstring(str(item.get('item_cost'))).amount for item in items or []]
+    if not amounts or any(amount is None for amount in amounts):
+        return None
+    return str(sum(amounts, Decimal(0)))
+
+
+def repair_field(receipt_dict: dict, error: ReceiptError):
+    """receipt_dict with the field of the error repaired, or None if it cannot be repaired locally"""
+    field_name = error.field_name.lstrip('_')
+    value = receipt_dict.get(field_name)
+
+    if field_name == 'date':
+        repaired = repair_date(value)
+    elif field_name == 'total_cost':
+        repaired = repair_amount(value)
+        if repaired is None:
+            repaired = total_from_items(repair_itemized_list(receipt_dict.get('itemized_list')))
+    elif field_name == 'category':
+        repaired = repair_category(value)
+    elif field_name == 'itemized_list':
+        repaired = repair_itemized_list(value)
+    else:
+        repaired = None
+
+    if repaired is None or repaired == value:
+        return None
+    LOCAL_REPAIRS.labels(field_name).inc()
+    repair_stats.record_repair(field_name)
+    return {**receipt_dict, field_name: repaired}
+
+
+def build_receipt(receipt_dict: dict):
+    """Validate receipt_dict, repairing fields locally before giving up
+
+    Returns (receipt, receipt_dict, error): the Receipt or None, the dict with the repairs applied, and the
+    ReceiptError of the first field that could not be repaired.
+    """
+    repaired_fields = set()
+    while True:
+        try:
+            # Receipt replaces the item costs in place, keep receipt_dict as the model returned it
+            receipt = Receipt(**copy.deepcopy(receipt_dict))
+        except ReceiptError as e:
+            # Each field is repaired at most once, a repair that does not validate goes to the model
+            repaired = None if e.field_name in repaired_fields else repair_field(receipt_dict, e)
+            if repaired is None:
+                return None, receipt_dict, e
+            repaired_fields.add(e.field_name)
+            receipt_dict = repaired
+            continue
+
+        if repaired_fields:
+            RETRIES_AVOIDED.inc()
+            repair_stats.record_avoided()
+        return receipt, receipt_dict, None
+
+
+class RepairStats:
+    def __init__(self):
+        self.repairs = {}
+        # Parses that validated after local repairs, each one a correction round trip saved
+        self.retries_avoided = 0
+        self._lock = threading.Lock()
+
+    def record_repair(self, field_name):
+        with self._lock:
+            self.repairs[field_name] = self.repairs.get(field_name, 0) + 1
+
+    def record_avoided(self):
+        with self._lock:
+            self.retries_avoided += 1
+
+    def stats(self):
+        with self._lock:
+            return {'repairs': dict(self.repairs), 'retries_avoided': self.retries_avoided}
+
+
+repair_stats = RepairStats()
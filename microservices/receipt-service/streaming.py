@@ -0,0 +1,193 @@
+import asyncio
+import json
+import re
+import time
+from Exceptions import APIKeyError
+from pipeline import DEFAULT_INSIGHTS
+from metrics import FALLBACKS
+from breaker import ProviderHealth, record_call, take_call
+
+# Streaming /review: insight text is forwarded as Server-Sent Events while the provider is still generating it
+# The reviewers stream the raw review JSON, InsightStream pulls the insights string out of it as it arrives and
+# validates the complete JSON against the review schema at the end.
+# Events: 'insight' {"text": ...} for each piece of text, then 'done' {"insights": ...} with the final insights.
+# Clients should show the done insights, they differ from the streamed text if the response failed validation.
+
+# Proxies such as nginx buffer responses by default, which would hold the events back
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+_INSIGHTS_VALUE = re.compile(r'"insights"\s*:\s*"')
+_HIGH_SURROGATE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}$')
+
+
+class InsightStream:
+    """Incremental reader of the insights string in a streamed review JSON"""
+    def __init__(self):
+        self.text = ''
+        # Index of the next unread character of the insights value, None until the value starts
+        self._pos = None
+        self._closed = False
+
+    def feed(self, chunk: str) -> str:
+        """Add a chunk of the response, returns the insight text it completes"""
+        self.text += chunk
+        if self._pos is None:
+            match = _INSIGHTS_VALUE.search(self.text)
+            if match is None:
+                return ''
+            self._pos = match.end()
+        if self._closed:
+            return ''
+
+        # Stop before an escape sequence that is not complete yet
+        start = self._pos
+        end = start
+        while end < len(self.text):
+            char = self.text[end]
+            if char == '"':
+                self._closed = True
+                break
+            if char == '\\':
+                length = 6 if self.text[end + 1:end + 2] == 'u' else 2
+                if end + length > len(self.text):
+                    break
+                end += length
+            else:
+                end += 1
+        segment = self.text[start:end]
+        # Half of a surrogate pair waits for the other half
+        if not self._closed and _HIGH_SURROGATE.search(segment):
+            segment = segment[:-6]
+        self._pos = start + len(segment)
+        if not segment:
+            return ''
+        return json.loads(f'"{segment}"')
+
+    def result(self):
+        """Insights of the complete response, None if it does not follow the review schema"""
+        try:
+            review = json.loads(self.text)
+        except ValueError:
+            return None
+        if not isinstance(review, dict) or not review.get('status') or not isinstance(review.get('insights'), str):
+            return None
+        return review['insights']
+
+
+def wants_stream(data: dict, headers) -> bool:
+    return bool(data.get('stream')) or 'text/event-stream' in headers.get('Accept', '')
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_insights(insights: str) -> str:
+    """Events of insights that are already complete, e.g. from the insights cache"""
+    return sse_event('insight', {'text': insights}) + sse_event('done', {'insights': insights})
+
+
+def stream_review(candidates, receipt_str: str, query: str, task_name: str = 'reviewer',
+                  health: ProviderHealth = None):
+    """Yield (event, data) of the first reviewer whose stream works, same candidates as run_with_fallback
+
+    A reviewer that fails before its first insight text falls back to the next one. Text already sent cannot be
+    taken back, so a stream that fails after that ends with the default insights. If the last reviewer has an
+    invalid API key, the only event is ('invalid_api_keys', models).
+    """
+    api_key_error_models = []
+    if health is not None:
+        candidates = health.route(candidates, task_name)
+    for model_name, handler_cls, api_key in candidates:
+        if api_key == 'UNSET':
+            print(f'Skipping {model_name} {task_name}, {model_name} API key is not set')
+            continue
+        if not take_call(health, model_name, task_name):
+            continue
+        stream = InsightStream()
+        sent = False
+        start = time.perf_counter()
+        try:
+            print(f'Streaming {model_name} {task_name}')
+            handler = handler_cls(api_key)
+            for text in handler.review_stream(receipt_str, query, stream):
+                sent = True
+                yield 'insight', {'text': text}
+        except APIKeyError as e:
+            record_call(health, model_name, task_name, start, e)
+            FALLBACKS.labels(task_name, model_name, 'api_key').inc()
+            api_key_error_models.append(model_name)
+            if model_name == candidates[-1][0]:
+                yield 'invalid_api_keys', api_key_error_models
+                return
+            continue
+        except Exception as e:
+            record_call(health, model_name, task_name, start, e)
+            FALLBACKS.labels(task_name, model_name, 'error').inc()
+            print(f"Unexpected error occurred with {model_name} {task_name} stream: {e}")
+            if sent:
+                yield 'done', {'insights': DEFAULT_INSIGHTS}
+                return
+            continue
+
+        insights = stream.result()
+        record_call(health, model_name, task_name, start, insights)
+        if insights is not None or sent:
+            if insights is None:
+                print(f"{model_name} {task_name} stream does not follow the review schema")
+            yield 'done', {'insights': DEFAULT_INSIGHTS if insights is None else insights}
+            return
+        FALLBACKS.labels(task_name, model_name, 'no_result').inc()
+
+    yield 'done', {'insights': DEFAULT_INSIGHTS}
+
+
+async def stream_review_async(candidates, receipt_str: str, query: str, task_name: str = 'reviewer',
+                              health: ProviderHealth = None):
+    """Same as stream_review, with the async reviewer streams"""
+    api_key_error_models = []
+    if health is not None:
+        candidates = health.route(candidates, task_name)
+    for model_name, handler_cls, api_key in candidates:
+        if api_key == 'UNSET':
+            print(f'Skipping {model_name} {task_name}, {model_name} API key is not set')
+            continue
+        if not take_call(health, model_name, task_name):
+            continue
+        stream = InsightStream()
+        sent = False
+        start = time.perf_counter()
+        try:
+            print(f'Streaming {model_name} {task_name}')
+            # Construction may fetch model info on first use, keep it off the event loop
+            handler = await asyncio.to_thread(handler_cls, api_key)
+            async for text in handler.review_stream_async(receipt_str, query, stream):
+                sent = True
+                yield 'insight', {'text': text}
+        except APIKeyError as e:
+            record_call(health, model_name, task_name, start, e)
+            FALLBACKS.labels(task_name, model_name, 'api_key').inc()
+            api_key_error_models.append(model_name)
+            if model_name == candidates[-1][0]:
+                yield 'invalid_api_keys', api_key_error_models
+                return
+            continue
+        except Exception as e:
+            record_call(health, model_name, task_name, start, e)
+            FALLBACKS.labels(task_name, model_name, 'error').inc()
+            print(f"Unexpected error occurred with {model_name} {task_name} stream: {e}")
+            if sent:
+                yield 'done', {'insights': DEFAULT_INSIGHTS}
+                return
+            continue
+
+        insights = stream.result()
+        record_call(health, model_name, task_name, start, insights)
+        if insights is not None or sent:
+            if insights is None:
+                print(f"{model_name} {task_name} stream does not follow the review schema")
+            yield 'done', {'insights': DEFAULT_INSIGHTS if insights is None else insights}
+            return
+        FALLBACKS.labels(task_name, model_name, 'no_result').inc()
+
+    yield 'done', {'insights': DEFAULT_INSIGHTS}
@@ -0,0 +1,283 @@
+from collections import defaultdict
+from datetime import date as Date, datetime
+import statistics
+from dateutil import parser
+from dateutil.parser import ParserError
+from pipeline import format_receipts
+from metrics import time_stage
+
+# Spending summary for /review
+# A long receipt history sent verbatim grows the review prompt without bound. Past REVIEW_MAX_RAW_RECEIPTS receipts
+# the reviewer gets totals per category, month and merchant, the top items, trends and unusual receipts instead,
+# plus the most recent receipts verbatim, so the prompt size stays the same whatever the history length.
+
+# Rows of each section of the summary, these bound the prompt
+MAX_CATEGORIES = 10
+TOP_MERCHANTS = 5
+TOP_ITEMS = 5
+MAX_MONTHS = 12
+MAX_ANOMALIES = 5
+# A receipt is unusual if it costs this many times the typical receipt of its category
+ANOMALY_RATIO = 3.0
+# Categories need a few receipts before one of them can stand out
+ANOMALY_MIN_RECEIPTS = 5
+# Merchants and items kept in stored running totals, the rest of the long tail is dropped
+MAX_TRACKED = 200
+
+
+def _to_amount(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_date(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        return parser.isoparse(value).date()
+    except ValueError:
+        pass
+    try:
+        return parser.parse(value, dayfirst=True).date()
+    except (ParserError, ValueError, OverflowError):
+        return None
+
+
+def _money(amount: float) -> str:
+    return f"${amount:,.2f}"
+
+
+def _change(current: float, previous: float) -> str:
+    change = (current - previous) / previous * 100
+    return f"{abs(change):.0f}% {'above' if change >= 0 else 'below'}"
+
+
+def new_totals() -> dict:
+    """Running totals of a receipt history, plain dicts so they can be stored as json and added to later"""
+    return {
+        'receipts': 0,
+        'total': 0.0,
+        'first_date': None,
+        'last_date': None,
+        'categories': {},
+        'merchants': {},
+        'months': {},
+        # category -> month -> amount
+        'category_months': {},
+        'items': {},
+    }
+
+
+def _add(totals: dict, name: str, amount: float, count: float = 1):
+    entry = totals.setdefault(name, [0.0, 0])
+    entry[0] += amount
+    entry[1] += count
+
+
+def add_receipts(totals: dict, receipts):
+    """Add receipts from the /review request to the totals, in a single pass over the receipts and items
+
+    Returns the dated (date, merchant, category, amount) rows of the receipts, for find_anomalies.
+    """
+    dated = []
+    for receipt in receipts:
+        amount = _to_amount(receipt.get('totalCost'))
+        if amount is None:
+            continue
+        date = _to_date(receipt.get('date'))
+        category = str(receipt.get('category') or 'Others')
+        merchant = str(receipt.get('merchantName') or 'Unknown')
+
+        totals['total'] += amount
+        totals['receipts'] += 1
+        _add(totals['categories'], category, amount)
+        _add(totals['merchants'], merchant, amount)
+        if date is not None:
+            month = date.strftime('%Y-%m')
+            _add(totals['months'], month, amount)
+            category_months = totals['category_months'].setdefault(category, {})
+            category_months[month] = category_months.get(month, 0.0) + amount
+            day = date.isoformat()
+            if totals['first_date'] is None or day < totals['first_date']:
+                totals['first_date'] = day
+            if totals['last_date'] is None or day > totals['last_date']:
+                totals['last_date'] = day
+            dated.append((date, merchant, category, amount))
+
+        for item in receipt.get('itemizedList') or []:
+            cost = _to_amount(item.get('itemCost'))
+            quantity = _to_amount(item.get('itemQuantity')) or 1
+            if cost is None:
+                continue
+            name = str(item.get('itemName') or '').strip()
+            if name:
+                _add(totals['items'], name, cost * quantity, quantity)
+    return dated
+
+
+def compact_totals(totals: dict, max_entries: int = MAX_TRACKED) -> dict:
+    """Totals with only the largest merchants and items kept, so stored totals do not grow with the history"""
+    compacted = dict(totals)
+    for key in ('merchants', 'items'):
+        entries = sorted(totals[key].items(), key=lambda entry: -entry[1][0])[:max_entries]
+        compacted[key] = dict(entries)
+    return compacted
+
+
+def finish_summary(totals: dict, anomalies=()) -> dict:
+    """Summary for format_summary from the running totals"""
+    first_date, last_date = totals['first_date'], totals['last_date']
+    return {
+        'receipts': totals['receipts'],
+        'total': totals['total'],
+        'first_date': Date.fromisoformat(first_date) if first_date is not None else None,
+        'last_date': Date.fromisoformat(last_date) if last_date is not None else None,
+        'categories': sorted(((name, list(entry)) for name, entry in totals['categories'].items()),
+                             key=lambda entry: -entry[1][0]),
+        'merchants': sorted(((name, list(entry)) for name, entry in totals['merchants'].items()),
+                            key=lambda entry: -entry[1][0])[:TOP_MERCHANTS],
+        'months': sorted((month, list(entry)) for month, entry in totals['months'].items()),
+        'category_months': {(category, month): amount
+                            for category, months in totals['category_months'].items()
+                            for month, amount in months.items()},
+        'items': sorted(((name, list(entry)) for name, entry in totals['items'].items()),
+                        key=lambda entry: -entry[1][0])[:TOP_ITEMS],
+        'anomalies': list(anomalies),
+    }
+
+
+def summarize_spending(receipts) -> dict:
+    """Totals of a receipts array from the /review request"""
+    totals = new_totals()
+    dated = add_receipts(totals, receipts)
+    return finish_summary(totals, find_anomalies(dated))
+
+
+def find_anomalies(dated):
+    """Receipts costing far more than the median receipt of their category, largest ratio first"""
+    by_category = defaultdict(list)
+    for row in dated:
+        by_category[row[2]].append(row[3])
+    medians = {category: statistics.median(amounts) for category, amounts in by_category.items()
+               if len(amounts) >= ANOMALY_MIN_RECEIPTS}
+
+    anomalies = []
+    for date, merchant, category, amount in dated:
+        median = medians.get(category)
+        if median and amount >= median * ANOMALY_RATIO:
+            anomalies.append((amount / median, date, merchant, category, amount))
+    anomalies.sort(key=lambda anomaly: -anomaly[0])
+    return anomalies[:MAX_ANOMALIES]
+
+
+def find_new_anomalies(totals: dict, dated):
+    """Like find_anomalies for receipts about to be added to totals, compared with the average of their category
+
+    The totals keep no per receipt amounts, so the category average stands in for the median.
+    """
+    anomalies = []
+    for date, merchant, category, amount in dated:
+        total, count = totals['categories'].get(category, (0.0, 0))
+        if count >= ANOMALY_MIN_RECEIPTS and total and amount >= total / count * ANOMALY_RATIO:
+            anomalies.append((amount / (total / count), date, merchant, category, amount))
+    anomalies.sort(key=lambda anomaly: -anomaly[0])
+    return anomalies[:MAX_ANOMALIES]
+
+
+def find_trends(summary: dict):
+    """Sentences comparing the latest month with the months before it"""
+    months = summary['months']
+    if len(months) < 2:
+        return []
+    trends = []
+    last_month, (last_total, _) = months[-1]
+    previous_month = months[-2][0]
+
+    earlier = [month_total for _, (month_total, _) in months[-4:-1]]
+    average = sum(earlier) / len(earlier)
+    if average:
+        trends.append(f"Spending in {last_month} was {_money(last_total)}, {_change(last_total, average)} the "
+                      f"average of the {len(earlier)} months before")
+
+    # Categories that moved the most between the last two months
+    changes = []
+    for category, _ in summary['categories']:
+        last = summary['category_months'].get((category, last_month), 0.0)
+        previous = summary['category_months'].get((category, previous_month), 0.0)
+        if previous and last != previous:
+            changes.append((abs(last - previous), category, last, previous))
+    for _, category, last, previous in sorted(changes, reverse=True)[:3]:
+        trends.append(f"{category} was {_money(last)} in {last_month}, {_change(last, previous)} "
+                      f"{previous_month} ({_money(previous)})")
+    return trends
+
+
+def format_summary(summary: dict) -> str:
+    lines = []
+    period = ''
+    if summary['first_date'] is not None:
+        period = f" from {summary['first_date'].isoformat()} to {summary['last_date'].isoformat()}"
+    average = summary['total'] / summary['receipts'] if summary['receipts'] else 0.0
+    lines.append(f"Spending summary of {summary['receipts']} receipts{period}, total {_money(summary['total'])}, "
+                 f"average {_money(average)} per receipt")
+
+    lines.append("By category:")
+    categories = summary['categories']
+    if len(categories) > MAX_CATEGORIES:
+        rest = categories[MAX_CATEGORIES - 1:]
+        categories = categories[:MAX_CATEGORIES - 1] + [(f"{len(rest)} other categories",
+                                                         [sum(entry[1][0] for entry in rest),
+                                                          sum(entry[1][1] for entry in rest)])]
+    for category, (amount, count) in categories:
+        share = amount / summary['total'] * 100 if summary['total'] else 0.0
+        lines.append(f"  - {category}: {_money(amount)} ({share:.1f}%, {count} receipts)")
+
+    months = summary['months']
+    if months:
+        lines.append("By month:")
+        if len(months) > MAX_MONTHS:
+            earlier_total = sum(amount for _, (amount, _) in months[:-MAX_MONTHS])
+            earlier_count = sum(count for _, (_, count) in months[:-MAX_MONTHS])
+            lines.append(f"  - Before {months[-MAX_MONTHS][0]}: {_money(earlier_total)} ({earlier_count} receipts)")
+        for month, (amount, count) in months[-MAX_MONTHS:]:
+            lines.append(f"  - {month}: {_money(amount)} ({count} receipts)")
+
+    lines.append("Top merchants:")
+    for merchant, (amount, count) in summary['merchants']:
+        lines.append(f"  - {merchant}: {_money(amount)} ({count} visits)")
+
+    if summary['items']:
+        lines.append("Top items:")
+        for name, (amount, quantity) in summary['items']:
+            lines.append(f"  - {name}: {_money(amount)} ({quantity:g} bought)")
+
+    trends = find_trends(summary)
+    if trends:
+        lines.append("Trends:")
+        lines.extend(f"  - {trend}" for trend in trends)
+
+    if summary['anomalies']:
+        lines.append("Unusual receipts:")
+        for ratio, date, merchant, category, amount in summary['anomalies']:
+            lines.append(f"  - {date.isoformat()} {merchant} {_money(amount)} ({category}), "
+                         f"{ratio:.1f}x the typical {category} receipt")
+    return "\n".join(lines)
+
+
+def _receipt_date(receipt):
+    return _to_date(receipt.get('date')) or datetime.min.date()
+
+
+def format_review_data(receipts, max_raw_receipts: int = 20, sample_size: int = 5) -> str:
+    """Spending data for the reviewer prompt: the receipts verbatim if there are few, else a summary"""
+    with time_stage('review_data'):
+        if len(receipts) <= max_raw_receipts:
+            return format_receipts(receipts)
+
+        text = format_summary(summarize_spending(receipts))
+        if sample_size:
+            recent = sorted(receipts, key=_receipt_date, reverse=True)[:sample_size]
+            text += "\n\nMost recent receipts:\n" + format_receipts(recent)
+        return text
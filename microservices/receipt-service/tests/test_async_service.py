@@ -0,0 +1,91 @@
+import asyncio
+import io
+import json
+from werkzeug.datastructures import FileStorage
+from asyncservice import create_async_app
+from ReceiptParser import AbstractParser
+
+
+class ScriptedParser(AbstractParser):
+    """Replies with the given responses in order instead of calling a provider"""
+    def __init__(self, responses):
+        super().__init__(api_key='TEST', receipt_schema=None, model_name='scripted')
+        self.responses = list(responses)
+        self.sent = []
+
+    def build_initial_message(self, receipt_obj_list):
+        return [self.initial_prompt, *self.build_receipt_parts(receipt_obj_list)]
+
+    def build_text_part(self, text: str):
+        return text
+
+    def build_image_part(self, img, thumbnail: bool = False):
+        # Sent as is, there is no provider to encode the image for
+        return img
+
+    def build_retry_message(self, error_msg):
+        return [error_msg]
+
+    def send_message(self, message):
+        self.sent.append(message)
+        return json.dumps(self.responses.pop(0)), 100
+
+    async def send_message_async(self, message):
+        await asyncio.sleep(0)
+        return self.send_message(message)
+
+    def get_input_token_limit(self):
+        return 128000
+
+    def get_token_count(self, prompt):
+        return len(prompt)
+
+
+VALID_RECEIPT = {"merchant_name": "Shell", "date": "01/01/2024", "total_cost": "31.92", "category": "Transport",
+                 "itemized_list": [{"item_name": "Fuel", "item_cost": "31.92", "item_quantity": 1}]}
+
+
+def test_sync_and_async_parse_share_retry_loop():
+    responses = [dict(VALID_RECEIPT, date="31st of Smarch"), VALID_RECEIPT]
+
+    sync_parser = ScriptedParser(responses)
+    async_parser = ScriptedParser(responses)
+    sync_receipt = sync_parser.parse(['image'])
+    async_receipt = asyncio.run(async_parser.parse_async(['image']))
+
+    assert sync_receipt.total_cost == async_receipt.total_cost == "31.92"
+    assert sync_parser.sent == async_parser.sent
+    # The retry turn is text only and carries the field error back to the model
+    assert "date" in sync_parser.sent[1].text
+
+
+def test_async_upload_validation():
+    def test_file():
+        return {'file': FileStorage(io.BytesIO(b'test file content'), filename='test_image.jpg')}
+
+    async def post_all():
+        # Created in the running loop, on python 3.9 Quart binds its locks to the loop of its constructor
+        client = create_async_app().test_client()
+        results = []
+        for form, files in [({'defaultModel': 'GEMINI', 'geminiKey': 'test'}, {}),
+                            ({'geminiKey': 'test'}, test_file()),
+                            ({'defaultModel': 'OPENAI', 'geminiKey': 'UNSET', 'openaiKey': 'UNSET'}, test_file())]:
+            response = await client.post('/upload', form=form, files=files)
+            results.append((response.status_code, await response.get_json()))
+        return results
+
+    assert asyncio.run(post_all()) == [
+        (400, {'error': 'No file received'}),
+        (400, {'error': 'Missing defaultModel parameter'}),
+        (400, {'error': 'Missing geminiKey or openaiKey parameter, at least 1 key is needed'}),
+    ]
+
+
+def test_async_review_validation():
+    async def post(data):
+        client = create_async_app().test_client()
+        response = await client.post('/review', json=data)
+        return response.status_code, await response.get_json()
+
+    assert asyncio.run(post({"apiKeys": {"defaultModel": "gemini", "geminiKey": "TESTKEY1"}})) == \
+           (400, {'error': 'Missing receipts parameter'})
@@ -0,0 +1,110 @@
+import asyncio
+import io
+import json
+import zipfile
+import PIL.Image
+from werkzeug.datastructures import FileStorage
+import asyncservice
+import receiptservice
+from receiptservice import create_app
+from tests.test_async_service import ScriptedParser, VALID_RECEIPT
+
+
+class BatchParser(ScriptedParser):
+    default_model_version = 'scripted'
+
+    def __init__(self, api_key):
+        super().__init__([VALID_RECEIPT])
+
+
+def make_image(shade):
+    buffer = io.BytesIO()
+    PIL.Image.new('RGB', (64, 64), (shade, shade, shade)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def make_zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def post_batch(client, files, **form):
+    data = {'defaultModel': 'GEMINI', 'geminiKey': 'TEST', **form,
+            'files': [(io.BytesIO(content), name) for name, content in files]}
+    return client.post('/upload/batch', data=data)
+
+
+def test_batch_validation(app_client):
+    response = app_client.post('/upload/batch', data={'defaultModel': 'GEMINI', 'geminiKey': 'TEST'})
+    assert response.status_code == 400
+    assert response.json == {'error': 'No files received'}
+
+    response = post_batch(app_client, [('receipt.png', make_image(10))], format='xml')
+    assert response.status_code == 400
+
+
+def test_batch_total_size_is_bounded_after_expanding_zips():
+    image = make_image(20)
+    client = create_app({'BATCH_MAX_TOTAL_SIZE': len(image) * 3}).test_client()
+
+    # Zip members count toward the total with their expanded size
+    members = {f'receipt{num}.png': image for num in range(4)}
+    response = post_batch(client, [('receipts.zip', make_zip(members))])
+    assert response.status_code == 400
+    assert response.json == {'error': f"Batch too large, at most {len(image) * 3} bytes of files per batch"}
+
+    response = post_batch(client, [('receipts.zip', make_zip(dict(list(members.items())[:2]))),
+                                   ('receipt.png', image), ('other.png', image)])
+    assert response.status_code == 400
+
+
+def test_batch_results_in_upload_order(monkeypatch):
+    monkeypatch.setattr(receiptservice, 'get_parsers', lambda *args: [('GEMINI', BatchParser, 'TEST')])
+    client = create_app().test_client()
+
+    files = [
+        ('first.png', make_image(10)),
+        ('notes.txt', b'not a receipt'),
+        ('archive.zip', make_zip({'scans/second.png': make_image(20), 'readme.md': b'#'})),
+    ]
+    response = post_batch(client, files)
+
+    assert response.status_code == 200
+    assert response.json['parsed'] == 2
+    assert response.json['failed'] == 2
+    results = response.json['results']
+    assert [result['filename'] for result in results] == ['first.png', 'notes.txt', 'second.png', 'readme.md']
+    assert [result['status'] for result in results] == [200, 400, 200, 400]
+    assert results[0]['result']['merchant_name'] == 'Shell'
+
+
+def test_batch_ndjson(monkeypatch):
+    monkeypatch.setattr(receiptservice, 'get_parsers', lambda *args: [('GEMINI', BatchParser, 'TEST')])
+    client = create_app().test_client()
+
+    response = post_batch(client, [('first.png', make_image(30)), ('second.png', make_image(40))],
+                          format='ndjson')
+
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert sorted(line['filename'] for line in lines) == ['first.png', 'second.png']
+    assert all(line['status'] == 200 for line in lines)
+
+
+def test_async_batch(monkeypatch):
+    monkeypatch.setattr(asyncservice, 'get_parsers', lambda *args: [('GEMINI', BatchParser, 'TEST')])
+    async def post():
+        # Created inside the loop it runs on, see tests/test_async_service.py
+        client = asyncservice.create_async_app().test_client()
+        archive = make_zip({'first.png': make_image(50), 'notes.txt': b'x'})
+        files = {'files': FileStorage(io.BytesIO(archive), filename='receipts.zip')}
+        response = await client.post('/upload/batch', form={'defaultModel': 'GEMINI', 'geminiKey': 'TEST'},
+                                     files=files)
+        return response.status_code, await response.get_json()
+
+    status, body = asyncio.run(post())
+    assert status == 200
+    assert [result['status'] for result in body['results']] == [200, 400]
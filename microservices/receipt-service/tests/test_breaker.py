@@ -0,0 +1,178 @@
+from breaker import CircuitBreaker, ProviderHealth, CLOSED, OPEN, HALF_OPEN
+from pipeline import run_with_fallback
+from receiptservice import create_app
+from Exceptions import APIKeyError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_handler(result=None, error=None):
+    class Handler:
+        created = 0
+
+        def __init__(self, api_key):
+            Handler.created += 1
+
+        def parse(self):
+            if error is not None:
+                raise error
+            return result
+
+    return Handler
+
+
+def make_breaker(clock):
+    return CircuitBreaker('GEMINI', window_seconds=60, min_calls=4, error_rate=0.5, open_seconds=30, clock=clock)
+
+
+def test_breaker_opens_on_error_rate_and_probes_when_half_open():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    for ok in (True, False, True):
+        breaker.record('parser', ok, 1.0)
+    assert breaker.current_state() == CLOSED
+    breaker.record('parser', False, 1.0)
+
+    assert breaker.current_state() == OPEN
+    assert not breaker.allow()
+    clock.now += 30
+    assert breaker.current_state() == HALF_OPEN
+    # Only one probe at a time
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record('parser', False, 1.0)
+    assert breaker.current_state() == OPEN
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record('parser', True, 1.0)
+    assert breaker.current_state() == CLOSED
+    assert breaker.status()['opened'] == 2
+
+
+def test_old_failures_leave_the_window():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    breaker.record('parser', False, 1.0)
+    breaker.record('parser', False, 1.0)
+    clock.now += 61
+    breaker.record('parser', False, 1.0)
+    breaker.record('parser', True, 1.0)
+
+    assert breaker.current_state() == CLOSED
+
+
+def test_invalid_api_keys_do_not_count():
+    breaker = make_breaker(FakeClock())
+    for _ in range(10):
+        breaker.record('parser', None, 1.0)
+
+    assert breaker.current_state() == CLOSED
+    assert breaker.status()['calls'] == 0
+
+
+def test_failing_default_is_tried_last():
+    health = ProviderHealth(min_calls=100, clock=FakeClock())
+    failing = make_handler(error=ConnectionError('down'))
+    working = make_handler(result='receipt')
+    candidates = [('GEMINI', failing, 'KEY'), ('OPENAI', working, 'KEY')]
+
+    for _ in range(3):
+        assert run_with_fallback(candidates, lambda parser: parser.parse(), 'parser', health).response == 'receipt'
+    assert failing.created == 1
+
+
+def test_route_keeps_default_first_unless_degraded():
+    health = ProviderHealth(min_calls=100, latency_ratio=3.0, clock=FakeClock())
+    candidates = [('GEMINI', None, 'KEY'), ('OPENAI', None, 'KEY')]
+    assert [c[0] for c in health.route(candidates, 'parser')] == ['GEMINI', 'OPENAI']
+
+    # Twice as slow is tolerated, more than three times is not
+    health.record('GEMINI', 'parser', True, 4.0)
+    health.record('OPENAI', 'parser', True, 2.0)
+    assert [c[0] for c in health.route(candidates, 'parser')] == ['GEMINI', 'OPENAI']
+    health.record('GEMINI', 'parser', True, 20.0)
+    health.record('GEMINI', 'parser', True, 20.0)
+    assert [c[0] for c in health.route(candidates, 'parser')] == ['OPENAI', 'GEMINI']
+    # Latency is per task
+    assert [c[0] for c in health.route(candidates, 'reviewer')] == ['GEMINI', 'OPENAI']
+
+    health.record('OPENAI', 'reviewer', False, 1.0)
+    assert [c[0] for c in health.route(candidates, 'reviewer')] == ['GEMINI', 'OPENAI']
+
+
+def test_open_provider_is_skipped_without_a_call():
+    health = ProviderHealth(min_calls=2, error_rate=0.5, open_seconds=30, clock=FakeClock())
+    failing = make_handler(error=ConnectionError('down'))
+    working = make_handler(result='receipt')
+    candidates = [('GEMINI', failing, 'KEY'), ('OPENAI', working, 'KEY')]
+
+    for _ in range(2):
+        assert run_with_fallback(candidates[:1], lambda parser: parser.parse(), 'parser', health).response is None
+    assert failing.created == 2
+
+    outcome = run_with_fallback(candidates, lambda parser: parser.parse(), 'parser', health)
+    assert outcome.response == 'receipt'
+    assert failing.created == 2
+    assert health.status()['GEMINI']['state'] == OPEN
+
+
+def test_routing_does_not_take_the_half_open_probe():
+    clock = FakeClock()
+    health = ProviderHealth(min_calls=2, error_rate=0.5, open_seconds=30, clock=clock)
+    health.record('OPENAI', 'parser', False, 1.0)
+    health.record('OPENAI', 'parser', False, 1.0)
+    clock.now += 30
+    fallback = make_handler(result='receipt')
+    candidates = [('GEMINI', make_handler(result='receipt'), 'KEY'), ('OPENAI', fallback, 'KEY')]
+
+    # OPENAI is routed but never called, its probe is still free for the next request that needs it
+    for _ in range(3):
+        assert run_with_fallback(candidates, lambda parser: parser.parse(), 'parser', health).response == 'receipt'
+    assert fallback.created == 0
+    assert health.breaker('OPENAI').allow()
+    assert not health.breaker('OPENAI').available()
+
+
+def test_only_provider_side_errors_open_the_breaker():
+    class StatusError(Exception):
+        def __init__(self, status_code):
+            super().__init__(f'status {status_code}')
+            self.status_code = status_code
+
+    health = ProviderHealth(min_calls=2, error_rate=0.5, clock=FakeClock())
+    # One user's rate limit, a rejected request or an unusable reply is not the provider failing
+    for error in (StatusError(429), StatusError(400), ValueError('not json')):
+        candidates = [('GEMINI', make_handler(error=error), 'KEY')]
+        run_with_fallback(candidates, lambda parser: parser.parse(), 'parser', health)
+    assert health.status()['GEMINI']['state'] == CLOSED
+    assert health.status()['GEMINI']['calls'] == 0
+
+    for error in (StatusError(503), TimeoutError()):
+        candidates = [('GEMINI', make_handler(error=error), 'KEY')]
+        run_with_fallback(candidates, lambda parser: parser.parse(), 'parser', health)
+    assert health.status()['GEMINI']['state'] == OPEN
+
+
+def test_invalid_key_of_routed_last_provider():
+    health = ProviderHealth(clock=FakeClock())
+    candidates = [('GEMINI', make_handler(error=APIKeyError()), 'KEY')]
+
+    outcome = run_with_fallback(candidates, lambda parser: parser.parse(), 'parser', health)
+
+    assert outcome.invalid_api_keys
+    assert health.status()['GEMINI']['state'] == CLOSED
+
+
+def test_providers_endpoint():
+    client = create_app().test_client()
+    assert client.get('/providers').get_json() == {'enabled': True, 'providers': {}}
+
+    client = create_app({'BREAKER_ENABLED': False}).test_client()
+    assert client.get('/providers').get_json() == {'enabled': False, 'providers': {}}
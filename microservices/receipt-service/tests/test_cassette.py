@@ -0,0 +1,171 @@
+import asyncio
+import json
+import time
+import pytest
+from Config import Config
+from Exceptions import APIKeyError
+from ReceiptReview import AbstractReview
+from receiptservice import create_app
+from cassette import Cassette, CassetteMiss, use_cassette, set_cassette, get_cassette
+from benchmarks.mock_provider import MockProvider, start_mock_provider, DEFAULT_INSIGHTS
+
+REVIEW = {'status': True, 'insights': 'Cook at home.'}
+
+
+class CountingReviewer(AbstractReview):
+    """Answers every message after delay seconds and counts the calls, stands in for a provider"""
+    delay = 0.0
+
+    def __init__(self, api_key='KEY'):
+        super().__init__(api_key=api_key, review_schema=None, model_name='counting')
+        self.calls = 0
+
+    def build_initial_message(self, receipt_str, query):
+        return [self.initial_prompt, receipt_str, query]
+
+    def build_retry_message(self, error_msg):
+        return [error_msg]
+
+    def send_message(self, message):
+        self.calls += 1
+        time.sleep(self.delay)
+        return json.dumps(REVIEW), 100
+
+    async def send_message_async(self, message):
+        return self.send_message(message)
+
+    def stream_message(self, message):
+        self.calls += 1
+        text = json.dumps(REVIEW)
+        for i in range(0, len(text), 4):
+            yield text[i:i + 4]
+
+    async def stream_message_async(self, message):
+        for chunk in self.stream_message(message):
+            yield chunk
+
+    def get_input_token_limit(self):
+        return 128000
+
+    def get_token_count(self, prompt):
+        return len(prompt)
+
+
+class OfflineReviewer(CountingReviewer):
+    def send_message(self, message):
+        raise ConnectionError('no network in replay')
+
+    def stream_message(self, message):
+        raise ConnectionError('no network in replay')
+
+
+class InvalidKeyReviewer(CountingReviewer):
+    def send_message(self, message):
+        raise APIKeyError()
+
+
+@pytest.fixture
+def cassette_path(tmp_path):
+    yield str(tmp_path / 'providers.json.gz')
+    set_cassette(None)
+
+
+def test_replay_returns_recorded_reply_without_calling_provider(cassette_path):
+    reviewer = CountingReviewer()
+    with use_cassette(cassette_path, 'record') as cassette:
+        assert reviewer.review('receipts', 'query') == REVIEW['insights']
+    assert reviewer.calls == 1
+    assert cassette.stats()['recorded'] == 1
+
+    # Another key, same conversation
+    with use_cassette(cassette_path, 'replay') as cassette:
+        assert OfflineReviewer(api_key='OTHER').review('receipts', 'query') == REVIEW['insights']
+        assert asyncio.run(OfflineReviewer().review_async('receipts', 'query')) == REVIEW['insights']
+    assert cassette.stats()['hits'] == 2
+    assert get_cassette() is None
+
+
+def test_replay_miss_raises(cassette_path):
+    with use_cassette(cassette_path, 'record'):
+        CountingReviewer().review('receipts', 'query')
+    with use_cassette(cassette_path, 'replay'):
+        with pytest.raises(CassetteMiss):
+            OfflineReviewer().review('receipts', 'another query')
+
+
+def test_auto_records_only_misses(cassette_path):
+    reviewer = CountingReviewer()
+    with use_cassette(cassette_path, 'auto') as cassette:
+        reviewer.review('receipts', 'query')
+        reviewer.review('receipts', 'query')
+        reviewer.review('receipts', 'another query')
+    assert reviewer.calls == 2
+    assert cassette.stats() == {'mode': 'auto', 'entries': 2, 'hits': 1, 'misses': 2, 'recorded': 2}
+
+
+def test_invalid_key_is_replayed(cassette_path):
+    with use_cassette(cassette_path, 'record'):
+        with pytest.raises(APIKeyError):
+            InvalidKeyReviewer().review('receipts', 'query')
+    with use_cassette(cassette_path, 'replay'):
+        with pytest.raises(APIKeyError):
+            OfflineReviewer().review('receipts', 'query')
+
+
+def test_stream_is_replayed_chunk_by_chunk(cassette_path):
+    class Stream:
+        def feed(self, chunk):
+            return chunk
+
+    with use_cassette(cassette_path, 'record'):
+        recorded = list(CountingReviewer().review_stream('receipts', 'query', Stream()))
+    with use_cassette(cassette_path, 'replay'):
+        replayed = list(OfflineReviewer().review_stream('receipts', 'query', Stream()))
+
+        async def collect():
+            return [chunk async for chunk in OfflineReviewer().review_stream_async('receipts', 'query', Stream())]
+        replayed_async = asyncio.run(collect())
+    assert len(recorded) > 1
+    assert replayed == replayed_async == recorded
+
+
+def test_latency_preserved_or_collapsed(cassette_path):
+    reviewer = CountingReviewer()
+    reviewer.delay = 0.2
+    with use_cassette(cassette_path, 'record'):
+        reviewer.review('receipts', 'query')
+
+    start = time.perf_counter()
+    with use_cassette(cassette_path, 'replay', latency='preserve'):
+        OfflineReviewer().review('receipts', 'query')
+    assert time.perf_counter() - start >= 0.2
+
+    start = time.perf_counter()
+    with use_cassette(cassette_path, 'replay', latency='collapse'):
+        OfflineReviewer().review('receipts', 'query')
+    assert time.perf_counter() - start < 0.2
+
+
+def test_unknown_mode_rejected(cassette_path):
+    with pytest.raises(ValueError):
+        Cassette(cassette_path, 'rewind')
+
+
+def test_service_replays_recorded_provider_calls(cassette_path, monkeypatch):
+    # Record a review through the mock provider, then replay it with the mock gone
+    mock = MockProvider(latency=0.01, jitter=0, seed=0)
+    server = start_mock_provider(mock)
+    monkeypatch.setattr(Config, 'OPENAI_BASE_URL', f"http://127.0.0.1:{server.server_address[1]}/v1")
+    review = {'apiKeys': {'defaultModel': 'OPENAI', 'openaiKey': 'CASSETTE-RECORD'},
+              'receipts': [], 'query': 'Where can I save?'}
+    config = {'CASSETTE_MODE': 'record', 'CASSETTE_PATH': cassette_path, 'INSIGHTS_CACHE_TTL': 0}
+    try:
+        recorded = create_app(config).test_client().post('/review', json=review)
+    finally:
+        server.shutdown()
+
+    review['apiKeys']['openaiKey'] = 'CASSETTE-REPLAY'
+    client = create_app({**config, 'CASSETTE_MODE': 'replay'}).test_client()
+    replayed = client.post('/review', json=review)
+    assert recorded.get_json() == replayed.get_json() == DEFAULT_INSIGHTS
+    assert client.get('/stats').get_json()['cassette']['hits'] == 1
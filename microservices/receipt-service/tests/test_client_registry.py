@@ -0,0 +1,83 @@
+import asyncio
+import time
+import google.generativeai as genai
+from ClientRegistry import ClientRegistry
+from gemini import bind_client
+
+
+class FakeClient:
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_reuses_client_per_api_key():
+    registry = ClientRegistry(factory=FakeClient, close=FakeClient.close)
+
+    client = registry.get('key1')
+    assert registry.get('key1') is client
+    assert registry.get('key2') is not client
+    assert len(registry) == 2
+
+
+def test_drops_least_recently_used_client_when_full():
+    registry = ClientRegistry(factory=FakeClient, max_size=2, close=FakeClient.close)
+    client1 = registry.get('key1')
+    client2 = registry.get('key2')
+    # Touch key1 so key2 becomes the least recently used
+    registry.get('key1')
+    registry.get('key3')
+
+    assert registry.get('key1') is client1
+    assert registry.get('key2') is not client2
+    # An in-flight request may still hold the dropped client, it is left open
+    assert not client2.closed
+    assert len(registry) == 2
+
+
+def test_drops_idle_clients(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    registry = ClientRegistry(factory=FakeClient, idle_ttl=60, close=FakeClient.close)
+    client = registry.get('key1')
+
+    now[0] += 61
+    new_client = registry.get('key1')
+
+    assert new_client is not client
+    assert not client.closed
+
+    registry.clear()
+    assert new_client.closed
+    assert len(registry) == 0
+
+
+class FakeGenerativeClient:
+    def __init__(self):
+        self.requests = []
+
+    def generate_content(self, request, **kwargs):
+        self.requests.append(request)
+        return genai.protos.GenerateContentResponse(candidates=[{'content': {'parts': [{'text': 'ok'}]}}])
+
+
+
+class FakeGenerativeAsyncClient(FakeGenerativeClient):
+    async def generate_content(self, request, **kwargs):
+        return super().generate_content(request, **kwargs)
+
+
+def test_gemini_model_handles_send_through_the_bound_client():
+    # Fails if the pinned google-generativeai changes how GenerativeModel holds its clients
+    model = genai.GenerativeModel('models/gemini-1.5-flash')
+    client = FakeGenerativeClient()
+    async_client = FakeGenerativeAsyncClient()
+    bind_client(model, '_client', client)
+    bind_client(model, '_async_client', async_client)
+
+    assert model.generate_content('hello').text == 'ok'
+    assert asyncio.run(model.generate_content_async('hello')).text == 'ok'
+    assert len(client.requests) == 1 and len(async_client.requests) == 1
@@ -0,0 +1,146 @@
+from io import BytesIO
+from pathlib import Path
+import json
+from DuplicateIndex import (DuplicateIndex, image_hashes, hamming, get_duplicate_scope, DUPLICATE_RETURNED,
+                            DUPLICATE_WARNED)
+from preprocess import normalize_image
+import PIL.Image
+import PIL.ImageEnhance
+
+IMAGES_DIR = Path(__file__).parent / 'media/receipts_images'
+
+
+class UploadStub:
+    def __init__(self):
+        self.duplicate = None
+
+
+def load(name):
+    return normalize_image(PIL.Image.open(IMAGES_DIR / name))
+
+
+def rephotographed(img):
+    # Slightly darker, smaller and re-encoded, like a second photo of the same receipt
+    img = PIL.ImageEnhance.Brightness(img).enhance(0.85)
+    img = img.resize((img.width * 3 // 4, img.height * 3 // 4))
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=60)
+    return normalize_image(PIL.Image.open(buffer))
+
+
+def test_rephotographed_receipt_is_a_near_duplicate():
+    index = DuplicateIndex()
+    food = load('food1.jpeg')
+    index.add('user:1', image_hashes(food), 'a' * 64)
+
+    match = index.lookup('user:1', image_hashes(rephotographed(food)))
+    assert match is not None and match.content_hash == 'a' * 64
+    assert match.phash_distance <= index.max_phash_distance
+
+    # Other receipts and other users are not matched
+    for name in ['clothing1.jpg', 'healthcare1.jpg', 'transport1.jpg', 'transport2.JPG']:
+        assert index.lookup('user:1', image_hashes(load(name))) is None
+    assert index.lookup('user:2', image_hashes(food)) is None
+
+
+def test_lookup_probes_chunks_within_the_distance():
+    index = DuplicateIndex(max_phash_distance=8, max_dhash_distance=256)
+    index.add('user:1', (0x0123456789abcdef, 0), 'a' * 64)
+
+    # 8 bits flipped, 2 in each 16 bit chunk, at least one chunk is still within 8 // 4 bits
+    near = 0x0123456789abcdef ^ 0x0003000300030003
+    assert hamming(near, 0x0123456789abcdef) == 8
+    assert index.lookup('user:1', (near, 0)).phash_distance == 8
+    assert index.lookup('user:1', (near ^ 0x10, 0)) is None
+
+
+def test_resolve_flags_only_the_same_receipt():
+    food = load('food1.jpeg')
+    earlier_json = json.dumps({'merchant_name': 'FOOD REPUBLIC PTE LT', 'date': '01/01/2024', 'total_cost': '12.50'})
+    reparsed_json = json.dumps({'merchant_name': 'Food Republic Pte Lt ', 'date': '01/01/2024', 'total_cost': '12.50',
+                                'category': 'FOOD'})
+
+    index = DuplicateIndex(mode='return')
+    hashes, match = index.check('user:1', food)
+    assert match is None
+    index.add('user:1', hashes, 'a' * 64)
+
+    # Same merchant, date and total once parsed again, answered with the earlier parse
+    upload = UploadStub()
+    _, match = index.check('user:1', rephotographed(food))
+    response = json.loads(index.resolve(match, upload, reparsed_json, earlier_json))
+    assert response['merchant_name'] == 'FOOD REPUBLIC PTE LT' and 'category' not in response
+    assert response['duplicate']['outcome'] == DUPLICATE_RETURNED
+    assert upload.duplicate.headers()['X-Duplicate'] == DUPLICATE_RETURNED
+
+    # A similar looking receipt with another total is not a duplicate
+    upload = UploadStub()
+    other_json = json.dumps(dict(json.loads(reparsed_json), total_cost='8.00'))
+    assert index.resolve(match, upload, other_json, earlier_json) == other_json
+    assert upload.duplicate is None
+
+    # The earlier parse is no longer cached, the upload keeps its own parse but is flagged
+    upload = UploadStub()
+    response = json.loads(index.resolve(match, upload, reparsed_json, None))
+    assert response['category'] == 'FOOD' and response['duplicate']['outcome'] == DUPLICATE_WARNED
+
+    warn_index = DuplicateIndex()
+    warn_index.add('user:1', hashes, 'a' * 64)
+    _, match = warn_index.check('user:1', food)
+    response = json.loads(warn_index.resolve(match, UploadStub(), reparsed_json, earlier_json))
+    assert response['category'] == 'FOOD' and response['duplicate']['outcome'] == DUPLICATE_WARNED
+    assert warn_index.stats() == {'returned': 0, 'warned': 1, 'none': 0, 'size': 1, 'uploads': 0}
+
+
+def test_return_mode_answers_close_matches_without_parsing():
+    earlier_json = json.dumps({'merchant_name': 'FOOD REPUBLIC PTE LT'})
+    index = DuplicateIndex(mode='return', return_phash_distance=4, return_dhash_distance=24)
+    index.add('user:1', (0x0123456789abcdef, 0), 'a' * 64)
+
+    close = index.lookup('user:1', (0x0123456789abcdef ^ 0b111, 0))
+    upload = UploadStub()
+    response = json.loads(index.answer(close, upload, earlier_json))
+    assert response['duplicate'] == {'outcome': DUPLICATE_RETURNED, 'of': 'a' * 16, 'distance': 3}
+    assert upload.duplicate is close
+    # No longer cached, the upload is parsed
+    assert index.answer(close, UploadStub(), None) is None
+
+    # Borderline matches are parsed to confirm them, and 'warn' mode always parses
+    borderline = index.lookup('user:1', (0x0123456789abcdef ^ 0b11111111, 0))
+    assert not index.can_answer(borderline)
+    assert not DuplicateIndex(mode='warn').can_answer(close)
+
+
+def test_cached_reupload_is_flagged_in_the_same_scope_only():
+    index = DuplicateIndex()
+    upload = UploadStub()
+    upload.content_hash = 'b' * 64
+    cached_json = json.dumps([{'merchant_name': 'Shell'}, {'merchant_name': 'Shell'}])
+    index.add_upload('user:1', upload.content_hash)
+
+    assert index.check_cached('user:2', upload, cached_json) == cached_json
+    assert upload.duplicate is None
+    # Split documents are flagged receipt by receipt
+    response = json.loads(index.check_cached('user:1', upload, cached_json))
+    assert [receipt['duplicate']['distance'] for receipt in response] == [0, 0]
+    assert upload.duplicate.outcome == DUPLICATE_RETURNED
+    # The first cache hit of user:2 was remembered
+    assert 'duplicate' in json.loads(index.check_cached('user:2', upload, cached_json))[0]
+
+
+def test_oldest_entries_are_dropped():
+    index = DuplicateIndex(max_size=2)
+    # 32 or more bits apart from each other
+    phashes = [0, 0xffffffff00000000, 0x00000000ffffffff]
+    for num, entry_phash in enumerate(phashes):
+        index.add('user:1', (entry_phash, 0), str(num) * 64)
+
+    assert index.stats()['size'] == 2
+    assert index.lookup('user:1', (phashes[0], 0)) is None
+    assert index.lookup('user:1', (phashes[2], 0)).content_hash == '2' * 64
+
+
+def test_duplicate_scope():
+    assert get_duplicate_scope({'userId': '42'}) == 'user:42'
+    assert get_duplicate_scope({'geminiKey': 'key'}).startswith('keys:')
+    assert get_duplicate_scope({'userId': '42', 'allowDuplicate': 'true'}) is None
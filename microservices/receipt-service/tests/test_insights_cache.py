@@ -0,0 +1,118 @@
+import json
+import time
+import receiptservice
+from receiptservice import create_app
+from InsightsCache import InsightsCache, create_insights_cache
+from ParseCache import MemoryCacheBackend
+from tests.test_review_stream import StreamingReviewer, REVIEW, parse_events
+
+RECEIPTS = [
+    {'id': 1, 'merchantName': 'FairPrice', 'date': '2024-03-01', 'category': 'Groceries', 'totalCost': 12.5,
+     'itemizedList': [{'itemName': 'Milk', 'itemQuantity': 1, 'itemCost': 4.5},
+                      {'itemName': 'Bread', 'itemQuantity': 2, 'itemCost': 4}]},
+    {'id': 2, 'merchantName': 'Kopitiam', 'date': '2024-03-02', 'category': 'Food', 'totalCost': 6,
+     'itemizedList': []},
+]
+
+
+class CountingReviewer(StreamingReviewer):
+    calls = 0
+
+    def send_message(self, message):
+        CountingReviewer.calls += 1
+        return super().send_message(message)
+
+
+def make_request(receipts=RECEIPTS, query='', stream=False):
+    return {'apiKeys': {'defaultModel': 'GEMINI', 'geminiKey': 'TEST', 'openaiKey': 'TEST'},
+            'receipts': receipts, 'query': query, 'stream': stream}
+
+
+def test_key_ignores_order_ids_and_number_format():
+    reordered = [dict(RECEIPTS[1], id=7, totalCost=6.0, merchantName=' Kopitiam '),
+                 dict(RECEIPTS[0], itemizedList=RECEIPTS[0]['itemizedList'][::-1])]
+
+    assert InsightsCache.make_key(RECEIPTS, 'Food?', 1) == InsightsCache.make_key(reordered, ' food? ', 1)
+
+
+def test_key_changes_with_receipts_query_and_prompt_version():
+    key = InsightsCache.make_key(RECEIPTS, '', 1)
+    edited = [dict(RECEIPTS[0], totalCost=13), RECEIPTS[1]]
+
+    assert InsightsCache.make_key(edited, '', 1) != key
+    assert InsightsCache.make_key(RECEIPTS[:1], '', 1) != key
+    assert InsightsCache.make_key(RECEIPTS, 'groceries', 1) != key
+    assert InsightsCache.make_key(RECEIPTS, '', 2) != key
+
+
+def test_fresh_stale_and_expired_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    cache = InsightsCache(MemoryCacheBackend(max_size=10), ttl=60, stale_ttl=600)
+    cache.store('key', 'Spend less')
+
+    assert cache.lookup('key') == ('Spend less', False)
+    now[0] += 120
+    assert cache.lookup('key') == ('Spend less', True)
+    now[0] += 600
+    assert cache.lookup('key') == (None, False)
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['stale_hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_only_one_refresh_per_key():
+    cache = InsightsCache(MemoryCacheBackend(max_size=10), ttl=60, stale_ttl=600)
+
+    assert cache.start_refresh('key')
+    assert not cache.start_refresh('key')
+    cache.finish_refresh('key')
+    assert cache.start_refresh('key')
+
+
+def test_zero_ttl_disables_the_cache():
+    cache = create_insights_cache({'INSIGHTS_CACHE_BACKEND': 'memory', 'INSIGHTS_CACHE_MAX_SIZE': 10,
+                                   'INSIGHTS_CACHE_TTL': 0, 'INSIGHTS_CACHE_STALE_TTL': 0})
+    cache.store('key', 'Spend less')
+
+    assert cache.lookup('key') == (None, False)
+
+
+def test_repeated_review_is_served_from_cache(monkeypatch):
+    monkeypatch.setattr(receiptservice, 'get_reviewers', lambda *args: [('GEMINI', CountingReviewer, 'TEST')])
+    CountingReviewer.calls = 0
+    client = create_app().test_client()
+
+    first = client.post('/review', json=make_request())
+    second = client.post('/review', json=make_request(receipts=RECEIPTS[::-1]))
+    streamed = client.post('/review', json=make_request(stream=True))
+
+    assert CountingReviewer.calls == 1
+    assert first.headers['X-Insights-Cache'] == 'miss'
+    assert second.headers['X-Insights-Cache'] == 'hit'
+    assert second.get_json() == first.get_json() == REVIEW['insights']
+    assert parse_events(streamed.get_data(as_text=True)) == [('insight', {'text': REVIEW['insights']}),
+                                                              ('done', {'insights': REVIEW['insights']})]
+    stats = json.loads(client.get('/stats').get_data(as_text=True))['insights_cache']
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+
+
+def test_stale_insights_are_returned_and_refreshed(monkeypatch):
+    monkeypatch.setattr(receiptservice, 'get_reviewers', lambda *args: [('GEMINI', CountingReviewer, 'TEST')])
+    CountingReviewer.calls = 0
+    app = create_app({'INSIGHTS_CACHE_TTL': 60, 'INSIGHTS_CACHE_STALE_TTL': 600})
+    cache = app.extensions['insights_cache']
+    key = InsightsCache.make_key(RECEIPTS, '', 1)
+    cache.backend.set(key, json.dumps({'insights': 'Old insights', 'created_at': time.time() - 120}))
+
+    response = app.test_client().post('/review', json=make_request())
+
+    assert response.headers['X-Insights-Cache'] == 'stale'
+    assert response.get_json() == 'Old insights'
+    for _ in range(100):
+        if cache.lookup(key) == (REVIEW['insights'], False):
+            break
+        time.sleep(0.05)
+    assert cache.lookup(key) == (REVIEW['insights'], False)
+    assert CountingReviewer.calls == 1
@@ -0,0 +1,149 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import asyncio
+import io
+import socket
+import threading
+import time
+from werkzeug.datastructures import FileStorage
+import asyncservice
+import receiptservice
+from receiptservice import create_app
+from jobs import (JobStore, create_job_queue, get_job_options, check_callback_url, post_callback, JOB_FAILED,
+                  JOB_QUEUED)
+from tests.test_batch_upload import BatchParser, make_image
+
+
+def job_config(tmp_path, **overrides):
+    return {'JOB_DB_PATH': str(tmp_path / 'jobs.sqlite3'), 'JOB_UPLOAD_DIR': str(tmp_path / 'jobs'), **overrides}
+
+
+def post_async(client, **form):
+    return client.post('/upload', data={'defaultModel': 'GEMINI', 'geminiKey': 'TEST', 'async': 'true', **form,
+                                        'file': (io.BytesIO(make_image(60)), 'receipt.png')})
+
+
+def test_async_upload_job(monkeypatch, tmp_path):
+    monkeypatch.setattr(receiptservice, 'get_parsers', lambda *args: [('GEMINI', BatchParser, 'TEST')])
+    client = create_app(job_config(tmp_path)).test_client()
+
+    response = post_async(client)
+    assert response.status_code == 202
+    job_id = response.json['job_id']
+    assert response.headers['Location'].endswith(f'/jobs/{job_id}')
+
+    for _ in range(100):
+        job = client.get(f'/jobs/{job_id}').json
+        if job['status'] not in ('queued', 'running'):
+            break
+        time.sleep(0.05)
+    assert job['status'] == 'done'
+    assert job['status_code'] == 200
+    assert job['result']['merchant_name'] == 'Shell'
+    # The upload is removed once parsed
+    assert list((tmp_path / 'jobs').iterdir()) == []
+
+    assert client.get('/jobs/unknown').status_code == 404
+
+
+def test_async_upload_backpressure_and_validation(tmp_path):
+    client = create_app(job_config(tmp_path, JOB_MAX_PENDING=0)).test_client()
+
+    response = post_async(client)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '30'
+
+    assert post_async(client, callbackUrl='ftp://example.com').status_code == 400
+
+
+def test_unfinished_jobs_fail_on_restart(tmp_path):
+    config = {**job_config(tmp_path), 'JOB_WORKERS': 1, 'JOB_MAX_PENDING': 1, 'JOB_TTL': 0,
+              'JOB_CALLBACK_TIMEOUT': 1.0, 'JOB_LEASE': 60, 'JOB_CALLBACK_WORKERS': 1,
+              'JOB_CALLBACK_ALLOWED_HOSTS': []}
+    store = JobStore(config['JOB_DB_PATH'])
+    store.create('orphan', 'receipt.png')
+    # Still leased by another live process sharing the database
+    store.create('live', 'receipt.png', owner='other', lease=60)
+    (tmp_path / 'jobs').mkdir()
+    (tmp_path / 'jobs' / 'orphan.png').write_bytes(b'x')
+    (tmp_path / 'jobs' / 'live.png').write_bytes(b'x')
+
+    queue = create_job_queue(config)
+
+    job = queue.store.get('orphan')
+    assert job['status'] == JOB_FAILED
+    assert job['status_code'] == 500
+    assert queue.store.get('live')['status'] == JOB_QUEUED
+    assert [path.name for path in (tmp_path / 'jobs').iterdir()] == ['live.png']
+
+
+def test_callback_urls_must_be_public_or_allowed(monkeypatch):
+    form = {'async': 'true', 'callbackUrl': 'http://169.254.169.254/latest/meta-data'}
+    assert get_job_options(form)[2] == 'Invalid callbackUrl parameter, expected a public host'
+    assert get_job_options({**form, 'callbackUrl': 'http://localhost:8081/metrics'})[2] is not None
+    assert get_job_options({**form, 'callbackUrl': 'https://hooks.example.com/receipts'})[2] is None
+    assert get_job_options({**form, 'callbackUrl': 'http://backend:3000/jobs'}, ['backend'])[2] is None
+    assert get_job_options({**form, 'callbackUrl': 'https://hooks.example.com/receipts'}, ['backend'])[2] is not None
+
+    # Host names are checked again when the callback is sent
+    monkeypatch.setattr(socket, 'getaddrinfo', lambda host, port: [(None, None, None, '', ('10.0.0.5', 0))])
+    assert check_callback_url('https://hooks.example.com/receipts') == \
+           'Invalid callbackUrl parameter, expected a public host'
+    assert not post_callback('https://hooks.example.com/receipts', {}, attempts=1)
+
+
+def test_callbacks_go_to_the_checked_address_and_do_not_follow_redirects(monkeypatch):
+    received = []
+
+    class CallbackHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            received.append((self.path, self.headers['Host']))
+            if self.path == '/moved':
+                self.send_response(302)
+                self.send_header('Location', f'http://127.0.0.1:{self.server.server_port}/internal')
+            else:
+                self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), CallbackHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+    getaddrinfo = socket.getaddrinfo
+    lookups = []
+
+    def resolve_once(host, *args):
+        # Only the check resolves the host name, the connection goes to the address it checked
+        if host == 'hooks.test':
+            lookups.append(host)
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+        return getaddrinfo(host, *args)
+
+    monkeypatch.setattr(socket, 'getaddrinfo', resolve_once)
+    try:
+        assert post_callback(f'http://hooks.test:{port}/jobs?id=1', {}, attempts=1, allowed_hosts=['hooks.test'])
+        assert not post_callback(f'http://hooks.test:{port}/moved', {}, attempts=1, allowed_hosts=['hooks.test'])
+    finally:
+        server.shutdown()
+    assert received == [('/jobs?id=1', f'hooks.test:{port}'), ('/moved', f'hooks.test:{port}')]
+    assert lookups == ['hooks.test', 'hooks.test']
+
+
+def test_async_service_job(monkeypatch, tmp_path):
+    monkeypatch.setattr(asyncservice, 'get_parsers', lambda *args: [('GEMINI', BatchParser, 'TEST')])
+    async def run_job():
+        # Created inside the loop it runs on, see tests/test_async_service.py
+        client = asyncservice.create_async_app(job_config(tmp_path)).test_client()
+        files = {'file': FileStorage(io.BytesIO(make_image(70)), filename='receipt.png')}
+        response = await client.post('/upload', form={'defaultModel': 'GEMINI', 'geminiKey': 'TEST', 'async': 'true'},
+                                     files=files)
+        job_id = (await response.get_json())['job_id']
+        for _ in range(100):
+            job = await (await client.get(f'/jobs/{job_id}')).get_json()
+            if job['status'] not in ('queued', 'running'):
+                return job
+            await asyncio.sleep(0.05)
+
+    assert asyncio.run(run_job())['status'] == 'done'
@@ -0,0 +1,20 @@
+import io
+import receiptservice
+from receiptservice import create_app
+from tests.test_batch_upload import BatchParser, make_image
+
+
+def test_metrics_endpoint(monkeypatch):
+    monkeypatch.setattr(receiptservice, 'get_parsers', lambda *args: [('GEMINI', BatchParser, 'TEST')])
+    client = create_app().test_client()
+
+    response = client.post('/upload', data={'defaultModel': 'GEMINI', 'geminiKey': 'TEST',
+                                            'file': (io.BytesIO(make_image(80)), 'receipt.png')})
+    assert response.status_code == 200
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'receipt_request_duration_seconds_count{method="POST",route="/upload",status="200"}' in body
+    assert 'receipt_parse_attempts_count{provider="None",result="success"}' in body
+    assert 'receipt_image_normalize_seconds_count' in body
@@ -0,0 +1,61 @@
+import uuid
+import pytest
+from Config import Config
+from receiptservice import create_app
+from benchmarks.mock_provider import MockProvider, start_mock_provider, DEFAULT_INSIGHTS, DEFAULT_RECEIPTS, INVALID_KEY
+from benchmarks.load_test import percentile
+from gemini import gemini_clients
+from gpt4o import openai_clients, openai_async_clients
+
+
+@pytest.fixture
+def mock_provider(monkeypatch):
+    mock = MockProvider(latency=0.01, jitter=0, seed=0)
+    server = start_mock_provider(mock)
+    port = server.server_address[1]
+    monkeypatch.setattr(Config, 'OPENAI_BASE_URL', f"http://127.0.0.1:{port}/v1")
+    monkeypatch.setattr(Config, 'GEMINI_API_ENDPOINT', f"http://127.0.0.1:{port}")
+    monkeypatch.setattr(Config, 'GEMINI_TRANSPORT', 'rest')
+    yield mock
+    server.shutdown()
+
+
+def api_keys(model, key=None):
+    # Clients are kept per key, a new key gets clients for the mock endpoint
+    key = key or f"MOCK-{uuid.uuid4().hex}"
+    return {'defaultModel': model, 'geminiKey': key, 'openaiKey': key}
+
+
+@pytest.mark.parametrize('model', ['OPENAI', 'GEMINI'])
+def test_review_and_upload_through_mock(mock_provider, model):
+    client = create_app().test_client()
+
+    review = client.post('/review', json={'apiKeys': api_keys(model), 'receipts': [], 'query': ''})
+    streamed = client.post('/review', json={'apiKeys': api_keys(model), 'receipts': [], 'query': '', 'stream': True})
+    with open('tests/media/receipts_images/food1.jpeg', 'rb') as f:
+        upload = client.post('/upload', data={'file': (f, 'food1.jpeg'), **api_keys(model)},
+                             content_type='multipart/form-data')
+
+    assert review.get_json() == DEFAULT_INSIGHTS
+    assert streamed.get_data(as_text=True).endswith(f'event: done\ndata: {{"insights": "{DEFAULT_INSIGHTS}"}}\n\n')
+    assert upload.status_code == 200
+    assert upload.get_json()['merchant_name'] in [receipt['merchant_name'] for receipt in DEFAULT_RECEIPTS]
+
+
+@pytest.mark.parametrize('model', ['OPENAI', 'GEMINI'])
+def test_mock_rejects_invalid_keys(mock_provider, model):
+    client = create_app().test_client()
+
+    response = client.post('/review', json={'apiKeys': api_keys(model, INVALID_KEY), 'receipts': [], 'query': ''})
+
+    assert response.status_code == 401
+    # The clients of the rejected key are dropped from the registry
+    assert INVALID_KEY not in gemini_clients and INVALID_KEY not in openai_clients
+    assert INVALID_KEY not in openai_async_clients
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([3], 0.95) == 3
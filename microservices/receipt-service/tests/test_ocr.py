@@ -0,0 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import PIL.Image
+from ocr import OcrPage, OcrPrepass, OcrStats, layout_text
+from gpt4o import OpenAIReceiptParser
+
+RECEIPT_TEXT = 'FOOD REPUBLIC\nChicken Rice    5.50\nTOTAL           5.50'
+
+
+def fake_reader(results):
+    """Reader returning the given (text, confidence, words, seconds) per image color, or raising it"""
+    def read(img, lang):
+        result = results[img.getpixel((0, 0))]
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return read
+
+
+def test_layout_keeps_items_and_prices_on_one_row():
+    # Prices come as a separate block from tesseract, after all the items
+    words = [(10, 100, 70, 20, 'Chicken'), (90, 102, 40, 20, 'Rice'), (10, 140, 60, 20, 'TOTAL'),
+             (300, 98, 40, 20, '5.50'), (300, 141, 40, 20, '5.50'), (10, 60, 100, 20, 'RECEIPT')]
+    lines = layout_text(words).splitlines()
+    assert lines[0] == 'RECEIPT'
+    assert lines[1].startswith('Chicken Rice ') and lines[1].endswith(' 5.50')
+    assert lines[2].startswith('TOTAL ') and lines[2].endswith(' 5.50')
+    # Prices line up in the same column
+    assert lines[1].index('5.50') == lines[2].index('5.50')
+
+
+def test_confident_pages_become_text_others_keep_the_image():
+    images = [PIL.Image.new('L', (800, 1200), color) for color in (0, 1, 2, 3)]
+    reader = fake_reader({
+        0: (RECEIPT_TEXT, 92.0, 40, 0.3),
+        1: ('blurry', 41.0, 40, 0.3),
+        2: ('FOOD', 95.0, 1, 0.1),
+        3: RuntimeError('tesseract is not installed'),
+    })
+    stats = OcrStats()
+    prepass = OcrPrepass(ThreadPoolExecutor(max_workers=2), min_confidence=80, min_words=10, reader=reader,
+                         stats=stats)
+
+    pages = prepass.apply(images)
+
+    assert isinstance(pages[0], OcrPage) and pages[0].text == RECEIPT_TEXT and pages[0].thumbnail is None
+    assert pages[1:] == images[1:]
+    assert stats.stats() == {'pages': 4, 'text_pages': 1, 'low_confidence': 2, 'errors': 1, 'seconds': 0.7}
+
+
+def test_async_prepass_with_thumbnail():
+    reader = fake_reader({0: (RECEIPT_TEXT, 92.0, 40, 0.3)})
+    prepass = OcrPrepass(ThreadPoolExecutor(max_workers=1), reader=reader, thumbnail_max_dimension=256,
+                         stats=OcrStats())
+
+    page, = asyncio.run(prepass.apply_async([PIL.Image.new('L', (800, 1200), 0)]))
+
+    assert page.thumbnail.size == (171, 256)
+
+
+def test_parser_sends_ocr_text_instead_of_the_image():
+    parser = OpenAIReceiptParser('TEST')
+    text_only = parser.build_initial_message([OcrPage(RECEIPT_TEXT, 92.0)])
+    with_thumbnail = OpenAIReceiptParser('TEST').build_initial_message(
+        [OcrPage(RECEIPT_TEXT, 92.0, PIL.Image.new('L', (171, 256), 255))])
+    image = OpenAIReceiptParser('TEST').build_initial_message([PIL.Image.new('L', (800, 1200), 255)])
+
+    assert [part['type'] for part in text_only] == ['text', 'text']
+    assert RECEIPT_TEXT in text_only[1]['text']
+    assert with_thumbnail[2]['image_url']['detail'] == 'low'
+    assert image[1]['image_url']['detail'] == 'high'
+    # Text is a fraction of the tokens of a detail high image
+    assert (parser.estimate_initial_tokens([OcrPage(RECEIPT_TEXT, 92.0)]) <
+            parser.estimate_initial_tokens([PIL.Image.new('L', (800, 1200), 255)]))
@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import threading
+import time
+from Receipt import Receipt, ReceiptEncoder
+from pages import (get_page_mode, group_pages, merge_receipts, combine_page_outcomes, parse_page_groups,
+                   parse_page_groups_async, max_groups_in_flight)
+from pipeline import FallbackOutcome
+
+
+def make_receipt(total_cost, category='Others', items=()):
+    return Receipt(merchant_name='META LEGAL & FINANCE', date='12/03/2024', total_cost=total_cost, category=category,
+                   itemized_list=[{'item_name': name, 'item_cost': cost, 'item_quantity': 1} for name, cost in items])
+
+
+def make_outcome(response=None, invalid_api_keys=False, api_key_error_models=()):
+    outcome = FallbackOutcome()
+    outcome.response = response
+    outcome.invalid_api_keys = invalid_api_keys
+    outcome.api_key_error_models = list(api_key_error_models)
+    return outcome
+
+
+def test_group_pages():
+    assert group_pages([1, 2, 3, 4, 5], 2) == [[1, 2], [3, 4], [5]]
+    assert group_pages([1, 2], 1) == [[1], [2]]
+
+
+def test_merge_keeps_grand_total_and_all_items():
+    receipt = merge_receipts([
+        make_receipt('1200.00', items=[('Consultation', '1200.00')]),
+        make_receipt('5715.00', items=[('Filing', '4515.00')]),
+    ])
+
+    assert receipt.total_cost == '5715.00'
+    assert receipt.date == '12/03/2024'
+    assert receipt.category == 'OTHERS'
+    assert [item.item_name for item in receipt.itemized_list] == ['Consultation', 'Filing']
+
+
+def test_combine_split_returns_list():
+    outcome = combine_page_outcomes([make_outcome(make_receipt('10.00')), make_outcome(make_receipt('20.00'))],
+                                    'split')
+
+    receipts = json.loads(json.dumps(outcome.response, cls=ReceiptEncoder))
+    assert [receipt['total_cost'] for receipt in receipts] == ['10.00', '20.00']
+
+
+def test_combine_fails_when_a_page_group_fails():
+    for page_mode in ['merge', 'split']:
+        outcome = combine_page_outcomes([make_outcome(make_receipt('10.00')), make_outcome(None),
+                                         make_outcome(make_receipt('20.00'))], page_mode)
+
+        assert outcome.response is None
+        assert outcome.error == 'Error parsing page groups 2 of 3'
+        assert not outcome.invalid_api_keys
+
+
+def test_combine_reports_invalid_keys_only_when_nothing_parsed():
+    outcomes = [make_outcome(None, True, ['GEMINI']), make_outcome(make_receipt('10.00'), False, ['GEMINI'])]
+    assert not combine_page_outcomes(outcomes, 'merge').invalid_api_keys
+
+    outcome = combine_page_outcomes([make_outcome(None, True, ['GEMINI'])] * 2, 'merge')
+    assert outcome.invalid_api_keys
+    assert outcome.api_key_error_models == ['GEMINI']
+
+
+def test_page_groups_in_flight_are_bounded():
+    assert max_groups_in_flight(4, 1) == 4
+    assert max_groups_in_flight(4, 3) == 1
+    in_flight = [0, 0]
+    lock = threading.Lock()
+
+    def page_groups():
+        for num in range(10):
+            yield [num]
+
+    def parse_group(group):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        return group[0]
+
+    with ThreadPoolExecutor(8) as executor:
+        assert parse_page_groups(page_groups(), parse_group, executor, 2) == list(range(10))
+    assert in_flight[1] <= 2
+
+    async def async_page_groups():
+        for num in range(10):
+            yield [num]
+
+    async def parse_group_async(group):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight[1], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        return group[0]
+
+    in_flight[1] = 0
+    assert asyncio.run(parse_page_groups_async(async_page_groups(), parse_group_async, 3)) == list(range(10))
+    assert in_flight[1] == 3
+
+
+def test_page_mode_validation():
+    config = {'PAGE_MODE': 'combined', 'PAGES_PER_GROUP': 1}
+
+    assert get_page_mode({}, config) == ('combined', 1, None)
+    assert get_page_mode({'pageMode': 'split', 'pagesPerGroup': '3'}, config) == ('split', 3, None)
+    assert get_page_mode({'pageMode': 'pages'}, config)[2] is not None
+    assert get_page_mode({'pagesPerGroup': '0'}, config)[2] is not None
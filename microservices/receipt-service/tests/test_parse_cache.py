@@ -0,0 +1,108 @@
+import io
+import json
+import os
+import time
+import pytest
+from ParseCache import ParseCache, MemoryCacheBackend, DiskCacheBackend
+from gemini import GeminiReceiptParser
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryCacheBackend(max_size=2)
+    backend.set('a', '1')
+    backend.set('b', '2')
+    # Touch 'a' so 'b' becomes the least recently used
+    assert backend.get('a') == '1'
+    backend.set('c', '3')
+
+    assert backend.get('b') is None
+    assert backend.get('a') == '1'
+    assert backend.get('c') == '3'
+    assert len(backend) == 2
+
+
+def test_memory_backend_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    backend = MemoryCacheBackend(max_size=10, ttl=60)
+    backend.set('a', '1')
+
+    now[0] += 59
+    assert backend.get('a') == '1'
+    now[0] += 2
+    assert backend.get('a') is None
+    assert len(backend) == 0
+
+
+def test_disk_backend_survives_new_instance(tmp_path):
+    DiskCacheBackend(str(tmp_path)).set('abcdef', '{"merchant_name": "Shell"}')
+
+    backend = DiskCacheBackend(str(tmp_path))
+    assert backend.get('abcdef') == '{"merchant_name": "Shell"}'
+    assert len(backend) == 1
+
+    backend.clear()
+    assert backend.get('abcdef') is None
+
+
+def test_disk_backend_sweeps_expired_and_oldest_entries(tmp_path):
+    backend = DiskCacheBackend(str(tmp_path), ttl=60, max_size=10, sweep_interval=3600)
+    for num in range(10):
+        backend.set(f"key{num:02d}", str(num))
+        # Written in order, oldest first
+        os.utime(backend._path(f"key{num:02d}"), (1000 + num, 1000 + num))
+    assert len(backend) == 10
+
+    # Every entry above has expired, the 11th write sweeps them
+    backend.set('key10', '10')
+    assert len(backend) == 1
+
+    backend = DiskCacheBackend(str(tmp_path), max_size=10, sweep_interval=3600)
+    for num in range(11, 21):
+        backend.set(f"key{num:02d}", str(num))
+    # Trimmed to 9 entries once a write went past max_size, the oldest one went first
+    assert len(backend) == 9
+    assert backend.get('key10') is None
+    assert backend.get('key20') == '20'
+
+
+def test_cache_key_depends_on_model_and_prompt_version():
+    content_hash = ParseCache.hash_content(b'receipt bytes')
+    key = ParseCache.make_key(content_hash, 'gpt-4o-mini', 1)
+
+    assert key != ParseCache.make_key(content_hash, 'gpt-4o', 1)
+    assert key != ParseCache.make_key(content_hash, 'gpt-4o-mini', 2)
+    assert key != ParseCache.make_key(ParseCache.hash_content(b'other bytes'), 'gpt-4o-mini', 1)
+
+
+def test_lookup_counts_hits_and_misses():
+    cache = ParseCache(MemoryCacheBackend())
+    content_hash = ParseCache.hash_content(b'receipt bytes')
+    cache.store(content_hash, 'gpt-4o-mini', 1, '{}')
+
+    assert cache.lookup(content_hash, [('models/gemini-1.5-flash', 1), ('gpt-4o-mini', 1)]) == '{}'
+    assert cache.lookup(content_hash, [('models/gemini-1.5-flash', 1)]) is None
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'size': 1}
+
+
+def test_upload_returns_cached_receipt_without_llm(app_client):
+    file_bytes = b'previously parsed receipt'
+    receipt_json = json.dumps({
+        "merchant_name": "Shell",
+        "date": "01/01/2024",
+        "total_cost": "31.92",
+        "category": "TRANSPORT",
+        "itemized_list": []
+    })
+    parse_cache = app_client.application.extensions['parse_cache']
+    parse_cache.store(ParseCache.hash_content(file_bytes), GeminiReceiptParser.default_model_version,
+                      GeminiReceiptParser.prompt_version, receipt_json)
+
+    # The key is invalid, so a 200 means no LLM was called
+    response = app_client.post('/upload', data={
+        'file': (io.BytesIO(file_bytes), 'receipt.jpg'), 'defaultModel': 'GEMINI',
+        'geminiKey': 'INVALID_KEY', 'openaiKey': 'UNSET'})
+
+    assert response.status_code == 200
+    assert response.json == json.loads(receipt_json)
+    assert app_client.get('/stats').json['parse_cache']['hits'] >= 1
@@ -0,0 +1,39 @@
+import json
+from conversation import CorrectionTurn
+from tests.test_async_service import ScriptedParser, VALID_RECEIPT
+
+
+def test_correction_patches_only_the_failed_field():
+    parser = ScriptedParser([dict(VALID_RECEIPT, date='31st of Smarch'), {'date': '2024-01-31'}])
+    receipt = parser.parse(['image'])
+
+    assert receipt.date == '31/01/2024'
+    assert receipt.merchant_name == 'Shell'
+    correction = parser.sent[1]
+    assert isinstance(correction, CorrectionTurn)
+    # The previous JSON is sent back as text, the image is not
+    assert "'date'" in correction.text
+    assert json.dumps(dict(VALID_RECEIPT, date='31st of Smarch')) in correction.text
+    assert 'image' not in parser.sent[1:]
+
+
+def test_item_cost_error_is_reported_on_itemized_list():
+    bad_items = [{'item_name': 'Fuel', 'item_cost': 'unknown', 'item_quantity': 1}]
+    parser = ScriptedParser([dict(VALID_RECEIPT, itemized_list=bad_items),
+                             {'itemized_list': VALID_RECEIPT['itemized_list']}])
+
+    assert parser.parse(['image']).itemized_list[0].item_cost == '31.92'
+    assert "'itemized_list'" in parser.sent[1].text
+
+
+def test_retries_stop_when_budget_is_spent():
+    bad_receipt = dict(VALID_RECEIPT, date='31st of Smarch')
+    parser = ScriptedParser([bad_receipt] * 4)
+    parser.buffer = 100
+    parser.get_token_count = lambda prompt: 50
+    # Every scripted reply costs 100 tokens, the first attempt is not charged to the retry budget,
+    # so the third correction (200 spent + 50 prompt + 100 reply) does not fit
+    parser.retry_token_budget = 300
+
+    assert parser.parse(['image']) is None
+    assert len(parser.sent) == 3
@@ -0,0 +1,88 @@
+from io import BytesIO
+import PIL.Image
+import PIL.ImageDraw
+from preprocess import (normalize_image, find_receipt_box, fit_size, openai_image_tokens, gemini_image_tokens,
+                        ImagePreprocessor, PreprocessStats)
+
+
+def make_photo():
+    # White receipt on a dark table
+    img = PIL.Image.new('RGB', (1200, 1600), (40, 50, 40))
+    PIL.ImageDraw.Draw(img).rectangle((400, 200, 800, 1400), fill=(245, 245, 240))
+    return img
+
+
+def test_crop_to_receipt():
+    left, top, right, bottom = find_receipt_box(make_photo())
+    assert 350 <= left <= 400 and 150 <= top <= 200
+    assert 800 <= right <= 850 and 1400 <= bottom <= 1450
+
+    # Nothing to crop on a plain scan
+    assert find_receipt_box(PIL.Image.new('RGB', (800, 800), (250, 250, 250))) is None
+
+
+def test_normalize_applies_exif_orientation():
+    buffer = BytesIO()
+    exif = PIL.Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees
+    PIL.Image.new('RGB', (300, 200), (255, 255, 255)).save(buffer, format='JPEG', exif=exif)
+
+    img = normalize_image(PIL.Image.open(buffer), autocrop=False)
+    assert img.size == (200, 300)
+    assert img.mode == 'L'
+    assert img.info['original_size'] == (300, 200)
+
+
+def test_openai_image_tokens():
+    # Examples from the OpenAI vision pricing docs
+    assert openai_image_tokens((1024, 1024)) == 765
+    assert openai_image_tokens((2048, 4096)) == 1105
+    assert fit_size((200, 100), 2048, 768) == (200, 100)
+
+
+def test_encode_downscales_and_reports():
+    stats = PreprocessStats()
+    preprocessor = ImagePreprocessor('OPENAI', openai_image_tokens, max_dimension=2048, max_short_side=768,
+                                     stats=stats)
+    upload = BytesIO()
+    make_photo().save(upload, format='JPEG', quality=95)
+    img = normalize_image(make_photo(), source_bytes=len(upload.getvalue()))
+
+    mime_type, data = preprocessor.encode(img)
+    assert mime_type == 'image/jpeg'
+    assert PIL.Image.open(BytesIO(data)).size == fit_size(img.size, 2048, 768)
+    assert stats.stats()['images'] == 1
+    assert stats.stats()['bytes_sent'] == len(data)
+    assert stats.stats()['estimated_tokens_after'] <= stats.stats()['estimated_tokens_before']
+
+
+def test_encode_sends_the_upload_only_when_normalization_left_it_as_is(tmp_path):
+    preprocessor = ImagePreprocessor('GEMINI', gemini_image_tokens, max_dimension=1600, stats=None)
+
+    # A black and white scan, nothing to crop, recolour or downscale
+    scan_path = tmp_path / 'scan.png'
+    scan = PIL.Image.new('L', (600, 900), 255)
+    PIL.ImageDraw.Draw(scan).text((50, 50), 'TOTAL 18.86', fill=0)
+    scan.save(scan_path)
+    img = normalize_image(PIL.Image.open(scan_path), source_bytes=scan_path.stat().st_size, source_path=str(scan_path))
+    assert not img.info['pixels_changed']
+    assert preprocessor.encode(img) == ('image/png', scan_path.read_bytes())
+
+    # The same scan in colour is turned grayscale, the upload would not be
+    colour_path = tmp_path / 'colour.png'
+    scan.convert('RGB').save(colour_path)
+    img = normalize_image(PIL.Image.open(colour_path), source_bytes=colour_path.stat().st_size,
+                          source_path=str(colour_path))
+    mime_type, data = preprocessor.encode(img)
+    assert mime_type != 'image/png' and data != colour_path.read_bytes()
+
+    # Cropped, but a tiny upload that a re-encode grows: re-encoded smaller, still cropped
+    photo_path = tmp_path / 'photo.jpg'
+    make_photo().save(photo_path, quality=20)
+    img = normalize_image(PIL.Image.open(photo_path), source_bytes=photo_path.stat().st_size,
+                          source_path=str(photo_path))
+    assert img.info['geometry_changed']
+    mime_type, data = preprocessor.encode(img)
+    assert mime_type in ('image/jpeg', 'image/webp')
+    assert PIL.Image.open(BytesIO(data)).size == img.size
+    assert len(data) <= len(preprocessor._reencode(img, img.size, 'jpeg', 85))
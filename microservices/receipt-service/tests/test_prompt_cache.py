@@ -0,0 +1,20 @@
+from openai.types import CompletionUsage
+from gpt4o import cached_prompt_tokens
+from metrics import record_tokens, metrics_response
+from ReceiptParser import INITIAL_PROMPT
+from tests.test_async_service import ScriptedParser
+
+
+def test_prompts_are_shared_by_instances():
+    assert ScriptedParser([]).initial_prompt is ScriptedParser([]).initial_prompt is INITIAL_PROMPT
+
+
+def test_cached_tokens_are_recorded():
+    usage = CompletionUsage.model_validate({'prompt_tokens': 1500, 'completion_tokens': 20, 'total_tokens': 1520,
+                                            'prompt_tokens_details': {'cached_tokens': 1024}})
+    assert cached_prompt_tokens(usage) == 1024
+    assert cached_prompt_tokens(CompletionUsage(prompt_tokens=1, completion_tokens=1, total_tokens=2)) == 0
+
+    record_tokens('OPENAI', 'cache-test', 1500, 20, cached_prompt_tokens(usage))
+    body = metrics_response()[0].decode('utf-8')
+    assert 'receipt_llm_tokens_total{kind="cached_prompt",provider="OPENAI",task="cache-test"} 1024.0' in body
@@ -0,0 +1,89 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from Exceptions import APIKeyError
+from race import RaceStats, run_race, run_race_async, get_parse_policy
+
+
+def make_handler(delay, result=None, error=None):
+    class Handler:
+        started = []
+
+        def __init__(self, api_key):
+            self.cancel_event = None
+            Handler.started.append(time.monotonic())
+
+        def parse(self):
+            time.sleep(delay)
+            if error is not None:
+                raise error
+            return result
+
+        async def parse_async(self):
+            await asyncio.sleep(delay)
+            if error is not None:
+                raise error
+            return result
+
+    return Handler
+
+
+def test_hedged_request_wins_when_default_is_slow():
+    stats = RaceStats()
+    candidates = [('GEMINI', make_handler(1.0, 'gemini'), 'key'), ('OPENAI', make_handler(0.01, 'openai'), 'key')]
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        outcome = run_race(candidates, lambda h: h.parse(), 'parser', 0.05, executor, stats)
+        elapsed = time.monotonic() - start
+
+    assert outcome.response == 'openai'
+    assert elapsed < 0.5
+    assert stats.stats() == {'races': 1, 'hedged': 1, 'wins': {'OPENAI': 1}}
+
+
+def test_next_model_starts_immediately_after_failure():
+    slow_handler = make_handler(0.01, 'openai')
+    candidates = [('GEMINI', make_handler(0.01, None), 'key'), ('OPENAI', slow_handler, 'key')]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        start = time.monotonic()
+        outcome = run_race(candidates, lambda h: h.parse(), 'parser', 10, executor)
+
+    assert outcome.response == 'openai'
+    # Did not wait for the 10s hedge delay
+    assert slow_handler.started[0] - start < 1
+
+
+def test_invalid_keys_when_no_model_succeeds():
+    candidates = [('GEMINI', make_handler(0, error=APIKeyError()), 'key'),
+                  ('OPENAI', make_handler(0, error=APIKeyError()), 'key')]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        outcome = run_race(candidates, lambda h: h.parse(), 'parser', 0, executor)
+
+    assert outcome.response is None
+    assert outcome.invalid_api_keys
+    assert sorted(outcome.api_key_error_models) == ['GEMINI', 'OPENAI']
+
+
+def test_async_race_cancels_loser():
+    candidates = [('GEMINI', make_handler(0, 'gemini'), 'key'), ('OPENAI', make_handler(5, 'openai'), 'key')]
+
+    async def race():
+        start = time.monotonic()
+        outcome = await run_race_async(candidates, lambda h: h.parse_async(), 'parser', 0)
+        return outcome, time.monotonic() - start
+
+    outcome, elapsed = asyncio.run(race())
+    assert outcome.response == 'gemini'
+    assert elapsed < 1
+
+
+def test_parse_policy_validation():
+    config = {'PARSE_POLICY': 'fallback', 'PARSE_HEDGE_DELAY': 3.0}
+
+    assert get_parse_policy({}, config) == ('fallback', 3.0, None)
+    assert get_parse_policy({'parsePolicy': 'RACE', 'hedgeDelay': '0'}, config) == ('race', 0.0, None)
+    assert get_parse_policy({'parsePolicy': 'fastest'}, config)[2] is not None
+    assert get_parse_policy({'hedgeDelay': 'soon'}, config)[2] is not None
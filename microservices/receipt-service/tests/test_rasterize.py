@@ -0,0 +1,60 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import pytest
+import PIL.Image
+import rasterize
+from Exceptions import PageLimitError
+from ParseCache import ParseCache
+from pipeline import SpooledUpload
+
+
+def test_spooled_upload_hash_and_cleanup():
+    data = os.urandom(3000)
+    with SpooledUpload(BytesIO(data), suffix='.pdf', chunk_size=1024) as upload:
+        assert upload.content_hash == ParseCache.hash_content(data)
+        with open(upload.path, 'rb') as f:
+            assert f.read() == data
+    assert not os.path.exists(upload.path)
+
+
+def fake_pages(monkeypatch, page_count):
+    monkeypatch.setattr(rasterize, 'get_page_count', lambda path, max_pages=0: page_count)
+    def render_page(path, page_number, dpi, grayscale):
+        page = PIL.Image.new('L', (1, 1))
+        page.info['render_seconds'] = 0.1
+        page.info['page_number'] = page_number
+        return page
+    monkeypatch.setattr(rasterize, 'render_page', render_page)
+
+
+def page_numbers(groups):
+    return [[page.info['page_number'] for page in group] for group in groups]
+
+
+def test_page_groups_in_order(monkeypatch):
+    fake_pages(monkeypatch, 5)
+    with ThreadPoolExecutor(2) as executor:
+        groups = list(rasterize.iter_page_groups('receipt.pdf', executor, 2, prefetch=3))
+    assert page_numbers(groups) == [[1, 2], [3, 4], [5]]
+    # The render time is moved into the metrics
+    assert 'render_seconds' not in groups[0][0].info
+
+
+def test_page_groups_async_in_order(monkeypatch):
+    fake_pages(monkeypatch, 3)
+
+    async def collect(executor):
+        return [group async for group in rasterize.iter_page_groups_async('receipt.pdf', executor, 2, prefetch=1)]
+
+    with ThreadPoolExecutor(2) as executor:
+        assert page_numbers(asyncio.run(collect(executor))) == [[1, 2], [3]]
+
+
+def test_page_limit_rejects_instead_of_truncating(monkeypatch):
+    monkeypatch.setattr(rasterize, 'pdfinfo_from_path', lambda path: {'Pages': 21})
+
+    assert rasterize.get_page_count('receipt.pdf') == 21
+    with pytest.raises(PageLimitError, match='PDF has 21 pages, at most 20 are supported'):
+        rasterize.get_page_count('receipt.pdf', max_pages=20)
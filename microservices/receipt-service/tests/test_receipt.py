@@ -0,0 +1,46 @@
+import json
+import pytest
+import Receipt as receipt_module
+from Receipt import Receipt, ReceiptEncoder, dumps_receipts
+from Exceptions import ReceiptError
+
+
+def make_receipt(date='12/03/2024'):
+    return Receipt(merchant_name='FAIRPRICE', date=date, total_cost='S$ 12.50', category='Food',
+                   itemized_list=[{'item_name': 'Milk', 'item_cost': '$4.50', 'item_quantity': 2},
+                                  {'item_name': 'Bread', 'item_cost': '3.50'}])
+
+
+def test_formatted_fields():
+    receipt = make_receipt()
+
+    assert receipt.to_dict() == {
+        'merchant_name': 'FAIRPRICE',
+        'date': '12/03/2024',
+        'total_cost': '12.50',
+        'category': 'FOOD',
+        'itemized_list': [{'item_name': 'Milk', 'item_cost': '4.50', 'item_quantity': 2},
+                          {'item_name': 'Bread', 'item_cost': '3.50', 'item_quantity': 1}],
+    }
+    assert not hasattr(receipt, '__dict__')
+
+
+@pytest.mark.parametrize('date', ['12/03/2024', '2024-03-12', '12 Mar 2024', '2024/03/12'])
+def test_date_formats(date):
+    assert make_receipt(date).date == '12/03/2024'
+
+
+def test_empty_merchant_name_is_rejected():
+    with pytest.raises(ReceiptError) as e:
+        Receipt(merchant_name='', date='12/03/2024', total_cost='1', category='Food', itemized_list=[])
+    assert e.value.field_name == 'merchant_name'
+
+
+@pytest.mark.parametrize('use_orjson', [True, False])
+def test_to_json_matches_encoder(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(receipt_module, 'orjson', None)
+    receipts = [make_receipt(), make_receipt('2024-01-02')]
+
+    assert json.loads(make_receipt().to_json()) == json.loads(json.dumps(make_receipt(), cls=ReceiptEncoder))
+    assert json.loads(dumps_receipts(receipts)) == json.loads(json.dumps(receipts, cls=ReceiptEncoder))
@@ -0,0 +1,50 @@
+from Receipt import Receipt
+from repair import repair_date, repair_amount, repair_category, build_receipt, repair_stats
+from tests.test_async_service import ScriptedParser, VALID_RECEIPT
+
+
+def test_repair_date():
+    assert repair_date('13.01.2024 SGT') == '13/01/2024'
+    assert repair_date('Jan 13th, 2024') == '13/01/2024'
+    assert repair_date('2024-01-02') == '02/01/2024'
+    # A date without a month is not guessed
+    assert repair_date('31st of Smarch 2024') is None
+
+
+def test_repair_amount():
+    assert repair_amount('S$1O.5O') == '10.50'
+    assert repair_amount('12,50') == '12.50'
+    assert repair_amount('Total12.50') == '12.50'
+    assert repair_amount('unknown') is None
+
+
+def test_repair_category():
+    assert repair_category('FOOD') == 'Food'
+    assert repair_category('Groceries') == 'Food'
+    assert repair_category('Helthcare') == 'Healthcare'
+    assert repair_category('Invalid') is None
+
+
+def test_build_receipt_repairs_several_fields():
+    receipt_dict = dict(VALID_RECEIPT, date='13.01.2024 SGT', total_cost='None', category='fuel',
+                        itemized_list=[{'item_name': 'Fuel', 'item_cost': '31.92'},
+                                       {'item_name': '', 'item_cost': ''}])
+    avoided = repair_stats.stats()['retries_avoided']
+
+    receipt, repaired_dict, error = build_receipt(receipt_dict)
+
+    assert error is None
+    assert isinstance(receipt, Receipt)
+    assert receipt.date == '13/01/2024'
+    assert receipt.total_cost == '31.92'
+    assert receipt.category == 'TRANSPORT'
+    assert len(receipt.itemized_list) == 1
+    assert repair_stats.stats()['retries_avoided'] == avoided + 1
+    # The model's dict is left untouched
+    assert receipt_dict['category'] == 'fuel'
+
+
+def test_local_repair_skips_the_retry():
+    parser = ScriptedParser([dict(VALID_RECEIPT, total_cost='None')])
+    assert parser.parse(['image']).total_cost == '31.92'
+    assert len(parser.sent) == 1
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import asyncservice
+import receiptservice
+from asyncservice import create_async_app
+from receiptservice import create_app
+from Exceptions import APIKeyError
+from pipeline import DEFAULT_INSIGHTS
+from ReceiptReview import AbstractReview
+from streaming import InsightStream
+
+REVIEW = {'status': True, 'insights': 'Eat out less.\nCook "at home" instead.'}
+
+
+class StreamingReviewer(AbstractReview):
+    """Streams the given response text in small chunks instead of calling a provider"""
+    response_text = json.dumps(REVIEW)
+    chunk_size = 5
+
+    def __init__(self, api_key):
+        super().__init__(api_key=api_key, review_schema=None, model_name='scripted')
+
+    def build_initial_message(self, receipt_str, query):
+        return [self.initial_prompt, receipt_str, query]
+
+    def build_retry_message(self, error_msg):
+        return [error_msg]
+
+    def send_message(self, message):
+        return self.response_text, 100
+
+    async def send_message_async(self, message):
+        return self.send_message(message)
+
+    def stream_message(self, message):
+        for i in range(0, len(self.response_text), self.chunk_size):
+            yield self.response_text[i:i + self.chunk_size]
+
+    async def stream_message_async(self, message):
+        for chunk in self.stream_message(message):
+            await asyncio.sleep(0)
+            yield chunk
+
+    def get_input_token_limit(self):
+        return 128000
+
+    def get_token_count(self, prompt):
+        return len(prompt)
+
+
+class FailingReviewer(StreamingReviewer):
+    def stream_message(self, message):
+        raise ConnectionError('stream failed')
+
+
+class InvalidKeyReviewer(StreamingReviewer):
+    def stream_message(self, message):
+        raise APIKeyError()
+
+
+class BrokenSchemaReviewer(StreamingReviewer):
+    response_text = '{"insights": "Eat out less.", "status": "maybe'
+
+
+REQUEST = {'apiKeys': {'defaultModel': 'GEMINI', 'geminiKey': 'TEST', 'openaiKey': 'TEST'},
+           'receipts': [], 'query': '', 'stream': True}
+
+
+def parse_events(body):
+    events = []
+    for block in body.strip().split('\n\n'):
+        event, data = block.split('\n')
+        events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+
+
+def post_review(monkeypatch, reviewers):
+    monkeypatch.setattr(receiptservice, 'get_reviewers', lambda *args: reviewers)
+    response = create_app().test_client().post('/review', json=REQUEST)
+    return response.status_code, response.get_data(as_text=True), response.headers
+
+
+def test_insight_stream_handles_any_chunking():
+    response_text = json.dumps({'status': True, 'insights': 'Café \\ "tips" 😀\n'}, ensure_ascii=True)
+    for chunk_size in range(1, 8):
+        stream = InsightStream()
+        text = ''.join(stream.feed(response_text[i:i + chunk_size])
+                       for i in range(0, len(response_text), chunk_size))
+        assert text == 'Café \\ "tips" 😀\n'
+        assert stream.result() == text
+
+
+def test_stream_sends_insights_as_events(monkeypatch):
+    status, body, headers = post_review(monkeypatch, [('GEMINI', StreamingReviewer, 'TEST')])
+
+    assert status == 200
+    assert headers['Content-Type'].startswith('text/event-stream')
+    events = parse_events(body)
+    assert len(events) > 2
+    assert ''.join(data['text'] for event, data in events[:-1]) == REVIEW['insights']
+    assert events[-1] == ('done', {'insights': REVIEW['insights']})
+
+
+def test_stream_falls_back_before_first_token(monkeypatch):
+    status, body, _ = post_review(monkeypatch, [('GEMINI', FailingReviewer, 'TEST'),
+                                                ('OPENAI', StreamingReviewer, 'TEST')])
+
+    assert status == 200
+    assert parse_events(body)[-1] == ('done', {'insights': REVIEW['insights']})
+
+
+def test_stream_with_broken_schema_ends_with_default_insights(monkeypatch):
+    status, body, _ = post_review(monkeypatch, [('GEMINI', BrokenSchemaReviewer, 'TEST'),
+                                                ('OPENAI', StreamingReviewer, 'TEST')])
+
+    events = parse_events(body)
+    # Text was already sent, so there is no fallback
+    assert events[0][0] == 'insight'
+    assert events[-1] == ('done', {'insights': DEFAULT_INSIGHTS})
+
+
+def test_stream_invalid_keys(monkeypatch):
+    status, body, _ = post_review(monkeypatch, [('GEMINI', InvalidKeyReviewer, 'TEST')])
+
+    assert status == 401
+    assert json.loads(body) == {'error': "Invalid API keys for ['GEMINI']"}
+
+
+def test_async_stream(monkeypatch):
+    monkeypatch.setattr(asyncservice, 'get_reviewers', lambda *args: [('GEMINI', FailingReviewer, 'TEST'),
+                                                                       ('OPENAI', StreamingReviewer, 'TEST')])
+    async def post():
+        # Created inside the loop it runs on, see tests/test_async_service.py
+        client = create_async_app().test_client()
+        response = await client.post('/review', json=REQUEST, headers={'Accept': 'text/event-stream'})
+        return response.status_code, await response.get_data(as_text=True)
+
+    status, body = asyncio.run(post())
+    assert status == 200
+    events = parse_events(body)
+    assert ''.join(data['text'] for event, data in events[:-1]) == REVIEW['insights']
+    assert events[-1] == ('done', {'insights': REVIEW['insights']})
@@ -0,0 +1,108 @@
+import receiptservice
+from receiptservice import create_app
+from RollingSummary import RollingSummaryStore, PLAN_FULL, PLAN_DELTA, PLAN_UNCHANGED
+from ParseCache import MemoryCacheBackend
+from tests.test_review_stream import StreamingReviewer, REVIEW
+
+
+def make_receipt(day, amount, category='Food', merchant='Kopitiam'):
+    return {'merchantName': merchant, 'date': f'2024-03-{day:02d}', 'category': category, 'totalCost': amount,
+            'itemizedList': [{'itemName': 'Coffee', 'itemQuantity': 1, 'itemCost': amount}]}
+
+
+HISTORY = [make_receipt(day, 5 + day) for day in range(1, 26)]
+
+
+class RecordingReviewer(StreamingReviewer):
+    prompts = []
+
+    def send_message(self, message):
+        RecordingReviewer.prompts.append(message[1])
+        return super().send_message(message)
+
+
+def make_store():
+    return RollingSummaryStore(MemoryCacheBackend(max_size=10), max_raw_receipts=20, sample_size=5)
+
+
+def test_first_plan_is_full_then_delta_with_only_new_receipts():
+    store = make_store()
+    plan = store.plan('key', HISTORY)
+    assert plan.mode == PLAN_FULL
+    store.commit(plan, 'Cook more')
+
+    new_receipt = make_receipt(28, 300, merchant='Steakhouse')
+    plan = store.plan('key', HISTORY[::-1] + [new_receipt])
+
+    assert plan.mode == PLAN_DELTA
+    assert plan.new_receipts == 1
+    assert 'Cook more' in plan.receipt_str
+    assert 'Steakhouse' in plan.receipt_str
+    # Old receipts only appear through the summary
+    assert 'Date: 2024-03-01' not in plan.receipt_str
+    assert 'Unusual new receipts' in plan.receipt_str
+    assert plan.totals['receipts'] == 26
+
+
+def test_new_receipts_are_compared_with_the_history_before_them():
+    store = make_store()
+    store.commit(store.plan('key', HISTORY), 'Cook more')
+
+    # 3.3x the $18 average of the history, but only 2.7x the average once they are included
+    burst = [make_receipt(day, 60, merchant='Steakhouse') for day in (26, 27, 28)]
+    plan = store.plan('key', HISTORY + burst)
+
+    assert '2024-03-26 Steakhouse $60.00 (Food), 3.3x the average Food receipt' in plan.receipt_str
+    assert plan.totals['receipts'] == 28
+
+
+def test_unchanged_receipts_return_previous_insights():
+    store = make_store()
+    store.commit(store.plan('key', HISTORY), 'Cook more')
+
+    plan = store.plan('key', HISTORY)
+
+    assert plan.mode == PLAN_UNCHANGED
+    assert plan.insights == 'Cook more'
+
+
+def test_edited_receipt_rebuilds_the_summary():
+    store = make_store()
+    store.commit(store.plan('key', HISTORY), 'Cook more')
+
+    plan = store.plan('key', [make_receipt(1, 99)] + HISTORY[1:])
+
+    assert plan.mode == PLAN_FULL
+    assert plan.totals['receipts'] == 25
+
+
+def test_duplicate_receipts_are_counted():
+    store = make_store()
+    store.commit(store.plan('key', HISTORY[:3]), 'Cook more')
+
+    plan = store.plan('key', HISTORY[:3] + [HISTORY[0]])
+
+    assert plan.mode == PLAN_DELTA
+    assert plan.new_receipts == 1
+
+
+def test_incremental_review_route(monkeypatch):
+    monkeypatch.setattr(receiptservice, 'get_reviewers', lambda *args: [('GEMINI', RecordingReviewer, 'TEST')])
+    RecordingReviewer.prompts = []
+    client = create_app({'ROLLING_SUMMARY_BACKEND': 'memory', 'INSIGHTS_CACHE_TTL': 0}).test_client()
+
+    def review(receipts):
+        return client.post('/review', json={
+            'apiKeys': {'defaultModel': 'GEMINI', 'geminiKey': 'TEST', 'openaiKey': 'TEST'},
+            'receipts': receipts, 'query': '', 'incremental': True, 'userId': 'alice'})
+
+    first = review(HISTORY)
+    second = review(HISTORY + [make_receipt(28, 12)])
+    third = review(HISTORY + [make_receipt(28, 12)])
+
+    assert [response.headers['X-Review-Mode'] for response in (first, second, third)] == \
+        [PLAN_FULL, PLAN_DELTA, PLAN_UNCHANGED]
+    assert third.get_json() == REVIEW['insights']
+    assert len(RecordingReviewer.prompts) == 2
+    assert REVIEW['insights'] in RecordingReviewer.prompts[1]
+    assert len(RecordingReviewer.prompts[1]) < len(RecordingReviewer.prompts[0])
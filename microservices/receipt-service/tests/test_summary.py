@@ -0,0 +1,62 @@
+import random
+from pipeline import format_receipts
+from summary import summarize_spending, format_summary, format_review_data
+
+
+def make_receipt(date, merchant, category, total, items=()):
+    return {'merchantName': merchant, 'date': date, 'category': category, 'totalCost': total,
+            'itemizedList': [{'itemName': name, 'itemQuantity': quantity, 'itemCost': cost}
+                             for name, quantity, cost in items]}
+
+
+def make_history(count, seed=0):
+    rng = random.Random(seed)
+    receipts = []
+    for i in range(count):
+        month = 1 + i % 12
+        year = 2022 + i // 400
+        receipts.append(make_receipt(f"{year}-{month:02d}-{1 + i % 28:02d}T12:00:00.000Z", f"Shop {i % 40}",
+                                     rng.choice(['Food', 'Transport', 'Leisure']), round(rng.uniform(5, 50), 2),
+                                     [('Milk', 2, 3.5), (f"Item {i}", 1, 1.0)]))
+    return receipts
+
+
+def test_summarize_spending_totals():
+    receipts = [
+        make_receipt('2024-01-05T10:00:00.000Z', 'FairPrice', 'Food', 30.0, [('Milk', 2, 3.5)]),
+        make_receipt('2024-01-20T10:00:00.000Z', 'Grab', 'Transport', '12.5'),
+        make_receipt('2024-02-02T10:00:00.000Z', 'FairPrice', 'Food', 20.0, [('Milk', 1, 3.5)]),
+        make_receipt('not a date', 'FairPrice', 'Food', 'abc'),
+    ]
+    summary = summarize_spending(receipts)
+
+    assert summary['receipts'] == 3
+    assert summary['total'] == 62.5
+    assert summary['categories'][0] == ('Food', [50.0, 2])
+    assert summary['months'] == [('2024-01', [42.5, 2]), ('2024-02', [20.0, 1])]
+    assert summary['merchants'][0] == ('FairPrice', [50.0, 2])
+    assert summary['items'] == [('Milk', [10.5, 3])]
+
+    text = format_summary(summary)
+    assert 'Spending summary of 3 receipts from 2024-01-05 to 2024-02-02, total $62.50' in text
+    assert '  - Food: $50.00 (80.0%, 2 receipts)' in text
+    assert 'Spending in 2024-02 was $20.00, 53% below the average of the 1 months before' in text
+
+
+def test_anomalies():
+    receipts = [make_receipt(f"2024-03-{day:02d}", 'Cafe', 'Food', 10.0) for day in range(1, 11)]
+    receipts.append(make_receipt('2024-03-15', 'Steakhouse', 'Food', 120.0))
+
+    text = format_summary(summarize_spending(receipts))
+    assert 'Unusual receipts:\n  - 2024-03-15 Steakhouse $120.00 (Food), 12.0x the typical Food receipt' in text
+
+
+def test_review_data_stays_bounded():
+    few = make_history(5)
+    assert format_review_data(few, max_raw_receipts=20) == format_receipts(few)
+
+    year = format_review_data(make_history(400), max_raw_receipts=20, sample_size=5)
+    three_years = format_review_data(make_history(1200), max_raw_receipts=20, sample_size=5)
+    assert 'Most recent receipts:' in year
+    assert len(three_years) < len(year) * 1.2
+    assert len(three_years) < len(format_receipts(make_history(1200))) / 50
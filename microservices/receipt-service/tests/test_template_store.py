@@ -0,0 +1,113 @@
+from ParseCache import MemoryCacheBackend
+from TemplateStore import TemplateStore, learn_template, normalize_line, get_template_scope
+from repair import build_receipt
+from pipeline import FallbackOutcome
+from ocr import OcrPage
+import PIL.Image
+
+SCOPE = 'user:1'
+
+FIRST_RECEIPT = """McDonald's
+Blk 123 Ang Mo Kio Ave 6
+Order 4521      23/09/2022 12:31
+2 McSpicy Meal          15.80
+1 Coke Large             2.50
+SUBTOTAL                18.30
+GST 9%                   1.65
+TOTAL                   19.95
+CASH                    20.00"""
+
+SECOND_RECEIPT = """McDonald's
+Blk 123 Ang Mo Kio Ave 6
+Order 4522      02/10/2022 19:02
+1 Filet-O-Fish           5.40
+3 Fries Medium           8.70
+1 McFlurry Oreo          3.20
+SUBTOTAL                17.30
+GST 9%                   1.56
+TOTAL                   18.86
+CASH                    20.00"""
+
+FIRST_PARSE = {
+    'merchant_name': "McDonald's", 'date': '23/09/2022', 'total_cost': '19.95', 'category': 'Food',
+    'itemized_list': [{'item_name': 'McSpicy Meal', 'item_cost': '15.80', 'item_quantity': '2'},
+                      {'item_name': 'Coke Large', 'item_cost': '2.50', 'item_quantity': '1'}],
+}
+
+
+class ParserStub:
+    model_name = 'gpt-4o-mini'
+    prompt_version = 1
+
+
+def model_outcome(receipt_dict):
+    outcome = FallbackOutcome()
+    outcome.response = build_receipt(receipt_dict)[0]
+    outcome.handler = ParserStub()
+    return outcome
+
+
+def test_learned_template_extracts_the_next_receipt_without_a_model():
+    store = TemplateStore(MemoryCacheBackend())
+    assert store.match(SCOPE, [OcrPage(FIRST_RECEIPT, 95.0)]) is None
+    store.learn(SCOPE, [OcrPage(FIRST_RECEIPT, 95.0)], model_outcome(FIRST_PARSE))
+
+    outcome = store.match(SCOPE, [OcrPage(SECOND_RECEIPT, 93.0)])
+
+    assert outcome.response.to_dict() == {
+        'merchant_name': "McDonald's", 'date': '02/10/2022', 'total_cost': '18.86', 'category': 'FOOD',
+        'itemized_list': [{'item_name': 'Filet-O-Fish', 'item_cost': '5.40', 'item_quantity': '1'},
+                          {'item_name': 'Fries Medium', 'item_cost': '8.70', 'item_quantity': '3'},
+                          {'item_name': 'McFlurry Oreo', 'item_cost': '3.20', 'item_quantity': '1'}]}
+    # Cached as a parse of the model the template was learned from
+    assert (outcome.handler.model_name, outcome.handler.prompt_version) == ('gpt-4o-mini', 1)
+    assert store.stats() == {'lookups': 2, 'hits': 1, 'mismatches': 0, 'misses': 1, 'hit_rate': 0.5,
+                             'learned': 1, 'size': 1}
+
+
+def test_receipt_that_does_not_add_up_goes_to_the_model():
+    store = TemplateStore(MemoryCacheBackend())
+    store.learn(SCOPE, [OcrPage(FIRST_RECEIPT, 95.0)], model_outcome(FIRST_PARSE))
+    # OCR misread a price, the items no longer add up to the subtotal
+    misread = SECOND_RECEIPT.replace('8.70', '6.70')
+
+    assert store.match(SCOPE, [OcrPage(misread, 90.0)]) is None
+    assert store.stats()['mismatches'] == 1
+
+
+def test_template_is_not_learned_when_it_cannot_reproduce_the_parse():
+    store = TemplateStore(MemoryCacheBackend())
+    # The model read a total that is not on the OCR text
+    store.learn(SCOPE, [OcrPage(FIRST_RECEIPT, 95.0)], model_outcome({**FIRST_PARSE, 'total_cost': '21.00'}))
+    assert store.stats()['size'] == 0
+
+
+def test_only_ocr_pages_are_matched_and_learned():
+    store = TemplateStore(MemoryCacheBackend())
+    image = PIL.Image.new('L', (10, 10))
+    store.learn(SCOPE, [image], model_outcome(FIRST_PARSE))
+    assert store.match(SCOPE, [image]) is None
+    assert store.stats()['lookups'] == 0 and store.stats()['size'] == 0
+
+
+def test_templates_are_kept_per_user():
+    store = TemplateStore(MemoryCacheBackend())
+    store.learn(SCOPE, [OcrPage(FIRST_RECEIPT, 95.0)], model_outcome(FIRST_PARSE))
+
+    # Another user's receipts never use it, nor would a template they taught decide this user's receipts
+    assert store.match('user:2', [OcrPage(SECOND_RECEIPT, 93.0)]) is None
+    assert store.stats()['misses'] == 1
+    assert store.match(SCOPE, [OcrPage(SECOND_RECEIPT, 93.0)]) is not None
+
+    assert get_template_scope({'userId': '1', 'allowDuplicate': 'true'}) == SCOPE
+    assert get_template_scope({'geminiKey': 'a'}) != get_template_scope({'geminiKey': 'b'})
+
+
+def test_learned_anchors():
+    template = learn_template(FIRST_RECEIPT.splitlines(), build_receipt(FIRST_PARSE)[0])
+    assert template.anchor == normalize_line("McDonald's")
+    assert template.total_label == 'total'
+    assert template.skip_labels == {'subtotal', 'gst'}
+    assert template.quantity_position == 'leading'
+    # Items are line totals, they add up to the subtotal before tax
+    assert (template.sum_rule, template.sum_label) == ('costs', 'subtotal')
@@ -0,0 +1,52 @@
+import PIL.Image
+import tokens
+from tokens import estimate_gemini_tokens, count_openai_tokens, static_token_count
+from preprocess import ImagePreprocessor, openai_image_tokens
+from tests.test_async_service import ScriptedParser, VALID_RECEIPT
+
+
+def test_estimate_gemini_tokens():
+    assert estimate_gemini_tokens('') == 0
+    assert estimate_gemini_tokens('abcd') == 1
+    assert estimate_gemini_tokens('abcde') == 2
+    # Counted in UTF-8 bytes, so non latin text is not underestimated
+    assert estimate_gemini_tokens('日本') == 2
+
+
+def test_static_token_count_counts_once():
+    counted = []
+
+    def count(text):
+        counted.append(text)
+        return len(text)
+
+    assert static_token_count(('TEST', 'static'), 'prompt', count) == 6
+    assert static_token_count(('TEST', 'static'), 'prompt', count) == 6
+    assert counted == ['prompt']
+
+
+def test_encoding_load_failure_is_cached(monkeypatch):
+    loads = []
+
+    def encoding_for_model(model_name):
+        loads.append(model_name)
+        raise ConnectionError('offline')
+
+    monkeypatch.setattr(tokens.tiktoken, 'encoding_for_model', encoding_for_model)
+    monkeypatch.setattr(tokens, '_encodings', {})
+
+    assert count_openai_tokens('abcdefgh', 'gpt-test') == 2
+    assert count_openai_tokens('abcdefgh', 'gpt-test') == 2
+    assert loads == ['gpt-test']
+
+
+def test_parse_stops_before_sending_when_over_input_limit():
+    parser = ScriptedParser([VALID_RECEIPT])
+    parser.preprocessor = ImagePreprocessor('OPENAI', openai_image_tokens, max_dimension=2048, max_short_side=768)
+    parser.get_input_token_limit = lambda: 5000
+    images = [PIL.Image.new('L', (768, 2048))] * 3
+
+    # 85 + 170 * 8 tokens per page
+    assert parser.estimate_initial_tokens(images[:1]) > 1445
+    assert parser.parse(images) is None
+    assert parser.sent == []
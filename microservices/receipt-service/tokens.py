@@ -0,0 +1,66 @@
+import math
+import threading
+import tiktoken
+
+# Local token accounting for the retry and input limit checks
+# The checks only need an estimate before a message is sent, the billed usage comes back with each response.
+# Counting locally keeps network calls out of the retry loop: Gemini's count_tokens is an API request, and
+# tiktoken downloads its encoding the first time it is used, so encoders are loaded once per process.
+
+# Gemini has no local tokenizer in the SDK, its SentencePiece tokens average about 4 bytes of text
+GEMINI_BYTES_PER_TOKEN = 4
+# Encoding of models tiktoken does not know yet, the gpt-4o family encoding
+DEFAULT_ENCODING = 'o200k_base'
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+_static_counts = {}
+_static_counts_lock = threading.Lock()
+
+
+def get_encoding(model_name: str):
+    """tiktoken encoding of an OpenAI model, loaded once per process, None if it cannot be loaded"""
+    with _encodings_lock:
+        if model_name in _encodings:
+            return _encodings[model_name]
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+        except Exception as e:
+            # No network to download the encoding, remember it so the download is not retried on every count
+            print(f"Unable to load tiktoken encoding for {model_name}, estimating tokens instead: {e}")
+            encoding = None
+        _encodings[model_name] = encoding
+        return encoding
+
+
+def estimate_text_tokens(text: str, bytes_per_token: int = GEMINI_BYTES_PER_TOKEN) -> int:
+    """Token estimate from the UTF-8 size of the text, rounded up"""
+    return math.ceil(len(text.encode('utf-8')) / bytes_per_token)
+
+
+def count_openai_tokens(text: str, model_name: str) -> int:
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return estimate_text_tokens(text)
+    return len(encoding.encode(text))
+
+
+def estimate_gemini_tokens(text: str) -> int:
+    return estimate_text_tokens(text, GEMINI_BYTES_PER_TOKEN)
+
+
+def static_token_count(key, text: str, count) -> int:
+    """Token count of a prompt that is the same for every request, count(text) only runs once per key and text
+
+    key identifies the tokenizer, e.g. (provider, model_name).
+    """
+    with _static_counts_lock:
+        tokens = _static_counts.get((key, text))
+    if tokens is None:
+        tokens = count(text)
+        with _static_counts_lock:
+            _static_counts[(key, text)] = tokens
+    return tokens